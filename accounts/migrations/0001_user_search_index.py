@@ -0,0 +1,51 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:03
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def build_search_index(apps, schema_editor):
+    """Индексирует уже существующих пользователей"""
+    from accounts.search import INDEXED_FIELDS, search_terms
+
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    UserSearchTerm = apps.get_model('accounts', 'UserSearchTerm')
+
+    batch = []
+    for user in User.objects.only(*INDEXED_FIELDS).iterator(chunk_size=2000):
+        values = (getattr(user, field) for field in INDEXED_FIELDS)
+        batch.extend(
+            UserSearchTerm(user_id=user.pk, kind=kind, term=term)
+            for kind, term in search_terms(*values)
+        )
+        if len(batch) >= 5000:
+            UserSearchTerm.objects.bulk_create(batch)
+            batch = []
+    UserSearchTerm.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserSearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('t', 'Слово'), ('g', 'Триграмма')], max_length=1)),
+                ('term', models.CharField(max_length=150)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['kind', 'term', 'user'], name='accounts_usersearch_term_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'kind', 'term'), name='accounts_usersearch_uniq')],
+            },
+        ),
+        migrations.RunPython(build_search_index, migrations.RunPython.noop),
+    ]
@@ -4,9 +4,50 @@ from django.db.models.signals import post_save
 from django.dispatch import receiver
 
 
+class UserSearchTerm(models.Model):
+    """
+    Поисковый индекс пользователей.
+
+    Для каждого пользователя хранятся нормализованные слова из username,
+    first_name и last_name (поиск по префиксу) и их триграммы (поиск по
+    подстроке). Обе выборки идут по индексу (kind, term).
+    """
+    KIND_TOKEN = 't'
+    KIND_TRIGRAM = 'g'
+    KIND_CHOICES = [
+        (KIND_TOKEN, 'Слово'),
+        (KIND_TRIGRAM, 'Триграмма'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='search_terms')
+    kind = models.CharField(max_length=1, choices=KIND_CHOICES)
+    term = models.CharField(max_length=150)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['kind', 'term', 'user'], name='accounts_usersearch_term_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'kind', 'term'], name='accounts_usersearch_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id}: {self.term}'
+
+
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     """Автоматически создает профиль пользователя при создании User"""
     if created:
         from chat.models import UserProfile
         UserProfile.objects.create(user=instance)
+
+
+@receiver(post_save, sender=User)
+def update_user_search_terms(sender, instance, created, update_fields=None, **kwargs):
+    """Переиндексация при изменении имени (например, last_login не трогает индекс)"""
+    from .search import INDEXED_FIELDS, index_user
+
+    if update_fields is not None and not set(update_fields) & set(INDEXED_FIELDS):
+        return
+    index_user(instance, created=created)
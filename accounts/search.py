@@ -0,0 +1,108 @@
+"""
+Индексированный поиск пользователей.
+
+Имена разбиваются на нормализованные слова (нижний регистр, ё -> е).
+Префиксный поиск — это диапазон term >= q AND term < q + '\\U0010ffff' по
+индексу, поэтому работает одинаково в SQLite и PostgreSQL. Для поиска
+по подстроке (как раньше icontains) используются триграммы слов:
+пользователь подходит, если в его индексе есть все триграммы запроса.
+"""
+import re
+
+from django.db import transaction
+from django.db.models import Case, Count, IntegerField, Q, Sum, Value, When
+
+from .models import UserSearchTerm
+
+
+INDEXED_FIELDS = ('username', 'first_name', 'last_name')
+MAX_QUERY_TOKENS = 5
+MAX_TOKEN_LENGTH = 32
+
+# Вес совпадения: слово целиком > префикс слова > триграмма
+EXACT_WEIGHT = 1000
+PREFIX_WEIGHT = 500
+TRIGRAM_WEIGHT = 1
+
+_TOKEN_RE = re.compile(r'[^\W_]+', re.UNICODE)
+_PREFIX_END = '\U0010ffff'
+
+
+def normalize(value):
+    return (value or '').lower().replace('ё', 'е')
+
+
+def tokenize(value):
+    """Слова строки; username вида ivan_petrov дает и ivan_petrov, и ivan, petrov"""
+    value = normalize(value)
+    tokens = _TOKEN_RE.findall(value)
+    compact = value.strip()
+    if compact and ' ' not in compact and compact not in tokens:
+        tokens.append(compact)
+    return [token[:MAX_TOKEN_LENGTH] for token in tokens]
+
+
+def trigrams(token):
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+
+def search_terms(*values):
+    """Пары (kind, term) для индекса по значениям полей"""
+    terms = set()
+    for value in values:
+        for token in tokenize(value):
+            terms.add((UserSearchTerm.KIND_TOKEN, token))
+            terms.update((UserSearchTerm.KIND_TRIGRAM, gram) for gram in trigrams(token))
+    return terms
+
+
+def index_user(user, created=False):
+    """Перестраивает записи индекса одного пользователя"""
+    terms = search_terms(*(getattr(user, field) for field in INDEXED_FIELDS))
+    with transaction.atomic():
+        if not created:
+            UserSearchTerm.objects.filter(user=user).delete()
+        UserSearchTerm.objects.bulk_create(
+            UserSearchTerm(user=user, kind=kind, term=term) for kind, term in terms
+        )
+
+
+def search_user_ids(query, exclude_id=None, limit=10):
+    """ID пользователей, подходящих под запрос, в порядке релевантности"""
+    tokens = tokenize(query)[:MAX_QUERY_TOKENS]
+    if not tokens:
+        return []
+
+    token_filter = Q()
+    score = []
+    required_trigrams = set()
+    for token in tokens:
+        token_filter |= Q(term__gte=token, term__lt=token + _PREFIX_END)
+        score.append(When(kind=UserSearchTerm.KIND_TOKEN, term=token, then=Value(EXACT_WEIGHT)))
+        required_trigrams |= trigrams(token)
+    score.append(When(kind=UserSearchTerm.KIND_TOKEN, then=Value(PREFIX_WEIGHT)))
+
+    condition = Q(token_filter, kind=UserSearchTerm.KIND_TOKEN)
+    if required_trigrams:
+        condition |= Q(kind=UserSearchTerm.KIND_TRIGRAM, term__in=required_trigrams)
+
+    rows = UserSearchTerm.objects.filter(condition)
+    if exclude_id is not None:
+        rows = rows.exclude(user_id=exclude_id)
+
+    # Без совпадения по слову нужны все триграммы запроса (подстрока)
+    matched = Q(words__gt=0)
+    if required_trigrams:
+        matched |= Q(score__gte=len(required_trigrams) * TRIGRAM_WEIGHT)
+
+    ranked = (
+        rows.values('user_id')
+        .annotate(
+            score=Sum(Case(*score, default=Value(TRIGRAM_WEIGHT), output_field=IntegerField())),
+            words=Count('id', filter=Q(kind=UserSearchTerm.KIND_TOKEN)),
+        )
+        .filter(matched)
+        .order_by('-score', 'user_id')
+        .values_list('user_id', flat=True)
+    )
+    return list(ranked[:limit])
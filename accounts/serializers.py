@@ -2,6 +2,7 @@ from rest_framework import serializers
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate
 from chat.models import UserProfile
+from chat.presence import get_presence_store, latest_seen
 
 
 class UserRegistrationSerializer(serializers.ModelSerializer):
@@ -72,19 +73,21 @@ class UserProfileDetailSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'username', 'date_joined']
     
     def get_profile(self, obj):
+        """is_online и last_seen - из хранилища присутствия, как в справочнике пользователей"""
+        is_online, seen = get_presence_store().statuses([obj.id])[obj.id]
         try:
             profile = obj.profile
-            return {
-                'is_online': profile.is_online,
-                'last_seen': profile.last_seen,
-                'avatar': profile.avatar
-            }
         except UserProfile.DoesNotExist:
             return {
-                'is_online': False,
-                'last_seen': None,
+                'is_online': is_online,
+                'last_seen': seen,
                 'avatar': None
             }
+        return {
+            'is_online': is_online,
+            'last_seen': latest_seen(profile.last_seen, seen),
+            'avatar': profile.avatar
+        }
 
 
 class ChangePasswordSerializer(serializers.Serializer):
@@ -1,3 +1,88 @@
-from django.test import TestCase
+from django.contrib.auth.models import User
+from rest_framework.test import APITestCase
 
-# Create your tests here.
+from chat.models import UserProfile
+from chat.presence import get_presence_store, reset_presence_store
+from .models import UserSearchTerm
+from .search import search_user_ids
+
+
+class UserSearchTests(APITestCase):
+    def setUp(self):
+        self.me = User.objects.create_user('me', password='testpass123')
+        self.ivan = User.objects.create_user('ivan_petrov', first_name='Иван', last_name='Петров')
+        self.ivanna = User.objects.create_user('ivanna', first_name='Иванна', last_name='Семёнова')
+        self.olga = User.objects.create_user('olga', first_name='Ольга', last_name='Иванова')
+        self.client.force_authenticate(self.me)
+
+    def test_exact_word_ranks_above_prefix(self):
+        self.assertEqual(search_user_ids('иван')[:1], [self.ivan.id])
+        self.assertEqual(set(search_user_ids('иван')), {self.ivan.id, self.ivanna.id, self.olga.id})
+
+    def test_substring_and_normalization(self):
+        self.assertEqual(search_user_ids('petrov'), [self.ivan.id])
+        self.assertEqual(search_user_ids('менов'), [self.ivanna.id])
+        self.assertEqual(search_user_ids('СЕМЕН'), [self.ivanna.id])
+        self.assertEqual(search_user_ids('xyz'), [])
+
+    def test_index_follows_name_changes(self):
+        self.olga.last_name = 'Смирнова'
+        self.olga.save()
+        self.assertEqual(search_user_ids('смирн'), [self.olga.id])
+        self.assertNotIn(self.olga.id, search_user_ids('иванова'))
+
+        self.olga.delete()
+        self.assertFalse(UserSearchTerm.objects.filter(user_id=self.olga.id).exists())
+
+    def test_search_endpoint_excludes_current_user(self):
+        response = self.client.get('/api/auth/search/', {'q': 'me'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['users'], [])
+
+        response = self.client.get('/api/auth/search/', {'q': 'ольга'})
+        user = response.data['users'][0]
+        self.assertEqual(user['username'], 'olga')
+        self.assertEqual(user['full_name'], 'Ольга Иванова')
+        self.assertFalse(user['is_online'])
+
+
+class UserDirectoryTests(APITestCase):
+    def setUp(self):
+        self.me = User.objects.create_user('me', password='testpass123')
+        for i in range(5):
+            User.objects.create_user(f'user{i}')
+        self.client.force_authenticate(self.me)
+
+    def test_cursor_walks_directory(self):
+        usernames = []
+        params = {'limit': 2}
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/auth/users/', params)
+        while True:
+            usernames += [user['username'] for user in response.data['users']]
+            if not response.data['has_more']:
+                break
+            params['after'] = response.data['next_after']
+            response = self.client.get('/api/auth/users/', params)
+        self.assertEqual(usernames, [f'user{i}' for i in range(5)])
+
+    def test_presence_comes_from_store(self):
+        reset_presence_store()
+        self.addCleanup(reset_presence_store)
+        user = User.objects.get(username='user0')
+        for user_id in (self.me.id, user.id):
+            get_presence_store().connect(user_id, f'tab-{user_id}')
+
+        card = self.client.get('/api/auth/users/').data['users'][0]
+        self.assertEqual(card['username'], 'user0')
+        self.assertTrue(card['is_online'])
+        self.assertIsNotNone(card['last_seen'])
+
+        profile = self.client.get('/api/auth/profile/').data['profile']
+        self.assertTrue(profile['is_online'])
+        self.assertIsNotNone(profile['last_seen'])
+        self.assertFalse(UserProfile.objects.get(user=self.me).is_online)
+
+    def test_invalid_limit(self):
+        response = self.client.get('/api/auth/users/', {'limit': 'x'})
+        self.assertEqual(response.status_code, 400)
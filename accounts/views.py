@@ -5,14 +5,16 @@ from rest_framework.response import Response
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
-from django.db.models import Q
 from chat.models import UserProfile
+from chat.pagination import InvalidCursor, parse_limit
+from chat.presence import get_presence_store, latest_seen
 from .serializers import (
     UserRegistrationSerializer, UserLoginSerializer,
     UserProfileUpdateSerializer, UserProfileDetailSerializer,
     ChangePasswordSerializer
 )
 from chat.serializers import UserSerializer
+from .search import search_user_ids
 
 
 def get_tokens_for_user(user):
@@ -57,10 +59,8 @@ def user_login(request):
     
     if user:
         if user.is_active:
-            # Обновляем статус онлайн
-            profile, created = UserProfile.objects.get_or_create(user=user)
-            profile.is_online = True
-            profile.save()
+            # Онлайн-статус ведет WebSocket; здесь только обновляем last_seen
+            get_presence_store().touch(user.id)
             
             tokens = get_tokens_for_user(user)
             
@@ -83,13 +83,8 @@ def user_login(request):
 @permission_classes([IsAuthenticated])
 def user_logout(request):
     """Выход пользователя"""
-    try:
-        # Обновляем статус оффлайн
-        profile = request.user.profile
-        profile.is_online = False
-        profile.save()
-    except UserProfile.DoesNotExist:
-        pass
+    # last_seen попадет в профиль при следующей пакетной записи
+    get_presence_store().touch(request.user.id)
     
     try:
         # Получаем refresh token из запроса и добавляем в blacklist
@@ -161,83 +156,68 @@ def change_password(request):
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+DEFAULT_AVATAR = 'https://via.placeholder.com/150?text=Avatar'
+SEARCH_LIMIT = 10
+DIRECTORY_FIELDS = ('id', 'username', 'first_name', 'last_name', 'profile__last_seen', 'profile__avatar')
+
+
+def user_rows(rows):
+    """
+    Карточки пользователей из values() без создания моделей.
+    Онлайн-статус и свежий last_seen берутся одним запросом к хранилищу
+    присутствия; из профиля - только last_seen, уже записанный пачкой.
+    """
+    statuses = get_presence_store().statuses([row['id'] for row in rows])
+    return [{
+        'id': row['id'],
+        'username': row['username'],
+        'first_name': row['first_name'],
+        'last_name': row['last_name'],
+        'full_name': f"{row['first_name']} {row['last_name']}".strip(),
+        'is_online': statuses[row['id']][0],
+        'last_seen': latest_seen(row['profile__last_seen'], statuses[row['id']][1]),
+        'avatar': row['profile__avatar'] or DEFAULT_AVATAR,
+    } for row in rows]
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def search_users(request):
-    """Поиск пользователей по имени"""
+    """Поиск пользователей по имени (индекс UserSearchTerm, по релевантности)"""
     query = request.GET.get('q', '').strip()
     
     if not query:
         return Response({'users': []})
     
-    # Поиск по username, first_name, last_name
-    users = User.objects.filter(
-        Q(username__icontains=query) |
-        Q(first_name__icontains=query) |
-        Q(last_name__icontains=query)
-    ).exclude(id=request.user.id).select_related('profile')[:10]  # Ограничиваем результаты
-    
-    user_data = []
-    for user in users:
-        try:
-            profile = user.profile
-            user_info = {
-                'id': user.id,
-                'username': user.username,
-                'first_name': user.first_name,
-                'last_name': user.last_name,
-                'full_name': f"{user.first_name} {user.last_name}".strip(),
-                'is_online': profile.is_online,
-                'last_seen': profile.last_seen,
-                'avatar': profile.avatar or 'https://via.placeholder.com/150?text=Avatar'
-            }
-        except UserProfile.DoesNotExist:
-            user_info = {
-                'id': user.id,
-                'username': user.username,
-                'first_name': user.first_name,
-                'last_name': user.last_name,
-                'full_name': f"{user.first_name} {user.last_name}".strip(),
-                'is_online': False,
-                'last_seen': None,
-                'avatar': 'https://via.placeholder.com/150?text=Avatar'
-            }
-        user_data.append(user_info)
+    user_ids = search_user_ids(query, exclude_id=request.user.id, limit=SEARCH_LIMIT)
+    rows = {row['id']: row for row in User.objects.filter(id__in=user_ids).values(*DIRECTORY_FIELDS)}
     
-    return Response({'users': user_data})
+    return Response({'users': user_rows([rows[user_id] for user_id in user_ids if user_id in rows])})
 
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def user_list(request):
-    """Получить список всех пользователей (для поиска и начала чатов)"""
-    users = User.objects.exclude(id=request.user.id).select_related('profile')
-    user_data = []
+    """
+    Справочник пользователей (для поиска и начала чатов).
+    Курсорная пагинация по username: after - последний username предыдущей страницы.
+    """
+    try:
+        limit = parse_limit(request.GET.get('limit'))
+    except InvalidCursor as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    users = User.objects.exclude(id=request.user.id).order_by('username')
+    after = request.GET.get('after')
+    if after:
+        users = users.filter(username__gt=after)
     
-    for user in users:
-        try:
-            profile = user.profile
-            user_info = {
-                'id': user.id,
-                'username': user.username,
-                'first_name': user.first_name,
-                'last_name': user.last_name,
-                'full_name': f"{user.first_name} {user.last_name}".strip(),
-                'is_online': profile.is_online,
-                'last_seen': profile.last_seen,
-                'avatar': profile.avatar or 'https://via.placeholder.com/150?text=Avatar'
-            }
-        except UserProfile.DoesNotExist:
-            user_info = {
-                'id': user.id,
-                'username': user.username,
-                'first_name': user.first_name,
-                'last_name': user.last_name,
-                'full_name': f"{user.first_name} {user.last_name}".strip(),
-                'is_online': False,
-                'last_seen': None,
-                'avatar': 'https://via.placeholder.com/150?text=Avatar'
-            }
-        user_data.append(user_info)
+    rows = list(users.values(*DIRECTORY_FIELDS)[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
     
-    return Response({'users': user_data})
+    return Response({
+        'users': user_rows(rows),
+        'has_more': has_more,
+        'next_after': rows[-1]['username'] if has_more else None,
+    })
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import ChatRoom, Message, UserProfile
+from .models import ArchiveSegment, ChatRoom, Message, ReadReceipt, UserProfile
 
 
 @admin.register(UserProfile)
@@ -12,7 +12,7 @@ class UserProfileAdmin(admin.ModelAdmin):
 
 @admin.register(ChatRoom)
 class ChatRoomAdmin(admin.ModelAdmin):
-    list_display = ['name', 'created_at', 'participants_count']
+    list_display = ['name', 'created_at', 'participants_count', 'retention_days']
     list_filter = ['created_at']
     search_fields = ['name', 'description']
     filter_horizontal = ['participants']
@@ -24,11 +24,25 @@ class ChatRoomAdmin(admin.ModelAdmin):
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
-    list_display = ['user', 'room', 'content_preview', 'timestamp', 'is_read']
-    list_filter = ['timestamp', 'is_read', 'room']
+    list_display = ['user', 'room', 'content_preview', 'timestamp']
+    list_filter = ['timestamp', 'room']
     search_fields = ['user__username', 'content', 'room__name']
     readonly_fields = ['timestamp']
     
     def content_preview(self, obj):
         return obj.content[:50] + '...' if len(obj.content) > 50 else obj.content
     content_preview.short_description = 'Содержание'
+
+
+@admin.register(ReadReceipt)
+class ReadReceiptAdmin(admin.ModelAdmin):
+    list_display = ['user', 'room', 'last_read_message_id', 'updated_at']
+    search_fields = ['user__username', 'room__name']
+    readonly_fields = ['updated_at']
+
+
+@admin.register(ArchiveSegment)
+class ArchiveSegmentAdmin(admin.ModelAdmin):
+    list_display = ['room', 'first_timestamp', 'last_timestamp', 'message_count', 'path']
+    list_filter = ['room']
+    readonly_fields = [field.name for field in ArchiveSegment._meta.fields]
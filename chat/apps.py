@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        # Подключает счетчик SQL-запросов к новым соединениям с базой
+        from . import metrics  # noqa: F401
@@ -0,0 +1,244 @@
+"""
+Срок хранения и архив сообщений.
+
+Сообщения старше срока хранения комнаты (ChatRoom.retention_days или общий
+CHAT_RETENTION['DAYS']) переносятся из таблицы сообщений в сжатые сегменты
+JSONL (gzip, формат как у export_messages) в ARCHIVE_DIR. Перенос идет
+пачками по BATCH_SIZE самых старых сообщений комнаты: файл сегмента пишется
+целиком до транзакции, а транзакция только добавляет ArchiveSegment и
+удаляет пачку, поэтому блокировка базы короткая. Если транзакция не
+удалась, файл удаляется; если процесс упал между записью файла и
+транзакцией, сообщения остаются в базе и попадут в следующий сегмент.
+
+История комнаты читает архив, когда в базе больше нет более старых
+сообщений, и по курсору на архивированное сообщение (history_with_archive).
+"""
+import gzip
+import json
+import os
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework import serializers
+
+from .exporter import export_queryset, jsonl_line
+from .models import ArchiveSegment, ChatRoom, Message
+from .pagination import InvalidCursor, _resolve_anchor, keyset_page, parse_limit
+from .serializers import message_is_read
+
+
+DEFAULTS = {
+    # None - хранить сообщения бессрочно
+    'DAYS': None,
+    'ARCHIVE_DIR': 'archive',
+    'BATCH_SIZE': 1000,
+    # Пауза между пачками (секунды), чтобы не занимать базу подряд
+    'PAUSE': 0.05,
+}
+
+
+def retention_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_RETENTION', {})}
+
+
+def room_cutoffs(room_id=None, days=None, now=None):
+    """
+    (room_id, граница) для комнат с ограниченным сроком хранения: архивируются
+    сообщения старше границы. days переопределяет сроки всех комнат.
+    """
+    now = now or timezone.now()
+    default_days = retention_settings()['DAYS']
+    rooms = ChatRoom.objects.order_by('id')
+    if room_id is not None:
+        rooms = rooms.filter(id=room_id)
+    for pk, retention_days in rooms.values_list('id', 'retention_days'):
+        room_days = days if days is not None else (retention_days if retention_days is not None else default_days)
+        if room_days is not None:
+            yield pk, now - timedelta(days=room_days)
+
+
+def archive_batch(room_id, cutoff, batch_size):
+    """Переносит одну пачку самых старых сообщений комнаты в новый сегмент; возвращает их число"""
+    rows = list(export_queryset(room_id=room_id, until=cutoff.isoformat())[:batch_size])
+    if not rows:
+        return 0
+
+    directory = os.path.join(retention_settings()['ARCHIVE_DIR'], f'room_{room_id}')
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{rows[0][0]}-{rows[-1][0]}-{int(time.time() * 1000)}.jsonl.gz')
+    with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as output:
+        for row in rows:
+            output.write(jsonl_line(row))
+    os.replace(path + '.tmp', path)
+
+    ids = [row[0] for row in rows]
+    try:
+        with transaction.atomic():
+            ArchiveSegment.objects.create(
+                room_id=room_id,
+                path=path,
+                first_message_id=min(ids),
+                last_message_id=max(ids),
+                first_timestamp=rows[0][-1],
+                last_timestamp=rows[-1][-1],
+                message_count=len(rows),
+            )
+            Message.objects.filter(id__in=ids).delete()
+    except Exception:
+        os.remove(path)
+        raise
+    return len(rows)
+
+
+def archive_room(room_id, cutoff, batch_size=None, pause=None):
+    """Архивирует все сообщения комнаты старше cutoff; возвращает их число"""
+    config = retention_settings()
+    batch_size = batch_size or config['BATCH_SIZE']
+    pause = config['PAUSE'] if pause is None else pause
+    total = 0
+    while True:
+        count = archive_batch(room_id, cutoff, batch_size)
+        total += count
+        if count < batch_size:
+            return total
+        if pause:
+            time.sleep(pause)
+
+
+def read_segment(segment):
+    """Записи сегмента от старых к новым"""
+    with gzip.open(segment.path, 'rt', encoding='utf-8') as source:
+        records = [json.loads(line) for line in source]
+    for record in records:
+        record['timestamp'] = parse_datetime(record['timestamp'])
+    return records
+
+
+def archived_anchor(room_id, message_id):
+    """(timestamp, id) сообщения, если оно в архиве комнаты, иначе None"""
+    segments = ArchiveSegment.objects.filter(
+        room_id=room_id, first_message_id__lte=message_id, last_message_id__gte=message_id
+    )
+    for segment in segments:
+        for record in read_segment(segment):
+            if record['id'] == message_id:
+                return record['timestamp'], record['id']
+    return None
+
+
+def _key_older(record, anchor):
+    if anchor[1] is None:
+        return record['timestamp'] < anchor[0]
+    return (record['timestamp'], record['id']) < anchor
+
+
+def archived_records(room_id, anchor, limit, newer=False):
+    """
+    До limit архивных сообщений по ту сторону anchor ((timestamp, id), id
+    может быть None; anchor=None - с самого нового): старше anchor от новых
+    к старым или, с newer=True, новее anchor от старых к новым.
+    Возвращает (записи, есть ли еще).
+    """
+    segments = ArchiveSegment.objects.filter(room_id=room_id)
+    if newer:
+        segments = segments.filter(last_timestamp__gte=anchor[0]).order_by('first_timestamp', 'id')
+    else:
+        if anchor is not None:
+            segments = segments.filter(first_timestamp__lte=anchor[0])
+        segments = segments.order_by('-last_timestamp', '-id')
+    records = []
+    for segment in segments.iterator():
+        if newer:
+            records.extend(r for r in read_segment(segment) if (r['timestamp'], r['id']) > anchor)
+        else:
+            records.extend(
+                r for r in reversed(read_segment(segment)) if anchor is None or _key_older(r, anchor)
+            )
+        if len(records) > limit:
+            break
+    return records[:limit], len(records) > limit
+
+
+def older_archived(room_id, anchor, limit):
+    """Продолжение истории в архиве, когда в базе старше anchor ничего нет"""
+    if limit < 1:
+        # Сегменты всегда старше сообщений в базе
+        return [], ArchiveSegment.objects.filter(room_id=room_id).exists()
+    return archived_records(room_id, anchor, limit)
+
+
+def history_with_archive(room_id, queryset, before=None, after=None, limit=None, pending=()):
+    """
+    keyset_page с продолжением в архиве: курсор может указывать на
+    архивированное сообщение, а страница, на которой кончилась база,
+    дополняется архивными записями.
+    Возвращает (сообщения из базы, архивные записи, has_more, newest_first).
+    """
+    pending = list(pending)
+    try:
+        page, has_more, newest_first = keyset_page(queryset, before, after, limit, pending)
+    except InvalidCursor:
+        cursor = after or before or ''
+        anchor = archived_anchor(room_id, int(cursor)) if cursor.isdigit() else None
+        if anchor is None:
+            raise
+        limit = parse_limit(limit)
+        if not after:
+            records, has_more = archived_records(room_id, anchor, limit)
+            return [], records, has_more, True
+        records, has_more = archived_records(room_id, anchor, limit, newer=True)
+        page = []
+        if not has_more:
+            # Все сообщения в базе новее архивных
+            rest = limit - len(records)
+            page = list(queryset.order_by('timestamp', 'id')[:rest + 1])
+            has_more = len(page) > rest
+            page = page[:rest]
+        return page, records, has_more, False
+
+    if has_more or not newest_first:
+        return page, [], has_more, newest_first
+    if page:
+        anchor = page[-1].timestamp, page[-1].id
+    elif before:
+        # Курсор - ID последнего сообщения в базе или время
+        moment, message_id = _resolve_anchor(queryset, before, pending)
+        if timezone.is_naive(moment):
+            moment = timezone.make_aware(moment)
+        anchor = moment, message_id
+    else:
+        anchor = None
+    records, has_more = older_archived(room_id, anchor, parse_limit(limit) - len(page))
+    return page, records, has_more, True
+
+
+def history_records(records, user_id, own, peers):
+    """Архивные записи в формате MessageSerializer; own, peers - водяные знаки прочтения"""
+    users = {
+        user['id']: user for user in User.objects.filter(
+            id__in={record['user'] for record in records}
+        ).values('id', 'username', 'email', 'first_name', 'last_name')
+    }
+    timestamp_field = serializers.DateTimeField()
+    result = []
+    for record in records:
+        # Автор мог быть удален: остается имя из архива
+        user = users.get(record['user']) or {
+            'id': record['user'], 'username': record['username'], 'email': '', 'first_name': '', 'last_name': '',
+        }
+        result.append({
+            'id': record['id'],
+            'room': record['room'],
+            'user': user,
+            'user_username': user['username'],
+            'content': record['content'],
+            'timestamp': timestamp_field.to_representation(record['timestamp']),
+            'is_read': message_is_read(record['id'], record['user'], user_id, own, peers),
+            'archived': True,
+        })
+    return result
@@ -0,0 +1,54 @@
+"""
+Кодирование кадров WebSocket.
+
+Событие группы несет уже готовый JSON-кадр (`frame`): он кодируется один
+раз в отправителе, а consumer каждого получателя пересылает строку как
+есть. Кодек выбирается настройкой CHAT_JSON_CODEC: 'json' (стандартная
+библиотека) или 'orjson' (нужен пакет orjson).
+"""
+import json
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+def _json_dumps(data):
+    return json.dumps(data, ensure_ascii=False)
+
+
+def _orjson_dumps(data):
+    import orjson
+
+    return orjson.dumps(data).decode()
+
+
+CODECS = {
+    'json': _json_dumps,
+    'orjson': _orjson_dumps,
+}
+
+
+def get_codec(name=None):
+    """Функция кодирования: dict -> str"""
+    name = name or getattr(settings, 'CHAT_JSON_CODEC', 'json')
+    if name not in CODECS:
+        raise ImproperlyConfigured(f'Неизвестный CHAT_JSON_CODEC: {name}')
+    if name == 'orjson':
+        try:
+            import orjson  # noqa: F401
+        except ImportError:
+            raise ImproperlyConfigured('Для CHAT_JSON_CODEC=orjson установите пакет orjson')
+    return CODECS[name]
+
+
+def encode_frame(data):
+    """Кодирует кадр для отправки клиенту"""
+    return get_codec()(data)
+
+
+def group_event(handler, frame, **fields):
+    """
+    Событие для channel_layer.group_send: имя обработчика, готовый кадр и
+    служебные поля для фильтрации на стороне получателя (например, user_id).
+    """
+    return {'type': handler, 'frame': encode_frame(frame), **fields}
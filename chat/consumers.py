@@ -1,17 +1,57 @@
+import asyncio
 import json
 import logging
+import time
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
+from asgiref.sync import sync_to_async
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import User
-from .models import ChatRoom, Message, UserProfile
+from django.utils import timezone
+from .codec import encode_frame, group_event
+from .history_cache import cache_message
+from .membership import is_member, room_member_ids, user_room_ids
+from .metrics import MetricsConsumerMixin, count_response_bytes, current_sample
+from .models import Message, ReadReceipt
+from .outbound import OutboundQueue, UnackedFrames, get_unacked_store, outbound_settings, outbound_stats
+from .persistence import message_id_allocator, message_write_behind, write_behind_enabled
+from .presence import (
+    flush_last_seen, get_presence_store, is_large_room, presence_broadcaster, room_watchers_group_name,
+    status_groups, watchers_group_name,
+)
+from .pagination import InvalidCursor
+from .ratelimit import get_rate_limiter, release_rate_limits
+from .sync import replay_frames
+from .typing import typing_tracker
 
 logger = logging.getLogger(__name__)
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
+# Типы кадров клиента, которые попадают в метрики под своим именем
+FRAME_TYPES = {'chat_message', 'typing', 'heartbeat', 'mark_read', 'subscribe', 'unsubscribe', 'ack'}
+
+
+def room_group_name(room_id):
+    """Имя группы channel layer для комнаты"""
+    return f'chat_{room_id}'
+
+
+class ChatConsumer(MetricsConsumerMixin, AsyncWebsocketConsumer):
+    """Соединение с одной комнатой: ws/chat/<room_id>/"""
+
+    # Исходящая очередь и неподтвержденные сообщения (см. outbound.py)
+    outbound = None
+    unacked = None
+    # Собеседники, на группы наблюдателей которых подписано соединение
+    watching = frozenset()
+    # Комнаты, за статусами участников которых следит соединение:
+    # ID комнаты -> участники (кроме себя) или None для большой комнаты
+    watched_rooms = {}
+    # Последняя доставленная публикация статуса собеседника (отсев копий)
+    statuses = None
+
     async def connect(self):
-        self.room_id = self.scope['url_route']['kwargs']['room_id']
-        self.room_group_name = f'chat_{self.room_id}'
+        self.room_id = int(self.scope['url_route']['kwargs']['room_id'])
         self.user = self.scope['user']
 
         # Проверяем аутентификацию
@@ -20,174 +60,459 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
 
         # Проверяем доступ к комнате
-        room_access = await self.check_room_access()
+        room_access = await self.check_room_access(self.room_id)
         if not room_access:
             await self.close()
             return
 
+        # Имя группы задается только после проверок: по нему disconnect
+        # отличает принятое соединение от отклоненного
+        self.room_group_name = room_group_name(self.room_id)
+
         # Присоединяемся к группе комнаты
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
+        await self.watch_contacts()
 
-        # Обновляем статус пользователя на онлайн
-        await self.set_user_online(True)
+        # Регистрируем соединение в хранилище присутствия
+        became_online = await self.set_user_online(True)
 
         await self.accept()
+        self.start_outbound()
 
-        # Уведомляем о подключении
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_status_update',
-                'user_id': self.user.id,
-                'username': self.user.username,
-                'is_online': True,
-            }
-        )
+        # Переподключение: повторяем сообщения, пропущенные после курсора
+        await self.resume([self.room_id])
+
+        # Уведомляем о подключении, только если пользователь не был онлайн
+        if became_online:
+            await self.broadcast_status(True)
 
         # Отмечаем сообщения как прочитанные
-        await self.mark_messages_as_read()
+        await self.mark_messages_as_read(self.room_id)
 
     async def disconnect(self, close_code):
+        release_rate_limits(self.channel_name)
         if hasattr(self, 'room_group_name'):
+            await self.stop_outbound()
             # Покидаем группу
             await self.channel_layer.group_discard(
                 self.room_group_name,
                 self.channel_name
             )
-
-            # Обновляем статус на оффлайн
-            await self.set_user_online(False)
-
-            # Уведомляем об отключении
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'user_status_update',
-                    'user_id': self.user.id,
-                    'username': self.user.username,
-                    'is_online': False,
-                }
-            )
+            await self.unwatch_contacts()
+            await self.leave_presence([self.room_id])
 
     async def receive(self, text_data):
+        # Лимиты проверяются до разбора JSON: мусорные кадры тоже считаются
+        sample = current_sample()
+        if not await self.check_rate_limits(('CONNECTION', self.channel_name), ('USER', self.user.id)):
+            if sample is not None:
+                sample.labels['event'] = 'frame:rate_limited'
+            return
         try:
             data = json.loads(text_data)
-            message_type = data.get('type', 'chat_message')
-            
-            if message_type == 'chat_message':
-                message_content = data.get('message', '').strip()
-                
-                if not message_content:
-                    await self.send_error("Сообщение не может быть пустым")
-                    return
-                
-                # Сохраняем сообщение
-                saved_message = await self.save_message(message_content)
-                
-                if saved_message:
-                    # Отправляем в группу
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            'type': 'chat_message',
-                            'message_id': saved_message['id'],
-                            'message': saved_message['content'],
-                            'user_id': saved_message['user_id'],
-                            'username': saved_message['username'],
-                            'timestamp': saved_message['timestamp'],
-                        }
-                    )
-                    
-            elif message_type == 'typing':
-                is_typing = data.get('is_typing', False)
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'typing_indicator',
-                        'user_id': self.user.id,
-                        'username': self.user.username,
-                        'is_typing': is_typing
-                    }
-                )
-                
-            elif message_type == 'mark_read':
-                await self.mark_messages_as_read()
-                await self.send(text_data=json.dumps({
-                    'type': 'messages_marked_read',
-                    'room_id': self.room_id
-                }))
-                
+            if sample is not None:
+                frame_type = data.get('type', 'chat_message')
+                sample.labels['event'] = f"frame:{frame_type if frame_type in FRAME_TYPES else 'unknown'}"
+            await self.handle_frame(data)
         except json.JSONDecodeError:
             await self.send_error("Неверный формат JSON")
         except Exception as e:
             logger.error(f"Error in receive: {e}")
+            if sample is not None:
+                sample.error = True
             await self.send_error("Произошла ошибка")
 
+    async def handle_frame(self, data):
+        """Обработка входящего кадра; комната определяется URL соединения"""
+        await self.dispatch_frame(self.room_id, data.get('type', 'chat_message'), data)
+
+    async def dispatch_frame(self, room_id, message_type, data):
+        """Обработка кадров, относящихся к конкретной комнате"""
+        if message_type == 'chat_message':
+            message_content = data.get('message', '').strip()
+
+            if not message_content:
+                await self.send_error("Сообщение не может быть пустым")
+                return
+
+            if not await self.check_rate_limits(('ROOM', room_id)):
+                return
+
+            # Подписка могла пережить выход из комнаты
+            if not await self.check_room_access(room_id):
+                await self.send_error("Нет доступа к комнате")
+                return
+
+            # Сохраняем сообщение
+            saved_message = await self.save_message(room_id, message_content)
+
+            if saved_message:
+                # Отправляем в группу
+                # Кадр кодируется один раз, получатели пересылают его как есть
+                await self.channel_layer.group_send(
+                    room_group_name(room_id),
+                    group_event('chat_message', {
+                        'type': 'chat_message',
+                        'room_id': room_id,
+                        'message_id': saved_message['id'],
+                        'message': saved_message['content'],
+                        'user_id': saved_message['user_id'],
+                        'username': saved_message['username'],
+                        'timestamp': saved_message['timestamp'],
+                    }, room_id=room_id, user_id=saved_message['user_id'], message_id=saved_message['id'])
+                )
+
+        elif message_type == 'typing':
+            # В группу уходят только смены состояния, а не каждое нажатие клавиши
+            await typing_tracker.update(
+                self.user.id, room_id, bool(data.get('is_typing', False)),
+                lambda is_typing: self.broadcast_typing(room_id, is_typing),
+            )
+
+        elif message_type == 'heartbeat':
+            await sync_to_async(get_presence_store().heartbeat, thread_sensitive=False)(
+                self.user.id, self.channel_name
+            )
+
+        elif message_type == 'mark_read':
+            await self.mark_messages_as_read(room_id)
+            await self.push(encode_frame({
+                'type': 'messages_marked_read',
+                'room_id': room_id
+            }))
+
+        elif message_type == 'ack':
+            await self.acknowledge(data)
+
+    async def broadcast_status(self, is_online):
+        """Смена онлайн-статуса для собеседников (без повторов и кратких обрывов)"""
+        if is_online:
+            await presence_broadcaster.online(self.user.id, self.publish_status)
+        else:
+            await presence_broadcaster.offline(self.user.id, self.publish_status)
+
+    async def publish_status(self, is_online):
+        """Одна рассылка в группу наблюдателей пользователя (и в его большие комнаты)"""
+        event = group_event('user_status_update', {
+            'type': 'user_status',
+            'user_id': self.user.id,
+            'username': self.user.username,
+            'is_online': is_online,
+        }, user_id=self.user.id, username=self.user.username, is_online=is_online, published=time.time_ns())
+        for group in await database_sync_to_async(status_groups)(self.user.id):
+            await self.channel_layer.group_send(group, event)
+
+    def presence_rooms(self):
+        """Комнаты, собеседники из которых интересуют соединение"""
+        return [self.room_id]
+
+    @database_sync_to_async
+    def get_room_contacts(self, room_ids):
+        """
+        {ID комнаты: участники кроме самого пользователя или None для большой
+        комнаты} (из кэша членства); комнат, из которых он вышел, в ответе нет.
+        """
+        rooms = {}
+        for room_id in set(room_ids) & user_room_ids(self.user.id):
+            members = room_member_ids(room_id)
+            rooms[room_id] = None if is_large_room(members) else members - {self.user.id}
+        return rooms
+
+    async def watch_contacts(self, room_ids=()):
+        """
+        Подписывает соединение на статусы собеседников. Загружаются только
+        новые комнаты и room_ids (состав которых изменился), а в channel layer
+        уходят только изменения подписок.
+        """
+        current = set(self.presence_rooms())
+        stale = (current - self.watched_rooms.keys()) | (current & set(room_ids))
+        rooms = {room_id: members for room_id, members in self.watched_rooms.items() if room_id in current}
+        for room_id in stale:
+            rooms.pop(room_id, None)
+        if stale:
+            rooms.update(await self.get_room_contacts(stale))
+
+        contacts = frozenset().union(*(members for members in rooms.values() if members is not None))
+        large = {room_id for room_id, members in rooms.items() if members is None}
+        watched_large = {room_id for room_id, members in self.watched_rooms.items() if members is None}
+        await self.update_groups(
+            [watchers_group_name(user_id) for user_id in contacts - self.watching]
+            + [room_watchers_group_name(room_id) for room_id in large - watched_large],
+            [watchers_group_name(user_id) for user_id in self.watching - contacts]
+            + [room_watchers_group_name(room_id) for room_id in watched_large - large],
+        )
+        self.watched_rooms = rooms
+        self.watching = contacts
+
+    async def unwatch_contacts(self):
+        await self.update_groups([], [watchers_group_name(user_id) for user_id in self.watching] + [
+            room_watchers_group_name(room_id) for room_id, members in self.watched_rooms.items() if members is None
+        ])
+        self.watched_rooms = {}
+        self.watching = frozenset()
+
+    async def update_groups(self, added, discarded):
+        """Подписки на группы параллельно, а не по одному ответу channel layer за раз"""
+        await asyncio.gather(
+            *(self.channel_layer.group_add(group, self.channel_name) for group in added),
+            *(self.channel_layer.group_discard(group, self.channel_name) for group in discarded),
+        )
+
+    async def broadcast_typing(self, room_id, is_typing):
+        """Рассылка индикатора печати в группу комнаты"""
+        await self.channel_layer.group_send(
+            room_group_name(room_id),
+            group_event('typing_indicator', {
+                'type': 'typing_indicator',
+                'room_id': room_id,
+                'user_id': self.user.id,
+                'username': self.user.username,
+                'is_typing': is_typing
+            }, room_id=room_id, user_id=self.user.id)
+        )
+
+    async def leave_presence(self, room_ids):
+        """Снятие соединения с присутствия при отключении"""
+        await typing_tracker.clear(self.user.id, room_ids)
+
+        # Оффлайн - только если это было последнее соединение пользователя
+        went_offline = await self.set_user_online(False)
+
+        if went_offline:
+            await self.broadcast_status(False)
+
+        # last_seen записывается в БД пачками, а не на каждое отключение
+        await database_sync_to_async(flush_last_seen)()
+
     async def chat_message(self, event):
         """Отправка сообщения"""
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message_id': event['message_id'],
-            'message': event['message'],
-            'user_id': event['user_id'],
-            'username': event['username'],
-            'timestamp': event['timestamp'],
-        }))
+        await self.deliver_message(event.get('message_id'), event.get('room_id'), event['frame'])
 
     async def user_status_update(self, event):
         """Обновление статуса пользователя"""
-        if event['user_id'] != self.user.id:
-            await self.send(text_data=json.dumps({
-                'type': 'user_status',
-                'user_id': event['user_id'],
-                'username': event['username'],
-                'is_online': event['is_online'],
-            }))
+        if event['user_id'] == self.user.id:
+            return
+        # Одна публикация может прийти и через группу наблюдателей, и через большую комнату
+        if self.statuses is None:
+            self.statuses = {}
+        published = event.get('published')
+        if published is not None and self.statuses.get(event['user_id']) == published:
+            return
+        self.statuses[event['user_id']] = published
+        await self.push(self.status_frame(event), key=('status', event['user_id']))
+
+    def status_frame(self, event):
+        # Соединение с одной комнатой получает статус с room_id, как раньше
+        return encode_frame({
+            'type': 'user_status',
+            'room_id': self.room_id,
+            'user_id': event['user_id'],
+            'username': event['username'],
+            'is_online': event['is_online'],
+        })
+
+    async def presence_watch(self, event):
+        """
+        Состав комнаты изменился: пересчитываем подписки на статусы, а если
+        пользователь сам вышел из комнаты - закрываем соединение.
+        """
+        if not await self.check_room_access(self.room_id):
+            await self.close()
+            return
+        await self.watch_contacts([event.get('room_id')])
 
     async def typing_indicator(self, event):
         """Индикатор печати"""
         if event['user_id'] != self.user.id:
-            await self.send(text_data=json.dumps({
-                'type': 'typing_indicator',
-                'user_id': event['user_id'],
-                'username': event['username'],
-                'is_typing': event['is_typing']
-            }))
+            await self.push(event['frame'], key=('typing', event.get('room_id'), event['user_id']))
 
-    async def send_error(self, error_message):
+    async def send_error(self, error_message, **extra):
         """Отправка ошибки"""
-        await self.send(text_data=json.dumps({
+        await self.push(encode_frame({
             'type': 'error',
-            'message': error_message
+            'message': error_message,
+            **extra,
         }))
 
-    @database_sync_to_async
-    def check_room_access(self):
-        """Проверка доступа к комнате"""
+    def query_param(self, name):
+        params = parse_qs(self.scope.get('query_string', b'').decode())
+        return params.get(name, [''])[0]
+
+    def start_outbound(self):
+        """Исходящая очередь соединения (после accept); с ?acks=1 - и учет подтверждений"""
+        config = outbound_settings()
+        if not config['ENABLED']:
+            return
+        self.outbound = OutboundQueue(self.send_frame, config['MAX_FRAMES'], on_error=self.outbound_failed)
+        self.outbound.start()
+        if self.query_param('acks') == '1':
+            self.unacked = UnackedFrames(config['MAX_UNACKED'])
+
+    async def stop_outbound(self):
+        """Останавливает очередь и сохраняет неподтвержденные сообщения для следующего подключения"""
+        if self.outbound is not None:
+            await self.outbound.stop()
+        if self.unacked is not None and len(self.unacked):
+            await sync_to_async(get_unacked_store().save, thread_sensitive=False)(self.user.id, self.unacked.items())
+            self.unacked = None
+
+    async def send_frame(self, frame):
+        await self.send(text_data=frame)
+
+    async def outbound_failed(self):
+        """Отправка из очереди не удалась: соединение закрывается, клиент переподключится с курсором"""
         try:
-            room = ChatRoom.objects.get(id=self.room_id)
-            return room.participants.filter(id=self.user.id).exists()
-        except ChatRoom.DoesNotExist:
-            return False
+            await self.close(code=1011)
+        except Exception:
+            # Соединение уже разорвано
+            pass
 
-    @database_sync_to_async
-    def save_message(self, message_content):
-        """Сохранение сообщения"""
+    async def push(self, frame, key=None):
+        """
+        Отправка кадра через исходящую очередь. key - ключ склейки: такие
+        кадры можно заменить более новым или отбросить.
+        """
+        if self.outbound is None:
+            await self.send(text_data=frame)
+            return
+        if self.outbound.closed:
+            # Очередь закрыта после ошибки отправки или переполнения
+            outbound_stats.count('dropped')
+            return
+        if self.outbound.put(frame, key):
+            count_response_bytes(frame)
+            return
+        # Клиент не успевает получать сообщения: пусть переподключится с курсором
+        logger.warning(f"Outbound queue overflow for user {self.user.id}, closing connection")
+        await self.outbound.stop()
+        await self.close(code=outbound_settings()['CLOSE_CODE'])
+
+    async def deliver_message(self, message_id, room_id, frame):
+        """Кадр chat_message; с подтверждениями он хранится до ack от клиента"""
+        if self.unacked is not None and message_id is not None:
+            self.unacked.add(message_id, room_id, frame)
+        await self.push(frame)
+
+    async def acknowledge(self, data):
+        """Кадр ack: message_id или список message_ids полученных сообщений"""
+        if self.unacked is None:
+            return
+        message_ids = data.get('message_ids')
+        if message_ids is None:
+            message_ids = [data.get('message_id')]
         try:
-            room = ChatRoom.objects.get(id=self.room_id)
-            message_obj = Message.objects.create(
-                room=room,
-                user=self.user,
-                content=message_content
+            message_ids = [int(message_id) for message_id in message_ids]
+        except (TypeError, ValueError):
+            await self.send_error("Неверный ID сообщения")
+            return
+        self.unacked.ack(message_ids)
+
+    async def resume(self, room_ids):
+        """
+        Повторная отправка при переподключении, по ID сообщения:
+        - с ?acks=1 - сообщения комнат, не подтвержденные прошлыми соединениями;
+        - если в URL передан cursor (курсор /api/chat/sync/ или timestamp
+          последнего полученного сообщения) - пропущенные кадры chat_message
+          с replayed=true, затем кадр resumed с новым курсором.
+        """
+        retransmit = {}
+        if self.unacked is not None:
+            retransmit = await sync_to_async(get_unacked_store().take, thread_sensitive=False)(
+                self.user.id, set(room_ids)
             )
+            outbound_stats.count('retransmitted', len(retransmit))
+
+        cursor = self.query_param('cursor')
+        replayed = {}
+        if cursor:
+            try:
+                frames, has_more, next_cursor = await database_sync_to_async(replay_frames)(list(room_ids), cursor)
+            except InvalidCursor as e:
+                await self.send_error(str(e), code='invalid_cursor')
+                cursor = None
+            else:
+                replayed = {
+                    frame['message_id']: (frame['room_id'], encode_frame(frame))
+                    for frame in frames if frame['message_id'] not in retransmit
+                }
+
+        for message_id, (room_id, frame) in sorted({**retransmit, **replayed}.items()):
+            await self.deliver_message(message_id, room_id, frame)
+        if cursor:
+            # has_more: пропущено больше REPLAY_LIMIT сообщений, остальное - через /api/chat/sync/
+            await self.push(encode_frame({
+                'type': 'resumed',
+                'cursor': next_cursor,
+                'replayed': len(replayed),
+                'retransmitted': len(retransmit),
+                'has_more': has_more,
+            }))
+
+    async def check_rate_limits(self, *buckets):
+        """
+        Списывает по токену из корзин (scope, key). При превышении лимита
+        отправляет ошибку rate_limited и возвращает False.
+        """
+        limiter = get_rate_limiter()
+        if limiter is None:
+            return True
+        for scope, key in buckets:
+            if scope != 'CONNECTION' and limiter.is_shared:
+                allowed, retry_after = await sync_to_async(limiter.check, thread_sensitive=False)(scope, key)
+            else:
+                allowed, retry_after = limiter.check(scope, key)
+            if not allowed:
+                await self.send_error(
+                    "Слишком много запросов, попробуйте позже",
+                    code='rate_limited',
+                    scope=scope.lower(),
+                    retry_after=round(retry_after, 2),
+                )
+                return False
+        return True
+
+    @database_sync_to_async
+    def check_room_access(self, room_id):
+        """Проверка доступа к комнате"""
+        return is_member(self.user.id, room_id)
+
+    async def save_message(self, room_id, message_content):
+        """
+        Сохранение сообщения.
+
+        При отложенной записи (CHAT_WRITE_BEHIND) сообщение сразу получает
+        ID и время, а в базу попадает пачкой из фоновой задачи.
+        """
+        try:
+            if write_behind_enabled():
+                # В базу за ID ходим только за новым блоком
+                message_id = message_id_allocator.take()
+                if message_id is None:
+                    message_id = await database_sync_to_async(message_id_allocator.allocate)()
+                message_obj = Message(
+                    id=message_id,
+                    room_id=room_id,
+                    user=self.user,
+                    content=message_content,
+                    timestamp=timezone.now(),
+                )
+                await message_write_behind.enqueue(message_obj)
+                # bulk_create не вызывает post_save, поэтому буфер комнаты дополняем здесь
+                await sync_to_async(cache_message, thread_sensitive=False)(message_obj)
+            else:
+                message_obj = await database_sync_to_async(Message.objects.create)(
+                    room_id=room_id,
+                    user=self.user,
+                    content=message_content
+                )
             return {
                 'id': message_obj.id,
                 'content': message_obj.content,
-                'user_id': message_obj.user.id,
-                'username': message_obj.user.username,
+                'user_id': self.user.id,
+                'username': self.user.username,
                 'timestamp': message_obj.timestamp.isoformat(),
             }
         except Exception as e:
@@ -195,25 +520,136 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return None
 
     @database_sync_to_async
-    def mark_messages_as_read(self):
+    def mark_messages_as_read(self, room_id):
         """Отметка сообщений как прочитанных"""
         try:
-            room = ChatRoom.objects.get(id=self.room_id)
-            Message.objects.filter(
-                room=room,
-                is_read=False
-            ).exclude(
-                user=self.user
-            ).update(is_read=True)
+            ReadReceipt.mark_read(self.user, room_id)
         except Exception as e:
             logger.error(f"Error marking messages as read: {e}")
 
-    @database_sync_to_async
-    def set_user_online(self, is_online):
-        """Установка статуса пользователя"""
+    async def set_user_online(self, is_online):
+        """
+        Регистрация/снятие соединения в хранилище присутствия.
+        Возвращает True, если онлайн-статус пользователя изменился.
+        """
+        store = get_presence_store()
+        update = store.connect if is_online else store.disconnect
         try:
-            profile, created = UserProfile.objects.get_or_create(user=self.user)
-            profile.is_online = is_online
-            profile.save()
+            return await sync_to_async(update, thread_sensitive=False)(
+                self.user.id, self.channel_name
+            )
         except Exception as e:
-            logger.error(f"Error updating user status: {e}")
\ No newline at end of file
+            logger.error(f"Error updating user status: {e}")
+            return False
+
+
+class UserChatConsumer(ChatConsumer):
+    """
+    Одно соединение на пользователя: ws/chat/
+
+    При подключении подписывается на все комнаты пользователя одним запросом.
+    Набор комнат меняется кадрами subscribe/unsubscribe, а кадры комнат
+    (chat_message, typing, mark_read) должны содержать room_id.
+    """
+
+    async def connect(self):
+        self.user = self.scope['user']
+
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        self.rooms = set(await self.get_user_room_ids())
+        for room_id in self.rooms:
+            await self.channel_layer.group_add(room_group_name(room_id), self.channel_name)
+        await self.watch_contacts()
+
+        became_online = await self.set_user_online(True)
+
+        await self.accept()
+        self.start_outbound()
+        await self.send_subscriptions('subscribed', sorted(self.rooms))
+        await self.resume(self.rooms)
+
+        if became_online:
+            await self.broadcast_status(True)
+
+    async def disconnect(self, close_code):
+        release_rate_limits(self.channel_name)
+        if hasattr(self, 'rooms'):
+            await self.stop_outbound()
+            for room_id in self.rooms:
+                await self.channel_layer.group_discard(room_group_name(room_id), self.channel_name)
+            await self.unwatch_contacts()
+            await self.leave_presence(self.rooms)
+
+    async def handle_frame(self, data):
+        message_type = data.get('type', 'chat_message')
+
+        if message_type in ('heartbeat', 'ack'):
+            await self.dispatch_frame(None, message_type, data)
+            return
+
+        try:
+            room_id = int(data.get('room_id'))
+        except (TypeError, ValueError):
+            await self.send_error("Необходимо указать room_id")
+            return
+
+        if message_type == 'subscribe':
+            await self.subscribe(room_id)
+        elif message_type == 'unsubscribe':
+            await self.unsubscribe(room_id)
+        elif room_id not in self.rooms:
+            await self.send_error("Нет подписки на комнату")
+        else:
+            await self.dispatch_frame(room_id, message_type, data)
+
+    async def subscribe(self, room_id):
+        """Подписка на комнату (например, после join_room)"""
+        if room_id not in self.rooms:
+            if not await self.check_room_access(room_id):
+                await self.send_error("Нет доступа к комнате")
+                return
+            await self.channel_layer.group_add(room_group_name(room_id), self.channel_name)
+            self.rooms.add(room_id)
+            await self.watch_contacts()
+        await self.send_subscriptions('subscribed', [room_id])
+
+    async def unsubscribe(self, room_id):
+        """Отписка от комнаты"""
+        if room_id in self.rooms:
+            await self.channel_layer.group_discard(room_group_name(room_id), self.channel_name)
+            self.rooms.discard(room_id)
+            await self.watch_contacts()
+        await self.send_subscriptions('unsubscribed', [room_id])
+
+    async def presence_watch(self, event):
+        """
+        Состав одной из комнат изменился: снимаем подписки на комнаты, из
+        которых пользователь вышел, и пересчитываем подписки на статусы.
+        """
+        left = self.rooms - set(await self.get_user_room_ids())
+        for room_id in left:
+            await self.channel_layer.group_discard(room_group_name(room_id), self.channel_name)
+        if left:
+            self.rooms -= left
+            await self.send_subscriptions('unsubscribed', sorted(left))
+        await self.watch_contacts([event.get('room_id')])
+
+    def presence_rooms(self):
+        return self.rooms
+
+    def status_frame(self, event):
+        return event['frame']
+
+    async def send_subscriptions(self, frame_type, room_ids):
+        await self.push(encode_frame({
+            'type': frame_type,
+            'room_ids': list(room_ids),
+        }))
+
+    @database_sync_to_async
+    def get_user_room_ids(self):
+        """ID всех комнат пользователя (из кэша членства)"""
+        return list(user_room_ids(self.user.id))
@@ -0,0 +1,120 @@
+"""
+Потоковая выгрузка сообщений в JSONL или CSV.
+
+Сообщения читаются курсором базы (iterator с chunk_size) в виде словарей
+values() без создания моделей и сериализаторов, а каждая строка сразу
+отдается потребителю, поэтому память не зависит от размера комнаты.
+Под ASGI представление отдает асинхронный генератор aexport_lines.
+"""
+import csv
+import json
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.utils.dateparse import parse_datetime
+
+from .models import Message
+
+
+FORMATS = ('jsonl', 'csv')
+FIELDS = ('id', 'room', 'user', 'username', 'content', 'timestamp')
+DEFAULT_CHUNK_SIZE = 2000
+
+_VALUES = {
+    'id': 'id',
+    'room': 'room_id',
+    'user': 'user_id',
+    'username': 'user__username',
+    'content': 'content',
+    'timestamp': 'timestamp',
+}
+
+
+class ExportFilterError(ValueError):
+    """Неверный фильтр выгрузки"""
+
+
+def _parse_bound(value, name):
+    if not value:
+        return None
+    try:
+        bound = parse_datetime(value)
+    except ValueError:
+        # Формат верный, но такой даты нет (2024-02-30)
+        bound = None
+    if bound is None:
+        raise ExportFilterError(f'Неверное время в {name}')
+    return bound
+
+
+def export_queryset(room_id=None, user_id=None, since=None, until=None):
+    """Сообщения по фильтрам в порядке (timestamp, id); since/until - ISO 8601"""
+    queryset = Message.objects.all()
+    if room_id is not None:
+        queryset = queryset.filter(room_id=room_id)
+    if user_id is not None:
+        queryset = queryset.filter(user_id=user_id)
+    since = _parse_bound(since, 'since')
+    if since is not None:
+        queryset = queryset.filter(timestamp__gte=since)
+    until = _parse_bound(until, 'until')
+    if until is not None:
+        queryset = queryset.filter(timestamp__lt=until)
+    return queryset.order_by('timestamp', 'id').values_list(*_VALUES.values())
+
+
+class _Echo:
+    """Буфер для csv.writer, который просто возвращает записанную строку"""
+
+    def write(self, value):
+        return value
+
+
+def jsonl_line(row):
+    """Строка JSONL для строки export_queryset"""
+    record = dict(zip(FIELDS, row))
+    record['timestamp'] = record['timestamp'].isoformat()
+    return json.dumps(record, ensure_ascii=False) + '\n'
+
+
+def _formatter(file_format):
+    """(строки заголовка, функция строки) для формата выгрузки"""
+    if file_format not in FORMATS:
+        raise ExportFilterError('Неизвестный формат выгрузки')
+    if file_format == 'jsonl':
+        return [], jsonl_line
+
+    writer = csv.writer(_Echo())
+
+    def csv_line(row):
+        row = list(row)
+        row[-1] = row[-1].isoformat()
+        return writer.writerow(row)
+
+    return [writer.writerow(FIELDS)], csv_line
+
+
+def export_lines(queryset, file_format='jsonl', chunk_size=DEFAULT_CHUNK_SIZE):
+    """Генератор строк выгрузки (с переводом строки)"""
+    header, line = _formatter(file_format)
+    yield from header
+    for row in queryset.iterator(chunk_size=chunk_size):
+        yield line(row)
+
+
+async def aexport_lines(queryset, file_format='jsonl', chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Асинхронный генератор для StreamingHttpResponse под ASGI: каждая пачка
+    курсора читается через sync_to_async и отдается одной строкой, и сервер
+    не собирает всю выгрузку в память, как для синхронного генератора.
+    """
+    header, line = _formatter(file_format)
+    for value in header:
+        yield value
+    rows = queryset.iterator(chunk_size=chunk_size)
+    next_chunk = sync_to_async(lambda: list(islice(rows, chunk_size)))
+    while True:
+        chunk = await next_chunk()
+        if not chunk:
+            break
+        yield ''.join(line(row) for row in chunk)
@@ -0,0 +1,294 @@
+"""
+Кэш последних сообщений "горячих" комнат.
+
+Для каждой комнаты хранится кольцевой буфер из SIZE последних сообщений,
+уже сериализованных MessageSerializer (без is_read, который зависит от
+читателя). Буфер заполняется при первом открытии комнаты, дополняется при
+сохранении сообщения и сбрасывается при редактировании или удалении.
+
+Чтобы параллельное заполнение из базы не затерло только что добавленное
+сообщение, у комнаты есть номер поколения: append() его увеличивает, а
+store() записывает буфер, только если поколение не изменилось с момента
+чтения из базы.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+
+DEFAULTS = {
+    'ENABLED': True,
+    'BACKEND': 'memory',
+    'REDIS_URL': 'redis://127.0.0.1:6379/0',
+    'SIZE': 50,
+    'MAX_ROOMS': 1000,
+    'TTL': 3600,
+}
+
+
+def history_cache_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_HISTORY_CACHE', {})}
+
+
+def serialize_message(message):
+    """Данные сообщения для буфера (без is_read)"""
+    from .serializers import MessageSerializer
+
+    data = dict(MessageSerializer(message).data)
+    data.pop('is_read', None)
+    return data
+
+
+class BaseHistoryCache:
+    def __init__(self, size):
+        self.size = size
+
+    def generation(self, room_id):
+        """Текущее поколение комнаты; передается в store()"""
+        raise NotImplementedError
+
+    def get(self, room_id):
+        """(сообщения от старых к новым, есть ли более старые) или None при промахе"""
+        raise NotImplementedError
+
+    def store(self, room_id, messages, has_older, generation):
+        """Записывает буфер, прочитанный из базы (сообщения от старых к новым)"""
+        raise NotImplementedError
+
+    def append(self, room_id, message):
+        """Добавляет новое сообщение, если буфер комнаты уже заполнен"""
+        raise NotImplementedError
+
+    def invalidate(self, room_id):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class MemoryHistoryCache(BaseHistoryCache):
+    """
+    Буферы в памяти процесса, не больше max_rooms комнат (LRU). Сброс по
+    сигналам виден только этому процессу, поэтому буфер живет не дольше ttl
+    секунд с заполнения из базы.
+    """
+
+    def __init__(self, size, max_rooms, ttl):
+        super().__init__(size)
+        self.max_rooms = max_rooms
+        self.ttl = ttl
+        self._rooms = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def generation(self, room_id):
+        with self._lock:
+            return self._generations.get(room_id, 0)
+
+    def get(self, room_id):
+        with self._lock:
+            entry = self._rooms.get(room_id)
+            if entry is None:
+                return None
+            buffer, has_older, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._rooms[room_id]
+                return None
+            self._rooms.move_to_end(room_id)
+            return list(buffer), has_older
+
+    def store(self, room_id, messages, has_older, generation):
+        with self._lock:
+            if self._generations.get(room_id, 0) != generation:
+                return False
+            buffer = deque(messages, maxlen=self.size)
+            self._rooms[room_id] = [buffer, has_older or len(messages) > self.size, time.monotonic() + self.ttl]
+            self._rooms.move_to_end(room_id)
+            while len(self._rooms) > self.max_rooms:
+                evicted, _ = self._rooms.popitem(last=False)
+                self._generations.pop(evicted, None)
+            return True
+
+    def append(self, room_id, message):
+        with self._lock:
+            self._generations[room_id] = self._generations.get(room_id, 0) + 1
+            entry = self._rooms.get(room_id)
+            if entry is None:
+                return
+            buffer = entry[0]
+            if len(buffer) == buffer.maxlen:
+                entry[1] = True
+            buffer.append(message)
+
+    def invalidate(self, room_id):
+        with self._lock:
+            self._rooms.pop(room_id, None)
+            self._generations[room_id] = self._generations.get(room_id, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._rooms.clear()
+            self._generations.clear()
+
+
+class RedisHistoryCache(BaseHistoryCache):
+    """
+    Буферы в Redis, общие для всех воркеров.
+
+    chat:recent:<room_id>       - LIST сообщений в JSON (от старых к новым),
+    chat:recent:<room_id>:meta  - '1', если в базе есть более старые сообщения,
+    chat:recent:<room_id>:gen   - номер поколения.
+    """
+
+    def __init__(self, url, size, ttl):
+        super().__init__(size)
+        self.ttl = ttl
+        import redis
+
+        self.redis = redis.Redis.from_url(url, socket_timeout=1)
+
+    def _keys(self, room_id):
+        base = f'chat:recent:{room_id}'
+        return base, f'{base}:meta', f'{base}:gen'
+
+    def generation(self, room_id):
+        return int(self.redis.get(self._keys(room_id)[2]) or 0)
+
+    def get(self, room_id):
+        key, meta_key, _ = self._keys(room_id)
+        pipe = self.redis.pipeline()
+        pipe.get(meta_key)
+        pipe.lrange(key, 0, -1)
+        meta, items = pipe.execute()
+        if meta is None:
+            return None
+        return [json.loads(item) for item in items], meta == b'1'
+
+    def store(self, room_id, messages, has_older, generation):
+        import redis
+
+        key, meta_key, gen_key = self._keys(room_id)
+        has_older = has_older or len(messages) > self.size
+        messages = messages[-self.size:]
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(gen_key)
+                if int(pipe.get(gen_key) or 0) != generation:
+                    return False
+                pipe.multi()
+                pipe.delete(key)
+                if messages:
+                    pipe.rpush(key, *(json.dumps(message) for message in messages))
+                    pipe.expire(key, self.ttl)
+                pipe.set(meta_key, '1' if has_older else '0', ex=self.ttl)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def append(self, room_id, message):
+        key, meta_key, gen_key = self._keys(room_id)
+        pipe = self.redis.pipeline()
+        pipe.incr(gen_key)
+        pipe.expire(gen_key, self.ttl)
+        pipe.rpushx(key, json.dumps(message))
+        pipe.exists(meta_key)
+        _, _, length, warm = pipe.execute()
+        if not warm:
+            return
+        if not length:
+            # Буфер пустой комнаты не существует как LIST: проще заполнить заново
+            self.redis.delete(meta_key)
+        elif length > self.size:
+            pipe = self.redis.pipeline()
+            pipe.ltrim(key, -self.size, -1)
+            pipe.set(meta_key, '1', ex=self.ttl)
+            pipe.execute()
+
+    def invalidate(self, room_id):
+        key, meta_key, gen_key = self._keys(room_id)
+        pipe = self.redis.pipeline()
+        pipe.delete(key, meta_key)
+        pipe.incr(gen_key)
+        pipe.expire(gen_key, self.ttl)
+        pipe.execute()
+
+    def clear(self):
+        keys = list(self.redis.scan_iter('chat:recent:*'))
+        if keys:
+            self.redis.delete(*keys)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_history_cache():
+    """Кэш процесса по настройке CHAT_HISTORY_CACHE; None, если выключен"""
+    global _cache
+    config = history_cache_settings()
+    if not config['ENABLED']:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                if config['BACKEND'] == 'redis':
+                    _cache = RedisHistoryCache(config['REDIS_URL'], config['SIZE'], config['TTL'])
+                else:
+                    _cache = MemoryHistoryCache(config['SIZE'], config['MAX_ROOMS'], config['TTL'])
+    return _cache
+
+
+def reset_history_cache():
+    """Сбрасывает кэш (для тестов и после смены настроек)"""
+    global _cache
+    with _cache_lock:
+        _cache = None
+
+
+def cache_message(message):
+    """Добавляет только что сохраненное сообщение в буфер его комнаты"""
+    cache = get_history_cache()
+    if cache is not None:
+        cache.append(message.room_id, serialize_message(message))
+
+
+def invalidate_room(room_id):
+    cache = get_history_cache()
+    if cache is not None:
+        cache.invalidate(room_id)
+
+
+def recent_page(room_id, queryset, limit):
+    """
+    Первая страница истории (самые новые сообщения) из буфера комнаты.
+
+    При промахе буфер заполняется из базы одним запросом на SIZE + 1 строк.
+    Возвращает (сообщения от новых к старым, has_more) или None, если
+    кэш выключен или limit больше размера буфера.
+    """
+    from .pagination import keyset_page
+    from .persistence import message_write_behind
+
+    cache = get_history_cache()
+    if cache is None or limit > cache.size:
+        return None
+
+    cached = cache.get(room_id)
+    if cached is None:
+        generation = cache.generation(room_id)
+        messages, has_older, _ = keyset_page(
+            queryset,
+            limit=cache.size,
+            pending=message_write_behind.pending_for_room(room_id),
+        )
+        buffer = [serialize_message(message) for message in reversed(messages)]
+        cache.store(room_id, buffer, has_older, generation)
+        cached = buffer, has_older
+
+    buffer, has_older = cached
+    page = buffer[::-1][:limit]
+    return page, has_older or len(buffer) > limit
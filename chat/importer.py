@@ -0,0 +1,214 @@
+"""
+Массовый импорт сообщений из JSONL.
+
+Каждая строка - объект {"room": <id>, "user": <id> или "username": <имя>,
+"content": <текст>, "timestamp": <ISO 8601, необязательно>}. Строки читаются
+потоком и пишутся пачками по batch_size: на пачку один запрос пользователей
+по username, один запрос участников комнат и один bulk_create, поэтому
+память не зависит от размера файла.
+"""
+import json
+import time
+from datetime import timezone as dt_timezone
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .history_cache import invalidate_room
+from .models import ChatRoom, Message, ReadReceipt
+from .persistence import committed_id_cap, message_id_allocator, write_behind_enabled
+
+
+DEFAULT_BATCH_SIZE = 1000
+MAX_ERRORS = 20
+
+
+class ImportLineError(ValueError):
+    """Строку нельзя импортировать"""
+
+
+def decode_line(line):
+    try:
+        return line.decode('utf-8')
+    except UnicodeDecodeError:
+        raise ImportLineError('Строка не в кодировке UTF-8')
+
+
+def parse_line(line):
+    """Разбор строки JSONL; возвращает словарь с room_id, user_id/username, content, timestamp"""
+    try:
+        data = json.loads(line)
+    except json.JSONDecodeError:
+        raise ImportLineError('Неверный JSON')
+    if not isinstance(data, dict):
+        raise ImportLineError('Ожидается JSON-объект')
+
+    try:
+        room_id = int(data['room'])
+    except (KeyError, TypeError, ValueError):
+        raise ImportLineError('Не указана комната')
+
+    content = data.get('content')
+    if not isinstance(content, str) or not content.strip():
+        raise ImportLineError('Пустое сообщение')
+
+    timestamp = data.get('timestamp')
+    if timestamp:
+        try:
+            timestamp = parse_datetime(str(timestamp))
+        except ValueError:
+            # Формат верный, но такой даты нет
+            timestamp = None
+        if timestamp is None:
+            raise ImportLineError('Неверное время')
+        if timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp, dt_timezone.utc)
+    else:
+        timestamp = timezone.now()
+
+    item = {'room_id': room_id, 'content': content, 'timestamp': timestamp}
+    if data.get('user') is not None:
+        try:
+            item['user_id'] = int(data['user'])
+        except (TypeError, ValueError):
+            raise ImportLineError('Неверный пользователь')
+    elif data.get('username'):
+        item['username'] = str(data['username'])
+    else:
+        raise ImportLineError('Не указан пользователь')
+    return item
+
+
+class MessageImporter:
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, progress=None):
+        self.batch_size = batch_size
+        self.progress = progress
+        self.imported = 0
+        self.skipped = 0
+        self.errors = []
+        self.rooms = set()
+        self.started = None
+
+    def run(self, lines):
+        """Импортирует строки (str или bytes) и возвращает отчет"""
+        self.started = time.monotonic()
+        batch = []
+        for number, line in enumerate(lines, start=1):
+            try:
+                if isinstance(line, bytes):
+                    line = decode_line(line)
+                if not line.strip():
+                    continue
+                batch.append((number, parse_line(line)))
+            except ImportLineError as e:
+                self.skip(number, str(e))
+            if len(batch) >= self.batch_size:
+                self.write_batch(batch)
+                batch = []
+        if batch:
+            self.write_batch(batch)
+
+        # bulk_create не вызывает post_save: буферы истории комнат устарели
+        for room_id in self.rooms:
+            invalidate_room(room_id)
+        return self.report()
+
+    def skip(self, number, reason):
+        self.skipped += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append({'line': number, 'error': reason})
+
+    def write_batch(self, batch):
+        usernames = {item['username'] for _, item in batch if 'username' in item}
+        user_ids = dict(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+        for _, item in batch:
+            if 'username' in item:
+                item['user_id'] = user_ids.get(item.pop('username'))
+
+        # Членство проверяется одним запросом на пачку
+        members = set(ChatRoom.participants.through.objects.filter(
+            chatroom_id__in={item['room_id'] for _, item in batch},
+            user_id__in={item['user_id'] for _, item in batch if item['user_id']},
+        ).values_list('chatroom_id', 'user_id'))
+
+        messages = []
+        for number, item in batch:
+            if item['user_id'] is None:
+                self.skip(number, 'Пользователь не найден')
+            elif (item['room_id'], item['user_id']) not in members:
+                self.skip(number, 'Пользователь не участник комнаты')
+            else:
+                messages.append(Message(
+                    room_id=item['room_id'],
+                    user_id=item['user_id'],
+                    content=item['content'],
+                    timestamp=item['timestamp'],
+                ))
+        if not messages:
+            return
+
+        with transaction.atomic():
+            if write_behind_enabled():
+                # ID из общего счетчика, чтобы не пересечься с очередью отложенной записи
+                for message_id, message in zip(message_id_allocator.reserve(len(messages)), messages):
+                    message.id = message_id
+            latest = dict(Message.objects.filter(
+                room_id__in={message.room_id for message in messages}
+            ).order_by().values('room_id').annotate(latest=Max('id')).values_list('room_id', 'latest'))
+            Message.objects.bulk_create(messages)
+            self.mark_read(latest, messages)
+        self.imported += len(messages)
+        self.rooms.update(message.room_id for message in messages)
+        if self.progress:
+            self.progress(self.report())
+
+    def mark_read(self, latest, messages):
+        """
+        Импортированная история получает ID новее всех водяных знаков и иначе
+        считалась бы непрочитанной. Участникам, которые прочитали комнату до
+        конца (знак не ниже latest - последнего ID до импорта), знак
+        сдвигается за импортированные сообщения; у остальных сдвиг отметил бы
+        прочитанными и их настоящие непрочитанные сообщения.
+        """
+        imported = {}
+        for message in messages:
+            imported[message.room_id] = max(imported.get(message.room_id, 0), message.id)
+        cap = committed_id_cap()
+        if cap is not None:
+            # Как и в ReadReceipt.mark_read: выше cap могут появиться сообщения воркеров
+            imported = {room_id: min(last, cap) for room_id, last in imported.items()}
+        watermarks = {
+            (room_id, user_id): last_read for room_id, user_id, last_read in ReadReceipt.objects.filter(
+                room_id__in=imported
+            ).values_list('room_id', 'user_id', 'last_read_message_id')
+        }
+        created = []
+        caught_up = {}
+        for room_id, user_id in ChatRoom.participants.through.objects.filter(
+            chatroom_id__in=imported
+        ).values_list('chatroom_id', 'user_id'):
+            watermark = watermarks.get((room_id, user_id))
+            if (watermark or 0) < (latest.get(room_id) or 0):
+                continue
+            if watermark is None:
+                created.append(ReadReceipt(user_id=user_id, room_id=room_id, last_read_message_id=imported[room_id]))
+            else:
+                caught_up.setdefault(room_id, []).append(user_id)
+        for room_id, user_ids in caught_up.items():
+            ReadReceipt.objects.filter(
+                room_id=room_id, user_id__in=user_ids, last_read_message_id__lt=imported[room_id]
+            ).update(last_read_message_id=imported[room_id], updated_at=timezone.now())
+        ReadReceipt.objects.bulk_create(created, ignore_conflicts=True)
+
+    def report(self):
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        return {
+            'imported': self.imported,
+            'skipped': self.skipped,
+            'errors': self.errors,
+            'elapsed': round(elapsed, 3),
+            'messages_per_second': round(self.imported / elapsed) if elapsed else 0,
+        }
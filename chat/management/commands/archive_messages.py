@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.archive import archive_room, room_cutoffs
+from chat.models import ChatRoom, Message
+
+
+class Command(BaseCommand):
+    help = (
+        'Переносит сообщения старше срока хранения (ChatRoom.retention_days или '
+        'CHAT_RETENTION["DAYS"]) в сжатые сегменты архива пачками по --batch-size'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', type=int, help='ID комнаты')
+        parser.add_argument('--days', type=int, help='Срок хранения в днях для всех выбранных комнат')
+        parser.add_argument('--batch-size', type=int, help='Сообщений в сегменте')
+        parser.add_argument('--dry-run', action='store_true', help='Только посчитать сообщения')
+
+    def handle(self, *args, **options):
+        if options['room'] is not None and not ChatRoom.objects.filter(id=options['room']).exists():
+            raise CommandError(f"Комната {options['room']} не найдена")
+        if options['days'] is not None and options['days'] < 0:
+            raise CommandError('Срок хранения не может быть отрицательным')
+        if options['batch_size'] is not None and options['batch_size'] < 1:
+            raise CommandError('Размер пачки должен быть больше нуля')
+
+        total = 0
+        for room_id, cutoff in room_cutoffs(options['room'], options['days']):
+            if options['dry_run']:
+                count = Message.objects.filter(room_id=room_id, timestamp__lt=cutoff).count()
+            else:
+                count = archive_room(room_id, cutoff, options['batch_size'])
+            if count:
+                self.stdout.write(f'Комната {room_id}: {count} сообщений старше {cutoff.isoformat()}')
+            total += count
+        verb = 'К архивации' if options['dry_run'] else 'Архивировано'
+        self.stdout.write(f'{verb} сообщений: {total}')
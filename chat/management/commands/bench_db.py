@@ -0,0 +1,133 @@
+import os
+import tempfile
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, connections
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from chat.models import ChatRoom, Message
+from minichat.databases import sqlite_database
+
+from .bench_fanout import percentile
+
+
+class Command(BaseCommand):
+    help = (
+        'Конкурентная запись сообщений в базу: --writers потоков пишут по '
+        '--writes сообщений через ORM, пока --readers потоков читают историю. '
+        'Для SQLite сравниваются режим по умолчанию и настроенный (WAL); для '
+        'PostgreSQL - текущий профиль DATABASES. Работает на временной базе.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=8)
+        parser.add_argument('--writes', type=int, default=200, help='Сообщений на поток-писатель')
+        parser.add_argument('--readers', type=int, default=4)
+
+    def handle(self, *args, **options):
+        sqlite = connection.vendor == 'sqlite'
+        if sqlite:
+            # Тестовая SQLite по умолчанию в памяти; блокировки файла проверяются только на диске
+            directory = tempfile.mkdtemp()
+            connection.settings_dict['TEST']['NAME'] = os.path.join(directory, 'bench.sqlite3')
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            users = User.objects.bulk_create(
+                User(username=f'dbbench{i}') for i in range(options['writers'])
+            )
+            room = ChatRoom.objects.create(name='Бенчмарк', chat_type='group')
+            room.participants.add(*users)
+
+            if sqlite:
+                name = connection.settings_dict['NAME']
+                profiles = [
+                    ('sqlite (по умолчанию)', sqlite_database(name, tuned=False)),
+                    ('sqlite (WAL)', sqlite_database(name, tuned=True)),
+                ]
+            else:
+                profiles = [(connection.vendor, None)]
+
+            for label, database in profiles:
+                if database is not None:
+                    connection.settings_dict['OPTIONS'] = database.get('OPTIONS', {})
+                connections.close_all()
+                if database is not None and 'OPTIONS' not in database:
+                    # WAL сохраняется в файле: возвращаем журнал по умолчанию
+                    with connection.cursor() as cursor:
+                        cursor.execute('PRAGMA journal_mode=DELETE')
+                self.report(label, self.run(room, users, options))
+        finally:
+            connections.close_all()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def run(self, room, users, options):
+        latencies = []
+        errors = [0]
+        reads = [0]
+        lock = threading.Lock()
+        writing = threading.Event()
+        writing.set()
+
+        def write(user):
+            try:
+                for i in range(options['writes']):
+                    started = time.perf_counter()
+                    try:
+                        Message.objects.create(room=room, user=user, content=f'Запись {i}')
+                    except OperationalError:
+                        with lock:
+                            errors[0] += 1
+                        continue
+                    with lock:
+                        latencies.append(time.perf_counter() - started)
+            finally:
+                connection.close()
+
+        def read():
+            try:
+                while writing.is_set():
+                    try:
+                        list(Message.objects.filter(room=room).order_by('-id')[:50])
+                    except OperationalError:
+                        with lock:
+                            errors[0] += 1
+                        continue
+                    with lock:
+                        reads[0] += 1
+            finally:
+                connection.close()
+
+        readers = [threading.Thread(target=read) for _ in range(options['readers'])]
+        writers = [threading.Thread(target=write, args=(user,)) for user in users]
+        started = time.perf_counter()
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        writing.clear()
+        for thread in readers:
+            thread.join()
+
+        return {
+            'writes': len(latencies),
+            'errors': errors[0],
+            'writes_per_second': round(len(latencies) / elapsed, 1),
+            'reads_per_second': round(reads[0] / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        }
+
+    def report(self, label, result):
+        self.stdout.write(
+            f"{label}: {result['writes']} записей ({result['writes_per_second']}/с), "
+            f"чтений {result['reads_per_second']}/с, ошибок {result['errors']}, "
+            f"задержка записи p50={result['p50_ms']} p95={result['p95_ms']} p99={result['p99_ms']} мс"
+        )
@@ -0,0 +1,63 @@
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from chat.codec import CODECS, get_codec
+
+
+class Command(BaseCommand):
+    help = (
+        'Микробенчмарк кодирования кадра chat_message при рассылке: '
+        'кодирование для каждого получателя против одного готового кадра на group_send.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, default=5000, help='Получателей в комнате')
+        parser.add_argument('--messages', type=int, default=20, help='Сообщений в комнату')
+        parser.add_argument('--codec', action='append', choices=sorted(CODECS), help='По умолчанию все доступные')
+
+    def handle(self, *args, **options):
+        recipients, messages = options['recipients'], options['messages']
+        frame = {
+            'type': 'chat_message',
+            'room_id': 1,
+            'message_id': 123456,
+            'message': 'Привет! Это обычное сообщение средней длины для проверки кодека.',
+            'user_id': 42,
+            'username': 'benchmark_user',
+            'timestamp': timezone.now().isoformat(),
+        }
+
+        self.stdout.write(f'Получателей: {recipients}, сообщений: {messages}')
+        for name in options['codec'] or sorted(CODECS):
+            try:
+                dumps = get_codec(name)
+            except ImproperlyConfigured as e:
+                if options['codec']:
+                    raise CommandError(str(e))
+                self.stdout.write(f'{name}: пропущен ({e})')
+                continue
+
+            # Как раньше: каждый consumer кодирует событие сам
+            started = time.perf_counter()
+            for _ in range(messages):
+                for _ in range(recipients):
+                    dumps(frame)
+            per_recipient = time.perf_counter() - started
+
+            # Кадр кодируется один раз; отправка в сокет все равно переводит строку в UTF-8
+            started = time.perf_counter()
+            for _ in range(messages):
+                encoded = dumps(frame)
+                for _ in range(recipients):
+                    encoded.encode()
+            once = time.perf_counter() - started
+
+            fanouts = messages * recipients
+            self.stdout.write(
+                f'{name}: на получателя {per_recipient / fanouts * 1e6:.2f} мкс/доставку '
+                f'({per_recipient * 1000:.1f} мс), один кадр {once / fanouts * 1e6:.2f} мкс/доставку '
+                f'({once * 1000:.1f} мс), ускорение x{per_recipient / once:.1f}'
+            )
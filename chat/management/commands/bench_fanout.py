@@ -0,0 +1,153 @@
+import asyncio
+import multiprocessing
+import statistics
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from chat.codec import group_event
+from minichat.channel_layers import build_channel_layers
+
+
+GROUP_NAME = 'bench_fanout'
+
+
+def percentile(values, pct):
+    """Перцентиль по отсортированному списку (ближайший ранг)"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+def _receiver(layer_config, members, expected, timeout, ready, results):
+    """Процесс-получатель: держит members каналов в группе и считает доставки"""
+    async def run():
+        layer = import_string(layer_config['BACKEND'])(**layer_config['CONFIG'])
+        channels = [await layer.new_channel() for _ in range(members)]
+        for channel in channels:
+            await layer.group_add(GROUP_NAME, channel)
+        ready.set()
+
+        latencies = []
+
+        async def consume(channel):
+            for _ in range(expected):
+                event = await layer.receive(channel)
+                latencies.append(time.time() - event['sent_at'])
+
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(consume(channel) for channel in channels)),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            pass
+        for channel in channels:
+            await layer.group_discard(GROUP_NAME, channel)
+        return latencies
+
+    results.put(asyncio.run(run()))
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочный тест рассылки chat_message через channel layer между '
+        'несколькими процессами. С --fake-redis поднимает локальный '
+        'redis-совместимый сервер (нужен пакет fakeredis[lua]).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=4, help='Процессов-получателей')
+        parser.add_argument('--members', type=int, default=25, help='Соединений в каждом процессе')
+        parser.add_argument('--messages', type=int, default=200, help='Сообщений в группу')
+        parser.add_argument('--backend', default=None, help='redis или redis-pubsub')
+        parser.add_argument('--fake-redis', action='store_true', help='Запустить fakeredis на --port')
+        parser.add_argument('--port', type=int, default=6390)
+        parser.add_argument('--timeout', type=float, default=60.0)
+
+    def handle(self, *args, **options):
+        backend = options['backend'] or settings.CHANNEL_LAYER_BACKEND
+        if backend == 'memory':
+            raise CommandError(
+                'InMemoryChannelLayer не работает между процессами: '
+                'укажите --backend redis или redis-pubsub'
+            )
+
+        hosts = settings.CHANNEL_REDIS_HOSTS
+        if options['fake_redis']:
+            hosts = [self.start_fake_redis(options['port'])]
+
+        layer_config = build_channel_layers(
+            backend, hosts, capacity=max(1000, options['messages'])
+        )['default']
+
+        processes, members, messages = options['processes'], options['members'], options['messages']
+        ctx = multiprocessing.get_context('spawn')
+        results = ctx.Queue()
+        ready_events = []
+        workers = []
+        for _ in range(processes):
+            ready = ctx.Event()
+            worker = ctx.Process(
+                target=_receiver,
+                args=(layer_config, members, messages, options['timeout'], ready, results),
+            )
+            worker.start()
+            ready_events.append(ready)
+            workers.append(worker)
+
+        for ready in ready_events:
+            if not ready.wait(options['timeout']):
+                raise CommandError('Процессы-получатели не подключились к channel layer')
+
+        started = time.time()
+        asyncio.run(self.send_messages(layer_config, messages))
+
+        latencies = []
+        for _ in workers:
+            latencies.extend(results.get(timeout=options['timeout'] + 10))
+        elapsed = time.time() - started
+        for worker in workers:
+            worker.join()
+
+        expected = processes * members * messages
+        self.stdout.write(f'Бэкенд: {backend} ({", ".join(hosts)})')
+        self.stdout.write(f'Получателей: {processes} x {members}, сообщений: {messages}')
+        self.stdout.write(f'Доставлено: {len(latencies)} из {expected} за {elapsed:.2f} c')
+        self.stdout.write(f'Доставок в секунду: {len(latencies) / elapsed:.0f}')
+        if latencies:
+            self.stdout.write(
+                'Задержка, мс: p50={:.1f} p95={:.1f} p99={:.1f} mean={:.1f}'.format(
+                    percentile(latencies, 50) * 1000,
+                    percentile(latencies, 95) * 1000,
+                    percentile(latencies, 99) * 1000,
+                    statistics.mean(latencies) * 1000,
+                )
+            )
+
+    async def send_messages(self, layer_config, messages):
+        layer = import_string(layer_config['BACKEND'])(**layer_config['CONFIG'])
+        for i in range(messages):
+            await layer.group_send(GROUP_NAME, group_event('chat_message', {
+                'type': 'chat_message',
+                'message_id': i,
+                'message': 'benchmark',
+                'user_id': 0,
+                'username': 'bench',
+                'timestamp': '',
+            }, user_id=0, sent_at=time.time()))
+
+    def start_fake_redis(self, port):
+        try:
+            from fakeredis import TcpFakeServer
+        except ImportError:
+            raise CommandError('Для --fake-redis установите пакет fakeredis[lua]')
+
+        server = TcpFakeServer(('127.0.0.1', port), server_type='redis')
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return f'redis://127.0.0.1:{port}/0'
@@ -0,0 +1,394 @@
+import asyncio
+import json
+import random
+import statistics
+import threading
+import time
+from collections import defaultdict
+
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test import AsyncClient, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat.models import ChatRoom, UserProfile
+from chat.outbound import outbound_stats
+from minichat.channel_layers import build_channel_layers
+
+from .bench_fanout import Command as FanoutCommand, percentile
+
+
+DELIVERY_TIMEOUT = 60.0
+# Версия формата отчета: меняется вместе с разделами и параметрами, чтобы
+# отчеты разных версий харнесса не сравнивались между собой.
+# 2 - раздел presence и параметр reconnects.
+REPORT_SCHEMA = 2
+
+
+class QueryCounter:
+    """Считает SQL-запросы всех соединений (в том числе из потоков sync_to_async)"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(int)
+
+    def add(self, name, seconds):
+        self.latencies[name].append(seconds)
+
+    def summary(self):
+        result = {}
+        for name, values in self.latencies.items():
+            result[name] = {
+                'count': len(values),
+                'p50_ms': round(percentile(values, 50) * 1000, 2),
+                'p95_ms': round(percentile(values, 95) * 1000, 2),
+                'p99_ms': round(percentile(values, 99) * 1000, 2),
+                'mean_ms': round(statistics.mean(values) * 1000, 2),
+                'queries_per_op': round(self.queries[name] / len(values), 2),
+            }
+        return result
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочный тест REST и WebSocket в одном процессе: N пользователей в '
+        'M комнатах подключаются к ws/chat/, печатают и отправляют сообщения, '
+        'затем запрашивают список комнат и историю. Работает на временной '
+        'тестовой базе; отчет - перцентили задержек, сообщения в секунду и '
+        'число SQL-запросов на операцию.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--rooms', type=int, default=10)
+        parser.add_argument('--messages', type=int, default=5, help='Сообщений от каждого пользователя')
+        parser.add_argument('--rest-requests', type=int, default=200, help='Запросов каждого REST-вида')
+        parser.add_argument('--concurrency', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--backend', default='memory', help='memory, redis или redis-pubsub')
+        parser.add_argument('--fake-redis', action='store_true', help='Запустить fakeredis на --port')
+        parser.add_argument('--port', type=int, default=6391)
+        parser.add_argument('--rate-limits', action='store_true', help='Не отключать CHAT_RATE_LIMITS')
+        parser.add_argument('--reconnects', type=int, default=20, help='Пользователей, которые переподключаются')
+        parser.add_argument('--presence-grace', type=float, default=0.5, help='CHAT_PRESENCE["GRACE"], секунды')
+        parser.add_argument('--json', dest='json_path', help='Записать отчет в JSON-файл')
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        hosts = settings.CHANNEL_REDIS_HOSTS
+        if options['fake_redis']:
+            hosts = [FanoutCommand().start_fake_redis(options['port'])]
+
+        overrides = {'CHANNEL_LAYERS': build_channel_layers(options['backend'], hosts, capacity=10000)}
+        if not options['rate_limits']:
+            overrides['CHAT_RATE_LIMITS'] = {'ENABLED': False}
+        overrides['CHAT_PRESENCE'] = {**getattr(settings, 'CHAT_PRESENCE', {}), 'GRACE': options['presence_grace']}
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(**overrides):
+                report = self.run(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        report['schema'] = REPORT_SCHEMA
+        report['config'] = {
+            key: options[key] for key in (
+                'users', 'rooms', 'messages', 'rest_requests', 'concurrency', 'backend', 'reconnects',
+            )
+        }
+        report['config']['database'] = connection.vendor
+        self.print_report(report)
+        if options['json_path']:
+            with open(options['json_path'], 'w', encoding='utf-8') as output:
+                json.dump(report, output, ensure_ascii=False, indent=2)
+                output.write('\n')
+
+    def run(self, options):
+        users, rooms = self.seed(options['users'], options['rooms'])
+        counter = QueryCounter()
+        connection_created.connect(counter.install)
+        counter.install(None, connection)
+        try:
+            from minichat.asgi import application
+
+            stats = Stats()
+            ws, presence = asyncio.run(self.websocket_phase(application, users, rooms, options, stats, counter))
+            asyncio.run(self.rest_phase(users, rooms, options, stats, counter))
+        finally:
+            connection_created.disconnect(counter.install)
+        return {'websocket': ws, 'presence': presence, 'operations': stats.summary()}
+
+    def seed(self, user_count, room_count):
+        """Пользователи и комнаты: каждый пользователь состоит в двух комнатах"""
+        password = make_password(None)
+        User.objects.bulk_create(
+            User(username=f'bench{i}', password=password) for i in range(user_count)
+        )
+        users = list(User.objects.filter(username__startswith='bench').order_by('id'))
+        UserProfile.objects.bulk_create(UserProfile(user=user) for user in users)
+        rooms = ChatRoom.objects.bulk_create(
+            ChatRoom(name=f'Комната {i}', chat_type='group') for i in range(room_count)
+        )
+        Participants = ChatRoom.participants.through
+        memberships = set()
+        for index, user in enumerate(users):
+            memberships.add((rooms[index % room_count].id, user.id))
+            memberships.add((rooms[(index + 1) % room_count].id, user.id))
+        Participants.objects.bulk_create(
+            Participants(chatroom_id=room_id, user_id=user_id) for room_id, user_id in memberships
+        )
+        members = defaultdict(list)
+        for room_id, user_id in memberships:
+            members[user_id].append(room_id)
+        for user in users:
+            user.bench_token = str(AccessToken.for_user(user))
+            user.bench_rooms = sorted(members[user.id])
+        return users, rooms
+
+    async def timed(self, stats, name, coroutine):
+        started = time.perf_counter()
+        result = await coroutine
+        stats.add(name, time.perf_counter() - started)
+        return result
+
+    async def phase(self, stats, counter, name, coroutines):
+        """
+        Выполняет однотипные операции параллельно. Запросы к БД считаются на
+        всю фазу: при параллельном выполнении их нельзя отнести к одной операции.
+        """
+        queries = counter.count
+        result = await asyncio.gather(*coroutines)
+        stats.queries[name] += counter.count - queries
+        return result
+
+    async def websocket_phase(self, application, users, rooms, options, stats, counter):
+        semaphore = asyncio.Semaphore(options['concurrency'])
+        deliveries = []
+
+        async def connect(user):
+            communicator = WebsocketCommunicator(application, f'/ws/chat/?token={user.bench_token}')
+
+            async def handshake():
+                connected, _ = await communicator.connect(timeout=30)
+                assert connected, 'WebSocket не подключился'
+                while (await communicator.receive_json_from(timeout=30))['type'] != 'subscribed':
+                    pass
+
+            async with semaphore:
+                await self.timed(stats, 'ws_connect', handshake())
+            return communicator
+
+        communicators = await self.phase(stats, counter, 'ws_connect', [connect(user) for user in users])
+
+        sent_to_room = defaultdict(int)
+        received = [0] * len(users)
+
+        async def read(index, user, communicator):
+            # Без таймаута: по таймауту WebsocketCommunicator отменяет само приложение
+            while True:
+                frame = await communicator.receive_json_from(timeout=3600)
+                if frame['type'] != 'chat_message':
+                    continue
+                latency = time.time() - float(frame['message'].split()[-1])
+                deliveries.append(latency)
+                received[index] += 1
+                if frame['user_id'] == user.id:
+                    # Путь собственного сообщения: receive -> сохранение -> group_send -> обратно
+                    stats.add('ws_message_echo', latency)
+
+        readers = [
+            asyncio.create_task(read(index, user, communicator))
+            for index, (user, communicator) in enumerate(zip(users, communicators))
+        ]
+
+        async def chat(user, communicator):
+            for _ in range(options['messages']):
+                room_id = random.choice(user.bench_rooms)
+                sent_to_room[room_id] += 1
+                async with semaphore:
+                    await communicator.send_json_to({'type': 'typing', 'room_id': room_id, 'is_typing': True})
+                    await communicator.send_json_to({
+                        'type': 'chat_message', 'room_id': room_id, 'message': f'bench {time.time()}',
+                    })
+                    await communicator.send_json_to({'type': 'typing', 'room_id': room_id, 'is_typing': False})
+                    # Отдаем управление, чтобы клиенты чередовались, а не слали пачками
+                    await asyncio.sleep(0)
+
+        queries = counter.count
+        started = time.perf_counter()
+        await asyncio.gather(*(chat(user, communicator) for user, communicator in zip(users, communicators)))
+
+        targets = [sum(sent_to_room[room_id] for room_id in user.bench_rooms) for user in users]
+        deadline = time.perf_counter() + DELIVERY_TIMEOUT
+        while any(got < target for got, target in zip(received, targets)) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - started
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+        ws_queries = counter.count - queries
+        stats.queries['ws_message_echo'] = ws_queries
+        messages_sent = len(users) * options['messages']
+
+        presence = await self.presence_phase(users, communicators, connect, options)
+
+        await self.phase(stats, counter, 'ws_disconnect', [
+            self.timed(stats, 'ws_disconnect', communicator.disconnect()) for communicator in communicators
+        ])
+
+        return {
+            'messages_sent': messages_sent,
+            'messages_per_second': round(messages_sent / elapsed, 1),
+            'deliveries': len(deliveries),
+            'deliveries_expected': sum(targets),
+            'deliveries_per_second': round(len(deliveries) / elapsed, 1),
+            'delivery_p50_ms': round(percentile(deliveries, 50) * 1000, 2),
+            'delivery_p95_ms': round(percentile(deliveries, 95) * 1000, 2),
+            'delivery_p99_ms': round(percentile(deliveries, 99) * 1000, 2),
+            'queries_per_message': round(ws_queries / messages_sent, 2),
+        }, presence
+
+    async def presence_phase(self, users, communicators, connect, options):
+        """
+        Доставки кадров user_status на смену статуса. Выбранные пользователи
+        сначала переподключаются сразу (обрыв в пределах GRACE - доставок быть
+        не должно), затем уходят дольше чем на GRACE и возвращаются (две смены
+        статуса). Кадры считаются у остальных пользователей; для сравнения
+        приводится число доставок при рассылке в каждую общую комнату.
+        """
+        picked = set(random.sample(range(len(users)), min(options['reconnects'], len(users))))
+        listeners = [index for index in range(len(users)) if index not in picked]
+        received = defaultdict(int)
+
+        async def read(index):
+            while True:
+                frame = await communicators[index].receive_json_from(timeout=3600)
+                if frame['type'] == 'user_status':
+                    received[index] += 1
+
+        readers = [asyncio.create_task(read(index)) for index in listeners]
+
+        async def reconnect(index, pause):
+            await communicators[index].disconnect(timeout=30)
+            await asyncio.sleep(pause)
+            communicators[index] = await connect(users[index])
+
+        grace = options['presence_grace']
+        await asyncio.gather(*(reconnect(index, 0) for index in picked))
+        await asyncio.sleep(grace * 2)
+        flap_deliveries = sum(received.values())
+
+        members = defaultdict(set)
+        for user in users:
+            for room_id in user.bench_rooms:
+                members[room_id].add(user.id)
+        listener_ids = {users[index].id for index in listeners}
+        expected = 0
+        room_fanout = 0
+        for index in picked:
+            user = users[index]
+            contacts = set().union(*(members[room_id] for room_id in user.bench_rooms)) - {user.id}
+            expected += 2 * len(contacts & listener_ids)
+            room_fanout += 2 * sum(len(members[room_id]) - 1 for room_id in user.bench_rooms)
+
+        received.clear()
+        coalesced = outbound_stats.stats()['coalesced']
+        await asyncio.gather(*(reconnect(index, grace * 3) for index in picked))
+        deadline = time.perf_counter() + DELIVERY_TIMEOUT
+        # Уход и возвращение, которые застали кадр в исходящей очереди, склеиваются в один кадр
+        while (sum(received.values()) + outbound_stats.stats()['coalesced'] - coalesced < expected
+               and time.perf_counter() < deadline):
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+        deliveries = sum(received.values())
+        coalesced = outbound_stats.stats()['coalesced'] - coalesced
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+
+        changes = 2 * len(picked)
+        return {
+            'status_changes': changes,
+            'deliveries': deliveries,
+            'deliveries_expected': expected,
+            'coalesced': coalesced,
+            'deliveries_per_change': round(deliveries / changes, 2) if changes else 0,
+            'room_fanout_per_change': round(room_fanout / changes, 2) if changes else 0,
+            'flap_deliveries': flap_deliveries,
+        }
+
+    async def rest_phase(self, users, rooms, options, stats, counter):
+        semaphore = asyncio.Semaphore(options['concurrency'])
+        client = AsyncClient()
+
+        async def request(name, user, path):
+            async with semaphore:
+                response = await self.timed(stats, name, client.get(
+                    path, headers={'authorization': f'Bearer {user.bench_token}'}
+                ))
+            assert response.status_code == 200, f'{path}: {response.status_code}'
+
+        picked = [random.choice(users) for _ in range(options['rest_requests'])]
+        await self.phase(stats, counter, 'rest_room_list', [
+            request('rest_room_list', user, '/api/chat/rooms/') for user in picked
+        ])
+        await self.phase(stats, counter, 'rest_history', [
+            request('rest_history', user, f'/api/chat/rooms/{random.choice(user.bench_rooms)}/history/')
+            for user in picked
+        ])
+
+    def print_report(self, report):
+        config = report['config']
+        self.stdout.write(
+            f"Пользователей: {config['users']}, комнат: {config['rooms']}, "
+            f"сообщений на пользователя: {config['messages']}, "
+            f"channel layer: {config['backend']}, БД: {config['database']}"
+        )
+        ws = report['websocket']
+        self.stdout.write(
+            f"WebSocket: {ws['messages_sent']} сообщений ({ws['messages_per_second']}/с), "
+            f"доставлено {ws['deliveries']} из {ws['deliveries_expected']} "
+            f"({ws['deliveries_per_second']}/с), SQL на сообщение: {ws['queries_per_message']}"
+        )
+        self.stdout.write(
+            f"Задержка доставки, мс: p50={ws['delivery_p50_ms']} "
+            f"p95={ws['delivery_p95_ms']} p99={ws['delivery_p99_ms']}"
+        )
+        presence = report['presence']
+        self.stdout.write(
+            f"Присутствие: {presence['status_changes']} смен статуса, доставлено "
+            f"{presence['deliveries']} из {presence['deliveries_expected']} (склеено {presence['coalesced']}) "
+            f"({presence['deliveries_per_change']} на смену, рассылка по комнатам - "
+            f"{presence['room_fanout_per_change']}), при переподключении в пределах GRACE: "
+            f"{presence['flap_deliveries']}"
+        )
+        self.stdout.write(f"{'Операция':<16} {'N':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'SQL/оп':>7}")
+        for name, row in report['operations'].items():
+            self.stdout.write(
+                f"{name:<16} {row['count']:>6} {row['p50_ms']:>8} {row['p95_ms']:>8} "
+                f"{row['p99_ms']:>8} {row['queries_per_op']:>7}"
+            )
@@ -0,0 +1,43 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.exporter import DEFAULT_CHUNK_SIZE, FORMATS, ExportFilterError, export_lines, export_queryset
+
+
+class Command(BaseCommand):
+    help = 'Потоковая выгрузка сообщений в JSONL или CSV (в файл или stdout)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=FORMATS, default='jsonl')
+        parser.add_argument('--output', default='-', help='Путь к файлу или "-" для stdout')
+        parser.add_argument('--room', type=int, help='ID комнаты')
+        parser.add_argument('--user', help='ID или username автора')
+        parser.add_argument('--since', help='Не раньше (ISO 8601)')
+        parser.add_argument('--until', help='Раньше (ISO 8601)')
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        user_id = options['user']
+        if user_id and not user_id.isdigit():
+            user_id = User.objects.filter(username=user_id).values_list('id', flat=True).first()
+            if user_id is None:
+                raise CommandError(f"Пользователь {options['user']} не найден")
+        try:
+            queryset = export_queryset(
+                options['room'], int(user_id) if user_id else None, options['since'], options['until']
+            )
+        except ExportFilterError as e:
+            raise CommandError(str(e))
+
+        lines = export_lines(queryset, options['format'], options['chunk_size'])
+        if options['output'] == '-':
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+
+        count = -1 if options['format'] == 'csv' else 0  # строка заголовка CSV
+        with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+            for line in lines:
+                output.write(line)
+                count += 1
+        self.stderr.write(f"Выгружено сообщений: {count} в {options['output']}")
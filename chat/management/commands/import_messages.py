@@ -0,0 +1,44 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.importer import DEFAULT_BATCH_SIZE, MessageImporter
+
+
+class Command(BaseCommand):
+    help = (
+        'Импорт сообщений из JSONL-файла (или stdin при "-"). Строка: '
+        '{"room": 1, "user": 2 | "username": "bob", "content": "...", "timestamp": "..."}'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Путь к JSONL-файлу или "-" для stdin')
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size должен быть положительным')
+
+        def progress(report):
+            self.stdout.write(
+                f"Импортировано {report['imported']}, пропущено {report['skipped']} "
+                f"({report['messages_per_second']} сообщений/с)"
+            )
+
+        importer = MessageImporter(batch_size=options['batch_size'], progress=progress)
+        # Строки читаются байтами: строка не в UTF-8 пропускается, а не прерывает импорт
+        if options['path'] == '-':
+            report = importer.run(getattr(sys.stdin, 'buffer', sys.stdin))
+        else:
+            try:
+                with open(options['path'], 'rb') as lines:
+                    report = importer.run(lines)
+            except OSError as e:
+                raise CommandError(str(e))
+
+        for error in report['errors']:
+            self.stderr.write(f"Строка {error['line']}: {error['error']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Готово: импортировано {report['imported']}, пропущено {report['skipped']} "
+            f"за {report['elapsed']:.2f} c ({report['messages_per_second']} сообщений/с)"
+        ))
@@ -0,0 +1,210 @@
+"""
+Кэш членства в комнатах.
+
+Хранит для пользователя множество ID его комнат, а для комнаты - множество
+ID участников, чтобы проверки доступа в consumer и REST-представлениях не
+ходили в промежуточную таблицу participants на каждый запрос. Множество
+загружается из базы одним запросом при промахе.
+
+Записи сбрасываются сигналами m2m_changed (add/remove/clear с любой стороны
+связи) и удалением комнаты; сброс повторяется после коммита транзакции.
+Как и в кэше истории, у ключа есть номер поколения, и загрузка из базы не
+перезапишет более новый сброс. TTL ограничивает рассинхронизацию, если
+членство изменено в обход ORM (bulk_create промежуточной таблицы).
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+DEFAULTS = {
+    'ENABLED': True,
+    'BACKEND': 'memory',
+    'REDIS_URL': 'redis://127.0.0.1:6379/0',
+    'MAX_ENTRIES': 100000,
+    'TTL': 300,
+}
+
+
+def membership_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_MEMBERSHIP_CACHE', {})}
+
+
+class MemoryMembershipCache:
+    """Множества в памяти процесса, не больше max_entries ключей (LRU)"""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def generation(self, key):
+        with self._lock:
+            return self._generations.get(key, 0)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            ids, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return ids
+
+    def store(self, key, ids, generation):
+        with self._lock:
+            if self._generations.get(key, 0) != generation:
+                return False
+            self._entries[key] = (ids, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                self._generations.pop(evicted, None)
+            return True
+
+    def invalidate(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+                self._generations[key] = self._generations.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+
+
+class RedisMembershipCache:
+    """
+    Множества в Redis, общие для всех воркеров:
+    chat:members:<key> - JSON-список ID, chat:members:<key>:gen - поколение.
+    """
+
+    def __init__(self, url, ttl):
+        import redis
+
+        self.ttl = ttl
+        self.redis = redis.Redis.from_url(url, socket_timeout=1)
+
+    def _keys(self, key):
+        base = 'chat:members:{}:{}'.format(*key)
+        return base, f'{base}:gen'
+
+    def generation(self, key):
+        return int(self.redis.get(self._keys(key)[1]) or 0)
+
+    def get(self, key):
+        value = self.redis.get(self._keys(key)[0])
+        if value is None:
+            return None
+        return frozenset(json.loads(value))
+
+    def store(self, key, ids, generation):
+        import redis
+
+        value_key, gen_key = self._keys(key)
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(gen_key)
+                if int(pipe.get(gen_key) or 0) != generation:
+                    return False
+                pipe.multi()
+                pipe.set(value_key, json.dumps(sorted(ids)), ex=self.ttl)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def invalidate(self, keys):
+        pipe = self.redis.pipeline()
+        for key in keys:
+            value_key, gen_key = self._keys(key)
+            pipe.delete(value_key)
+            pipe.incr(gen_key)
+            pipe.expire(gen_key, self.ttl)
+        pipe.execute()
+
+    def clear(self):
+        keys = list(self.redis.scan_iter('chat:members:*'))
+        if keys:
+            self.redis.delete(*keys)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_membership_cache():
+    """Кэш процесса по настройке CHAT_MEMBERSHIP_CACHE; None, если выключен"""
+    global _cache
+    config = membership_settings()
+    if not config['ENABLED']:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                if config['BACKEND'] == 'redis':
+                    _cache = RedisMembershipCache(config['REDIS_URL'], config['TTL'])
+                else:
+                    _cache = MemoryMembershipCache(config['MAX_ENTRIES'], config['TTL'])
+    return _cache
+
+
+def reset_membership_cache():
+    """Сбрасывает кэш (для тестов и после смены настроек)"""
+    global _cache
+    with _cache_lock:
+        _cache = None
+
+
+def _load(key):
+    from .models import ChatRoom
+
+    Participants = ChatRoom.participants.through.objects
+    kind, pk = key
+    if kind == 'user':
+        rows = Participants.filter(user_id=pk).values_list('chatroom_id', flat=True)
+    else:
+        rows = Participants.filter(chatroom_id=pk).values_list('user_id', flat=True)
+    return frozenset(rows)
+
+
+def _cached(key):
+    cache = get_membership_cache()
+    if cache is None:
+        return _load(key)
+    ids = cache.get(key)
+    if ids is None:
+        generation = cache.generation(key)
+        ids = _load(key)
+        cache.store(key, ids, generation)
+    return ids
+
+
+def user_room_ids(user_id):
+    """ID комнат пользователя (frozenset)"""
+    return _cached(('user', user_id))
+
+
+def room_member_ids(room_id):
+    """ID участников комнаты (frozenset)"""
+    return _cached(('room', room_id))
+
+
+def is_member(user_id, room_id):
+    """Состоит ли пользователь в комнате; несуществующая комната - False"""
+    return int(room_id) in user_room_ids(user_id)
+
+
+def invalidate_membership(user_ids=(), room_ids=()):
+    cache = get_membership_cache()
+    if cache is not None:
+        cache.invalidate([('user', pk) for pk in user_ids] + [('room', pk) for pk in room_ids])
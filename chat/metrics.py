@@ -0,0 +1,425 @@
+"""
+Метрики HTTP-запросов и событий WebSocket.
+
+Для каждого endpoint (имя URL) и каждого события consumer собираются
+гистограммы длительности и числа SQL-запросов, суммарное время в базе,
+размеры запросов и ответов и число ошибок. GET /metrics отдает их в
+текстовом формате Prometheus.
+
+SQL-запросы считает обертка execute, которая ставится на каждое соединение
+с базой и пишет в текущий замер из ContextVar. sync_to_async копирует
+контекст в поток, поэтому запросы из database_sync_to_async попадают в
+замер события consumer.
+
+Метрики хранятся в памяти процесса: каждый воркер Daphne отдает свои.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from channels.exceptions import StopConsumer
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.utils.crypto import constant_time_compare
+from rest_framework.authentication import BaseAuthentication
+from rest_framework.permissions import BasePermission
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULTS = {
+    'ENABLED': True,
+    # Границы гистограммы длительности, секунды
+    'DURATION_BUCKETS': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+    'QUERY_BUCKETS': (0, 1, 2, 5, 10, 20, 50, 100),
+    # Запросы дольше SLOW_MS пишутся в лог вместе с SQL (не больше MAX_SQL строк)
+    'SLOW_MS': 500,
+    'LOG_SQL': True,
+    'MAX_SQL': 20,
+    # Если задан, /metrics требует заголовок Authorization: Bearer <TOKEN>
+    'TOKEN': '',
+}
+
+
+def metrics_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_METRICS', {})}
+
+
+class Sample:
+    """Замер одного HTTP-запроса или события WebSocket"""
+
+    def __init__(self, kind, labels, keep_sql, request_bytes=0):
+        self.kind = kind
+        self.labels = labels
+        self.keep_sql = keep_sql
+        self.request_bytes = request_bytes
+        self.response_bytes = 0
+        self.status = None
+        self.error = False
+        self.queries = 0
+        self.query_time = 0.0
+        self.sql = []
+        self.duration = 0.0
+
+
+_current = ContextVar('chat_metrics_sample', default=None)
+
+
+def record_queries(execute, sql, params, many, context):
+    sample = _current.get()
+    if sample is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        sample.queries += 1
+        sample.query_time += elapsed
+        if sample.keep_sql:
+            sample.sql.append((elapsed, sql))
+
+
+@receiver(connection_created)
+def install_query_recorder(sender, connection, **kwargs):
+    if record_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_queries)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{_labels(labels, le=bound)} {cumulative}'
+        yield f'{name}_bucket{_labels(labels, le="+Inf")} {self.count}'
+        yield f'{name}_sum{_labels(labels)} {round(self.sum, 6)}'
+        yield f'{name}_count{_labels(labels)} {self.count}'
+
+
+class Series:
+    """Накопленные метрики одного endpoint или события"""
+
+    def __init__(self, config):
+        self.duration = Histogram(config['DURATION_BUCKETS'])
+        self.queries = Histogram(config['QUERY_BUCKETS'])
+        self.query_time = 0.0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.errors = 0
+        self.statuses = {}
+
+
+class MetricsRegistry:
+    # (суффикс имени, тип, описание)
+    FAMILIES = (
+        ('duration_seconds', 'histogram', 'Длительность обработки'),
+        ('db_queries', 'histogram', 'SQL-запросов на обработку'),
+        ('db_seconds_total', 'counter', 'Время в базе данных'),
+        ('request_bytes_total', 'counter', 'Байт получено'),
+        ('response_bytes_total', 'counter', 'Байт отправлено'),
+        ('errors_total', 'counter', 'Необработанные исключения и ответы 5xx'),
+    )
+
+    def __init__(self, config):
+        self.config = config
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, sample):
+        key = (sample.kind, tuple(sample.labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = Series(self.config)
+            series.duration.observe(sample.duration)
+            series.queries.observe(sample.queries)
+            series.query_time += sample.query_time
+            series.request_bytes += sample.request_bytes
+            series.response_bytes += sample.response_bytes
+            if sample.error:
+                series.errors += 1
+            if sample.status is not None:
+                series.statuses[sample.status] = series.statuses.get(sample.status, 0) + 1
+
+    def render(self):
+        """Текст в формате Prometheus exposition 0.0.4"""
+        with self._lock:
+            series = sorted(self._series.items())
+            lines = []
+            for kind in sorted({kind for kind, _ in self._series}):
+                rows = [(dict(labels), data) for (row_kind, labels), data in series if row_kind == kind]
+                for suffix, metric_type, help_text in self.FAMILIES:
+                    name = f'chat_{kind}_{suffix}'
+                    lines.append(f'# HELP {name} {help_text}')
+                    lines.append(f'# TYPE {name} {metric_type}')
+                    for labels, data in rows:
+                        if suffix == 'duration_seconds':
+                            lines.extend(data.duration.lines(name, labels))
+                        elif suffix == 'db_queries':
+                            lines.extend(data.queries.lines(name, labels))
+                        else:
+                            value = {
+                                'db_seconds_total': round(data.query_time, 6),
+                                'request_bytes_total': data.request_bytes,
+                                'response_bytes_total': data.response_bytes,
+                                'errors_total': data.errors,
+                            }[suffix]
+                            lines.append(f'{name}{_labels(labels)} {value}')
+                statuses = [(labels, data.statuses) for labels, data in rows if data.statuses]
+                if statuses:
+                    name = f'chat_{kind}_responses_total'
+                    lines.append(f'# HELP {name} Ответы по коду статуса')
+                    lines.append(f'# TYPE {name} counter')
+                    for labels, counts in statuses:
+                        for status, count in sorted(counts.items()):
+                            lines.append(f'{name}{_labels(labels, status=status)} {count}')
+        lines.extend(subsystem_lines())
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+def _labels(labels, **extra):
+    items = {**labels, **extra}
+    if not items:
+        return ''
+    body = ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', r'\\').replace('"', r'\"'))
+        for key, value in items.items()
+    )
+    return '{' + body + '}'
+
+
+def _size(data):
+    if not data:
+        return 0
+    return len(data.encode()) if isinstance(data, str) else len(data)
+
+
+def subsystem_lines():
+    """Счетчики подсистем чата, которые ведутся отдельно"""
+    from .outbound import outbound_stats
+    from .persistence import message_write_behind
+    from .presence import presence_broadcaster
+    from .typing import typing_tracker
+
+    typing = typing_tracker.stats()
+    lines = [
+        '# HELP chat_typing_frames_total Кадры typing от клиентов',
+        '# TYPE chat_typing_frames_total counter',
+    ]
+    for result in ('forwarded', 'suppressed', 'expired'):
+        lines.append(f'chat_typing_frames_total{_labels({"result": result})} {typing[result]}')
+    lines += [
+        '# HELP chat_typing_active Пользователи, которые сейчас печатают',
+        '# TYPE chat_typing_active gauge',
+        f'chat_typing_active {typing["active"]}',
+        '# HELP chat_write_behind_pending Сообщения, ожидающие записи в базу',
+        '# TYPE chat_write_behind_pending gauge',
+        f'chat_write_behind_pending {message_write_behind.pending_count()}',
+        '# HELP chat_write_behind_failed_total Сообщения, отброшенные из-за ошибки записи',
+        '# TYPE chat_write_behind_failed_total counter',
+        f'chat_write_behind_failed_total {message_write_behind.failed}',
+    ]
+    outbound = outbound_stats.stats()
+    lines += [
+        '# HELP chat_ws_outbound_queue_depth Кадры в исходящих очередях соединений',
+        '# TYPE chat_ws_outbound_queue_depth gauge',
+        f'chat_ws_outbound_queue_depth {outbound["depth"]}',
+        '# HELP chat_ws_outbound_queue_max_depth Самая длинная исходящая очередь',
+        '# TYPE chat_ws_outbound_queue_max_depth gauge',
+        f'chat_ws_outbound_queue_max_depth {outbound["max_depth"]}',
+        '# HELP chat_ws_outbound_frames_total Кадры исходящих очередей',
+        '# TYPE chat_ws_outbound_frames_total counter',
+    ]
+    for result in ('sent', 'coalesced', 'dropped'):
+        lines.append(f'chat_ws_outbound_frames_total{_labels({"result": result})} {outbound[result]}')
+    lines += [
+        '# HELP chat_ws_outbound_overflows_total Соединения, закрытые из-за переполнения очереди',
+        '# TYPE chat_ws_outbound_overflows_total counter',
+        f'chat_ws_outbound_overflows_total {outbound["overflows"]}',
+        '# HELP chat_ws_outbound_send_errors_total Соединения, на которых не удалась отправка из очереди',
+        '# TYPE chat_ws_outbound_send_errors_total counter',
+        f'chat_ws_outbound_send_errors_total {outbound["send_errors"]}',
+        '# HELP chat_ws_unacked_total Подтверждения доставки сообщений',
+        '# TYPE chat_ws_unacked_total counter',
+    ]
+    for result in ('acked', 'retransmitted', 'evicted'):
+        lines.append(f'chat_ws_unacked_total{_labels({"result": result})} {outbound[result]}')
+    presence = presence_broadcaster.stats()
+    lines += [
+        '# HELP chat_presence_status_total Смены статуса присутствия',
+        '# TYPE chat_presence_status_total counter',
+    ]
+    for result in ('published', 'suppressed'):
+        lines.append(f'chat_presence_status_total{_labels({"result": result})} {presence[result]}')
+    lines += [
+        '# HELP chat_presence_offline_pending Уходы, ожидающие окончания GRACE',
+        '# TYPE chat_presence_offline_pending gauge',
+        f'chat_presence_offline_pending {presence["pending"]}',
+    ]
+    return lines
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """Реестр процесса по настройке CHAT_METRICS; None, если выключен"""
+    global _registry
+    config = metrics_settings()
+    if not config['ENABLED']:
+        return None
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = MetricsRegistry(config)
+    return _registry
+
+
+def reset_registry():
+    """Сбрасывает реестр (для тестов и после смены настроек)"""
+    global _registry
+    with _registry_lock:
+        _registry = None
+
+
+@contextmanager
+def track(kind, labels, request_bytes=0):
+    """
+    Замер блока кода. Вызывающий может дополнить sample: поменять labels,
+    указать status и response_bytes. Без реестра отдает None.
+    """
+    registry = get_registry()
+    if registry is None:
+        yield None
+        return
+    sample = Sample(kind, labels, registry.config['LOG_SQL'], request_bytes)
+    token = _current.set(sample)
+    started = time.perf_counter()
+    try:
+        yield sample
+    except StopConsumer:
+        raise
+    except Exception:
+        sample.error = True
+        raise
+    finally:
+        sample.duration = time.perf_counter() - started
+        _current.reset(token)
+        if sample.status is not None and sample.status >= 500:
+            sample.error = True
+        registry.observe(sample)
+        if sample.duration * 1000 >= registry.config['SLOW_MS']:
+            log_slow(sample, registry.config['MAX_SQL'])
+
+
+def current_sample():
+    return _current.get()
+
+
+def log_slow(sample, max_sql):
+    labels = ' '.join(f'{key}={value}' for key, value in sample.labels.items())
+    lines = [
+        f"Slow {sample.kind} {labels}: {sample.duration * 1000:.1f} ms, "
+        f"{sample.queries} SQL queries ({sample.query_time * 1000:.1f} ms)"
+    ]
+    for elapsed, sql in sorted(sample.sql, key=lambda row: -row[0])[:max_sql]:
+        lines.append(f'  {elapsed * 1000:.1f} ms: {sql}')
+    logger.warning('\n'.join(lines))
+
+
+class MetricsMiddleware:
+    """
+    Метрики HTTP-запросов по имени URL (например, chat-history). У потоковых
+    ответов (экспорт) замеряется время до начала отдачи, размер не считается.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            request_bytes = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            request_bytes = 0
+        # Соединение этого потока могло открыться до импорта модуля
+        install_query_recorder(None, connection)
+        with track('http', {'endpoint': 'unmatched', 'method': request.method}, request_bytes) as sample:
+            response = self.get_response(request)
+            if sample is not None:
+                match = request.resolver_match
+                if match is not None:
+                    sample.labels['endpoint'] = match.view_name or match.route
+                sample.status = response.status_code
+                if not response.streaming:
+                    sample.response_bytes = len(response.content)
+        return response
+
+
+def count_response_bytes(data):
+    """Учитывает отправленные байты в текущем замере (кадр, поставленный в очередь, - сразу)"""
+    sample = current_sample()
+    if sample is not None:
+        sample.response_bytes += _size(data)
+
+
+class MetricsConsumerMixin:
+    """
+    Метрики событий consumer: каждое сообщение, которое обрабатывает
+    dispatch (websocket.connect, websocket.receive, события групп),
+    замеряется отдельно. Входящий кадр клиента consumer переименовывает
+    в frame:<type>; отправленные клиенту байты учитываются в текущем событии.
+    """
+
+    async def dispatch(self, message):
+        with track('ws', {'event': message['type']}, _size(message.get('text') or message.get('bytes'))):
+            await super().dispatch(message)
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        count_response_bytes(text_data or bytes_data)
+        await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+
+
+class MetricsTokenAuthentication(BaseAuthentication):
+    """Доступ сборщика метрик по CHAT_METRICS['TOKEN'] без учетной записи"""
+
+    def authenticate(self, request):
+        token = metrics_settings()['TOKEN']
+        header = request.headers.get('Authorization', '')
+        if token and constant_time_compare(header, f'Bearer {token}'):
+            return AnonymousUser(), 'metrics'
+        return None
+
+    def authenticate_header(self, request):
+        return 'Bearer'
+
+
+class CanReadMetrics(BasePermission):
+    def has_permission(self, request, view):
+        if request.auth == 'metrics':
+            return True
+        return bool(request.user and request.user.is_staff)
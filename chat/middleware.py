@@ -1,21 +1,102 @@
 from channels.auth import AuthMiddlewareStack
 from channels.db import database_sync_to_async
+from collections import OrderedDict
+from django.apps import apps
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings
 from urllib.parse import parse_qs
 import logging
+import threading
+import time
 
 User = get_user_model()
 logger = logging.getLogger(__name__)
 
 
+class TokenUserCache:
+    """
+    Ограниченный LRU-кэш пользователей по jti токена.
+
+    Запись живет не дольше TTL и не дольше срока действия самого токена,
+    поэтому повторное подключение с тем же токеном проверяет только подпись,
+    без похода в базу данных.
+    """
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, jti):
+        with self._lock:
+            entry = self._entries.get(jti)
+            if entry is None:
+                return None
+            user, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[jti]
+                return None
+            self._entries.move_to_end(jti)
+            return user
+
+    def set(self, jti, user, token_exp):
+        expires_at = min(time.time() + self.ttl, token_exp)
+        with self._lock:
+            self._entries[jti] = (user, expires_at)
+            self._entries.move_to_end(jti)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def evict_token(self, jti):
+        with self._lock:
+            self._entries.pop(jti, None)
+
+    def evict_user(self, user_id):
+        with self._lock:
+            for jti in [jti for jti, (user, _) in self._entries.items() if user.pk == user_id]:
+                del self._entries[jti]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_cache_settings = getattr(settings, 'CHAT_WS_AUTH_CACHE', {})
+token_user_cache = TokenUserCache(
+    max_size=_cache_settings.get('MAX_SIZE', 10000),
+    ttl=_cache_settings.get('TTL', 300),
+)
+
+BLACKLIST_INSTALLED = apps.is_installed('rest_framework_simplejwt.token_blacklist')
+
+
+@receiver([post_save, post_delete], sender=User)
+def evict_cached_user(sender, instance, **kwargs):
+    """Смена пароля, деактивация или удаление пользователя сбрасывают его записи"""
+    token_user_cache.evict_user(instance.pk)
+
+
+if BLACKLIST_INSTALLED:
+    from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+
+    @receiver(post_save, sender=BlacklistedToken)
+    def evict_blacklisted_token(sender, instance, **kwargs):
+        token_user_cache.evict_token(instance.token.jti)
+
+
 class JWTAuthMiddleware:
     """JWT authentication middleware for WebSocket connections"""
-    
+
     def __init__(self, inner):
         self.inner = inner
+        self.jwt_auth = JWTAuthentication()
 
     async def __call__(self, scope, receive, send):
         # Получаем токен из query parameters
@@ -24,6 +105,7 @@ class JWTAuthMiddleware:
         token = query_params.get('token', [None])[0]
 
         if token:
+            scope = dict(scope)
             try:
                 # Аутентификация через JWT
                 user = await self.get_user_from_token(token)
@@ -31,19 +113,37 @@ class JWTAuthMiddleware:
             except Exception as e:
                 logger.error(f"JWT authentication failed: {e}")
                 scope['user'] = AnonymousUser()
-        else:
+        elif 'user' not in scope:
             scope['user'] = AnonymousUser()
 
         return await self.inner(scope, receive, send)
 
-    @database_sync_to_async
-    def get_user_from_token(self, token):
+    async def get_user_from_token(self, token):
         """Получить пользователя из JWT токена"""
         try:
-            jwt_auth = JWTAuthentication()
-            validated_token = jwt_auth.get_validated_token(token)
-            user = jwt_auth.get_user(validated_token)
-            return user
+            # Подпись и срок действия проверяются без обращения к базе
+            validated_token = self.jwt_auth.get_validated_token(token)
+        except (InvalidToken, TokenError) as e:
+            logger.error(f"Invalid token: {e}")
+            return AnonymousUser()
+
+        jti = validated_token.get(api_settings.JTI_CLAIM)
+        user = token_user_cache.get(jti) if jti else None
+        if user is None:
+            user = await self.load_user(validated_token)
+            if jti and user.is_authenticated:
+                token_user_cache.set(jti, user, validated_token['exp'])
+        return user
+
+    @database_sync_to_async
+    def load_user(self, validated_token):
+        """Загрузка пользователя из базы (только при промахе кэша)"""
+        try:
+            if BLACKLIST_INSTALLED and BlacklistedToken.objects.filter(
+                token__jti=validated_token.get(api_settings.JTI_CLAIM)
+            ).exists():
+                raise InvalidToken('Token is blacklisted')
+            return self.jwt_auth.get_user(validated_token)
         except (InvalidToken, TokenError) as e:
             logger.error(f"Invalid token: {e}")
             return AnonymousUser()
@@ -53,5 +153,8 @@ class JWTAuthMiddleware:
 
 
 def JWTAuthMiddlewareStack(inner):
-    """Stack with JWT authentication middleware"""
-    return JWTAuthMiddleware(AuthMiddlewareStack(inner))
\ No newline at end of file
+    """
+    Stack with JWT authentication middleware.
+    Сессионная аутентификация остается запасной для клиентов без токена.
+    """
+    return AuthMiddlewareStack(JWTAuthMiddleware(inner))
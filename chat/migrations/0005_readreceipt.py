@@ -0,0 +1,52 @@
+# Generated by Django 5.2.7 on 2026-10-18 05:47
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def seed_read_receipts(apps, schema_editor):
+    """Переносит глобальный флаг is_read в водяные знаки участников"""
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    Message = apps.get_model('chat', 'Message')
+    ReadReceipt = apps.get_model('chat', 'ReadReceipt')
+
+    receipts = []
+    for room in ChatRoom.objects.prefetch_related('participants'):
+        for user in room.participants.all():
+            last_read = Message.objects.filter(
+                room=room, is_read=True
+            ).exclude(user=user).aggregate(last=Max('id'))['last']
+            if last_read:
+                receipts.append(ReadReceipt(user=user, room=room, last_read_message_id=last_read))
+    ReadReceipt.objects.bulk_create(receipts, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_message_room_timestamp_id_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadReceipt',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_receipts', to='chat.chatroom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_receipts', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'room'), name='chat_readreceipt_user_room_uniq')],
+            },
+        ),
+        migrations.RunPython(seed_read_receipts, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+    ]
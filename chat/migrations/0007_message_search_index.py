@@ -0,0 +1,78 @@
+"""
+Полнотекстовый индекс сообщений.
+
+SQLite: FTS5-таблица с внешним содержимым (chat_message) и триггерами.
+Если последующая миграция пересоздает таблицу chat_message, триггеры
+нужно создать заново.
+"""
+from django.db import migrations
+
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE chat_message_fts USING fts5(
+        content,
+        content='chat_message',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER chat_message_fts_insert AFTER INSERT ON chat_message BEGIN
+        INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER chat_message_fts_delete AFTER DELETE ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER chat_message_fts_update AFTER UPDATE OF content ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    "INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARD = [
+    'DROP TRIGGER IF EXISTS chat_message_fts_update',
+    'DROP TRIGGER IF EXISTS chat_message_fts_delete',
+    'DROP TRIGGER IF EXISTS chat_message_fts_insert',
+    'DROP TABLE IF EXISTS chat_message_fts',
+]
+
+# CONCURRENTLY не блокирует запись в большую таблицу (поэтому atomic = False)
+POSTGRES_FORWARD = [
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS chat_message_content_tsv_idx "
+    "ON chat_message USING GIN (to_tsvector('simple', content))",
+]
+
+POSTGRES_BACKWARD = [
+    'DROP INDEX CONCURRENTLY IF EXISTS chat_message_content_tsv_idx',
+]
+
+
+def run(statements):
+    def apply(apps, schema_editor):
+        vendor_statements = statements.get(schema_editor.connection.vendor, [])
+        for statement in vendor_statements:
+            schema_editor.execute(statement)
+    return apply
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('chat', '0006_write_behind'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRES_FORWARD}),
+            run({'sqlite': SQLITE_BACKWARD, 'postgresql': POSTGRES_BACKWARD}),
+        ),
+    ]
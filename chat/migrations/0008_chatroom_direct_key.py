@@ -0,0 +1,59 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:17
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+
+def merge_direct_rooms(apps, schema_editor):
+    """
+    Проставляет direct_key прямым чатам из двух участников. Дубликаты одной
+    пары сливаются в самый старый чат: сообщения переносятся, водяные знаки
+    прочтения объединяются по максимуму, лишние комнаты удаляются.
+    """
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    Message = apps.get_model('chat', 'Message')
+    ReadReceipt = apps.get_model('chat', 'ReadReceipt')
+    Participants = ChatRoom.participants.through
+
+    participants = defaultdict(list)
+    rows = Participants.objects.filter(chatroom__chat_type='direct').values_list('chatroom_id', 'user_id')
+    for room_id, user_id in rows.iterator():
+        participants[room_id].append(user_id)
+
+    pairs = defaultdict(list)
+    for room_id, user_ids in participants.items():
+        if len(user_ids) == 2:
+            low, high = sorted(user_ids)
+            pairs[f'{low}:{high}'].append(room_id)
+
+    for key, room_ids in pairs.items():
+        keeper, *duplicates = sorted(room_ids)
+        if duplicates:
+            Message.objects.filter(room_id__in=duplicates).update(room_id=keeper)
+            for receipt in ReadReceipt.objects.filter(room_id__in=duplicates):
+                kept, created = ReadReceipt.objects.get_or_create(
+                    user_id=receipt.user_id, room_id=keeper,
+                    defaults={'last_read_message_id': receipt.last_read_message_id},
+                )
+                if not created and kept.last_read_message_id < receipt.last_read_message_id:
+                    kept.last_read_message_id = receipt.last_read_message_id
+                    kept.save(update_fields=['last_read_message_id'])
+            ChatRoom.objects.filter(id__in=duplicates).delete()
+        ChatRoom.objects.filter(id=keeper).update(direct_key=key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_message_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='direct_key',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(merge_direct_rooms, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.7 on 2026-10-18 08:04
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_message_id_block'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='readreceipt',
+            index=models.Index(fields=['room', 'last_read_message_id'], name='chat_receipt_room_last_idx'),
+        ),
+    ]
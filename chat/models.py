@@ -1,5 +1,10 @@
-from django.db import models
+import os
+
+from django.db import models, transaction
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
 from django.utils import timezone
 
 
@@ -14,6 +19,10 @@ class ChatRoom(models.Model):
     chat_type = models.CharField(max_length=10, choices=CHAT_TYPES, default='direct')
     created_at = models.DateTimeField(auto_now_add=True)
     participants = models.ManyToManyField(User, related_name='chat_rooms')
+    # Канонический ключ пары для прямого чата: "<меньший id>:<больший id>"
+    direct_key = models.CharField(max_length=64, unique=True, null=True, blank=True, editable=False)
+    # Срок хранения сообщений в днях; None - общий CHAT_RETENTION['DAYS']
+    retention_days = models.PositiveIntegerField(null=True, blank=True)
 
     def __str__(self):
         return self.name
@@ -23,27 +32,255 @@ class ChatRoom(models.Model):
         
     def is_direct_chat(self):
         """Проверяет, является ли чат прямым (1-на-1)"""
-        return self.chat_type == 'direct' and self.participants.count() == 2
+        # participants.all() берется из prefetch_related, если он был сделан
+        return self.chat_type == 'direct' and len(self.participants.all()) == 2
         
     def get_other_participant(self, user):
         """Получает другого участника для прямого чата"""
         if self.is_direct_chat():
-            return self.participants.exclude(id=user.id).first()
+            return next((p for p in self.participants.all() if p.id != user.id), None)
         return None
 
+    @staticmethod
+    def direct_pair_key(user_id, other_user_id):
+        low, high = sorted((int(user_id), int(other_user_id)))
+        return f'{low}:{high}'
+
+    @classmethod
+    def get_or_create_direct(cls, user, other_user):
+        """
+        Прямой чат пары пользователей: один запрос по уникальному индексу
+        direct_key. Параллельные вызовы не создают дубликатов.
+        Возвращает (room, created).
+        """
+        key = cls.direct_pair_key(user.id, other_user.id)
+        with transaction.atomic():
+            room, created = cls.objects.get_or_create(direct_key=key, defaults={
+                'name': f"Чат: {user.username} и {other_user.username}",
+                'description': f"Прямой чат между {user.username} и {other_user.username}",
+                'chat_type': 'direct',
+            })
+            # Для существующего чата возвращает того, кто из него вышел
+            room.participants.add(user, other_user)
+        return room, created
+
+    def unread_count_for(self, user):
+        """Количество сообщений от других участников после водяного знака пользователя"""
+        watermark = ReadReceipt.objects.filter(
+            room=self, user=user
+        ).values_list('last_read_message_id', flat=True).first() or 0
+        return self.messages.filter(id__gt=watermark).exclude(user=user).count()
+
+    @classmethod
+    def unread_counts_for(cls, user, room_ids):
+        """
+        Количество непрочитанных сообщений по нескольким комнатам сразу.
+
+        Один запрос независимо от числа комнат: для каждой комнаты
+        коррелированный COUNT по диапазону id > водяного знака (индекс
+        room_id), без условия на каждую комнату в WHERE.
+        Возвращает словарь {room_id: count}.
+        """
+        room_ids = list(room_ids)
+        if not room_ids:
+            return {}
+        watermark = ReadReceipt.objects.filter(
+            user=user, room_id=models.OuterRef(models.OuterRef('pk'))
+        ).values('last_read_message_id')[:1]
+        unread = Message.objects.filter(
+            room_id=models.OuterRef('pk'), id__gt=Coalesce(models.Subquery(watermark), 0)
+        ).exclude(user=user).order_by().values('room_id').annotate(
+            count=models.Count('id')
+        ).values('count')
+
+        counts = dict.fromkeys(room_ids, 0)
+        rows = cls.objects.filter(id__in=room_ids).order_by().annotate(
+            unread=Coalesce(models.Subquery(unread), 0)
+        ).values_list('id', 'unread')
+        counts.update(rows)
+        return counts
+
 
 class Message(models.Model):
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='messages')
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='messages')
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
-    is_read = models.BooleanField(default=False)
+    # default вместо auto_now_add: при отложенной записи время назначается
+    # в момент получения сообщения и не должно перезаписываться в bulk_create
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
 
     def __str__(self):
         return f'{self.user.username}: {self.content[:50]}'
 
+    def save(self, *args, **kwargs):
+        from .persistence import message_id_allocator, write_behind_enabled
+
+        # При отложенной записи все ID выдает общий счетчик, иначе
+        # автоинкремент базы пересекся бы с уже выданными, но не записанными ID.
+        # ID берется в той же транзакции, что и INSERT, и не попадает в блоки.
+        if self.pk is None and write_behind_enabled():
+            with transaction.atomic():
+                self.pk = message_id_allocator.reserve(1)[0]
+                kwargs['force_insert'] = True
+                super().save(*args, **kwargs)
+            return
+        super().save(*args, **kwargs)
+
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['room', 'timestamp', 'id'], name='chat_message_room_ts_id_idx'),
+        ]
+
+
+class MessageIdBlock(models.Model):
+    """
+    Блок ID, выданный процессу для отложенной записи. Пока строка есть, часть
+    ID блока может быть еще не записана, и водяные знаки прочтения не
+    поднимаются выше start - 1. Строку удаляет сам процесс, когда все
+    выданные из блока сообщения записаны; блок упавшего процесса перестает
+    учитываться после expires_at.
+    """
+    start = models.BigIntegerField()
+    end = models.BigIntegerField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f'{self.start}..{self.end - 1}'
+
+
+class MessageSequence(models.Model):
+    """
+    Счетчик ID сообщений для отложенной записи (кроме PostgreSQL, где ID
+    берутся из последовательности таблицы сообщений).
+    """
+    next_id = models.BigIntegerField(default=1)
+
+    def __str__(self):
+        return f'next_id={self.next_id}'
+
+
+class ReadReceipt(models.Model):
+    """
+    Водяной знак прочтения: ID последнего прочитанного сообщения
+    пользователя в комнате. Все сообщения с id <= last_read_message_id
+    считаются прочитанными этим пользователем.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_receipts')
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='read_receipts')
+    last_read_message_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.user_id} -> {self.room_id}: {self.last_read_message_id}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'room'], name='chat_readreceipt_user_room_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['room', 'last_read_message_id'], name='chat_receipt_room_last_idx'),
+        ]
+
+    @classmethod
+    def mark_read(cls, user, room_id, message_id=None):
+        """
+        Сдвигает водяной знак вперед (по умолчанию до последнего сообщения комнаты).
+
+        Обычно это один UPDATE одной строки; строка создается при первом прочтении.
+        Водяной знак никогда не двигается назад и при отложенной записи не
+        поднимается выше committed_id_cap(): ниже него все сообщения уже в базе.
+        Возвращает итоговый ID.
+        """
+        from .persistence import committed_id_cap
+
+        if message_id is None:
+            message_id = Message.objects.filter(
+                room_id=room_id
+            ).order_by('-id').values_list('id', flat=True).first()
+            if message_id is None:
+                return 0
+        cap = committed_id_cap()
+        if cap is not None:
+            message_id = min(message_id, cap)
+            if message_id <= 0:
+                return 0
+
+        updated = cls.objects.filter(
+            user=user, room_id=room_id, last_read_message_id__lt=message_id
+        ).update(last_read_message_id=message_id, updated_at=timezone.now())
+        if not updated:
+            cls.objects.bulk_create(
+                [cls(user=user, room_id=room_id, last_read_message_id=message_id)],
+                ignore_conflicts=True,
+            )
+        return message_id
+
+    @classmethod
+    def watermarks(cls, room_id, user):
+        """
+        Возвращает (свой водяной знак, максимальный водяной знак других участников).
+        Второе значение показывает, до какого сообщения собеседники прочитали комнату.
+        """
+        # Один запрос: своя строка по уникальному ключу и лучший знак
+        # собеседников по индексу (room, last_read_message_id), без чтения
+        # строк всех участников
+        receipts = cls.objects.filter(room_id=models.OuterRef('pk')).values('last_read_message_id')
+        row = ChatRoom.objects.filter(pk=room_id).annotate(
+            own=Coalesce(models.Subquery(receipts.filter(user=user)[:1]), 0),
+            peers=Coalesce(models.Subquery(
+                receipts.exclude(user=user).order_by('-last_read_message_id')[:1]
+            ), 0),
+        ).values_list('own', 'peers').first()
+        return row or (0, 0)
+
+
+class MembershipChange(models.Model):
+    """
+    Журнал входа и выхода из комнат для синхронизации после переподключения.
+    room_id без внешнего ключа: запись об уходе переживает удаление комнаты.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='membership_changes')
+    room_id = models.BigIntegerField()
+    joined = models.BooleanField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at'], name='chat_memberchange_user_idx'),
+            models.Index(fields=['room_id', 'created_at'], name='chat_memberchange_room_idx'),
+        ]
+
+    @classmethod
+    def record(cls, user_ids, room_ids, joined):
+        cls.objects.bulk_create(
+            cls(user_id=user_id, room_id=room_id, joined=joined)
+            for user_id in user_ids for room_id in room_ids
+        )
+
+
+class ArchiveSegment(models.Model):
+    """
+    Сегмент архива: сообщения комнаты старше срока хранения, перенесенные
+    из таблицы сообщений в сжатый файл JSONL (gzip) в CHAT_RETENTION['ARCHIVE_DIR'].
+    Сегменты комнаты не пересекаются по времени.
+    """
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='archive_segments')
+    path = models.CharField(max_length=500)
+    first_message_id = models.BigIntegerField()
+    last_message_id = models.BigIntegerField()
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    message_count = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['room', 'last_timestamp'], name='chat_archive_room_time_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.room_id}: {self.first_message_id}-{self.last_message_id} ({self.message_count})'
 
 
 class UserProfile(models.Model):
@@ -62,3 +299,118 @@ class UserProfile(models.Model):
         if not self.avatar:
             self.avatar = 'https://via.placeholder.com/150?text=Avatar'
         super().save(*args, **kwargs)
+
+
+@receiver(post_save, sender=Message)
+def update_history_cache(sender, instance, created, **kwargs):
+    """Новое сообщение дописывается в буфер комнаты, отредактированное сбрасывает его"""
+    from .history_cache import cache_message, invalidate_room
+
+    if created:
+        cache_message(instance)
+    else:
+        invalidate_room(instance.room_id)
+
+
+@receiver(post_delete, sender=Message)
+def invalidate_history_cache(sender, instance, **kwargs):
+    from .history_cache import invalidate_room
+
+    invalidate_room(instance.room_id)
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_rooms_cache(sender, instance, created, update_fields=None, **kwargs):
+    """В буферах лежат данные автора: смена имени или email сбрасывает его комнаты"""
+    from .history_cache import get_history_cache
+
+    cache = get_history_cache()
+    if created or cache is None:
+        return
+    if update_fields is not None and not set(update_fields) & {'username', 'email', 'first_name', 'last_name'}:
+        return
+    room_ids = ChatRoom.participants.through.objects.filter(
+        user_id=instance.pk
+    ).values_list('chatroom_id', flat=True)
+    for room_id in room_ids:
+        cache.invalidate(room_id)
+
+
+def _invalidate_membership(user_ids, room_ids):
+    """Сбрасывает кэш членства сейчас и еще раз после коммита транзакции"""
+    from .membership import invalidate_membership
+
+    user_ids, room_ids = list(user_ids), list(room_ids)
+    invalidate_membership(user_ids, room_ids)
+    transaction.on_commit(lambda: invalidate_membership(user_ids, room_ids))
+
+
+def _notify_watchers(room_ids):
+    """Подключенные участники комнат обновляют подписки на статусы после коммита"""
+    from .presence import notify_membership_change
+
+    room_ids = list(room_ids)
+    transaction.on_commit(lambda: notify_membership_change(room_ids))
+
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def invalidate_membership_cache(sender, instance, action, reverse, pk_set, **kwargs):
+    """room.participants.add/remove/clear и user.chat_rooms.add/remove/clear"""
+    if action == 'pre_clear':
+        # После clear уже не узнать, кто был связан с объектом
+        field = 'chatroom_id' if reverse else 'user_id'
+        lookup = {'user_id': instance.pk} if reverse else {'chatroom_id': instance.pk}
+        instance._cleared_membership = list(sender.objects.filter(**lookup).values_list(field, flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    related = pk_set if action != 'post_clear' else getattr(instance, '_cleared_membership', [])
+    user_ids, room_ids = ([instance.pk], related) if reverse else (related, [instance.pk])
+    _invalidate_membership(user_ids, room_ids)
+    if related:
+        MembershipChange.record(user_ids, room_ids, joined=action == 'post_add')
+        _notify_watchers(room_ids)
+
+
+@receiver(post_save, sender=ChatRoom)
+@receiver(post_save, sender=User)
+def invalidate_new_object_membership(sender, instance, created, **kwargs):
+    """SQLite может выдать ID удаленной строки повторно: старая запись кэша ему не принадлежит"""
+    if created:
+        from .membership import invalidate_membership
+
+        if sender is User:
+            invalidate_membership(user_ids=[instance.pk])
+        else:
+            invalidate_membership(room_ids=[instance.pk])
+
+
+@receiver(pre_delete, sender=ChatRoom)
+def invalidate_deleted_room_membership(sender, instance, **kwargs):
+    """Каскадное удаление строк participants не вызывает m2m_changed"""
+    member_ids = list(
+        sender.participants.through.objects.filter(chatroom_id=instance.pk).values_list('user_id', flat=True)
+    )
+    _invalidate_membership(member_ids, [instance.pk])
+    MembershipChange.record(member_ids, [instance.pk], joined=False)
+    _notify_watchers([instance.pk])
+
+
+@receiver(pre_delete, sender=User)
+def invalidate_deleted_user_membership(sender, instance, **kwargs):
+    _invalidate_membership(
+        [instance.pk],
+        ChatRoom.participants.through.objects.filter(user_id=instance.pk).values_list('chatroom_id', flat=True),
+    )
+
+
+@receiver(post_delete, sender=ArchiveSegment)
+def delete_archive_file(sender, instance, **kwargs):
+    """Файл сегмента удаляется вместе с записью (и с комнатой) после коммита"""
+    def remove():
+        try:
+            os.remove(instance.path)
+        except FileNotFoundError:
+            pass
+
+    transaction.on_commit(remove)
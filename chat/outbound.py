@@ -0,0 +1,329 @@
+"""
+Исходящие очереди соединений WebSocket и подтверждения доставки.
+
+Обработчики событий группы (chat_message, typing_indicator,
+user_status_update) не отправляют кадр сами, а кладут его в ограниченную
+очередь соединения; отдельная задача отправляет кадры клиенту. Медленный
+клиент задерживает только свою очередь, а consumer продолжает разбирать
+входящие события channel layer и не переполняет его емкость.
+
+Политики при заполнении очереди (MAX_FRAMES кадров):
+    - кадры с ключом (печать, статус) склеиваются: новый кадр с тем же
+      ключом заменяет еще не отправленный, а при полной очереди отбрасывается
+      или вытесняет самый старый такой кадр;
+    - кадры без ключа (сообщения, ответы) не отбрасываются: если место не
+      освободить, соединение закрывается с кодом CLOSE_CODE, и клиент
+      переподключается с курсором.
+
+Подтверждения включаются параметром ?acks=1 в URL. Клиент отвечает кадром
+ack с ID полученных сообщений; неподтвержденные кадры chat_message (не
+больше MAX_UNACKED на соединение) при отключении сохраняются в хранилище
+пользователя (память процесса или Redis) на UNACKED_TTL секунд и
+отправляются повторно при следующем подключении к тем же комнатам.
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULTS = {
+    'ENABLED': True,
+    'MAX_FRAMES': 256,
+    # Код закрытия соединения, которое не успевает получать сообщения
+    'CLOSE_CODE': 4008,
+    'MAX_UNACKED': 500,
+    'UNACKED_TTL': 600,
+    'BACKEND': 'memory',
+    'REDIS_URL': 'redis://127.0.0.1:6379/0',
+}
+
+
+def outbound_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_OUTBOUND', {})}
+
+
+class OutboundStats:
+    """Счетчики очередей процесса для /metrics"""
+
+    RESULTS = ('sent', 'coalesced', 'dropped')
+
+    def __init__(self):
+        self._queues = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self.frames = dict.fromkeys(self.RESULTS, 0)
+        self.overflows = 0
+        self.send_errors = 0
+        self.acked = 0
+        self.retransmitted = 0
+        self.evicted = 0
+
+    def register(self, queue):
+        self._queues.add(queue)
+
+    def count(self, name, value=1):
+        with self._lock:
+            if name in self.frames:
+                self.frames[name] += value
+            else:
+                setattr(self, name, getattr(self, name) + value)
+
+    def stats(self):
+        depths = [len(queue) for queue in list(self._queues) if not queue.closed]
+        with self._lock:
+            return {
+                **self.frames,
+                'connections': len(depths),
+                'depth': sum(depths),
+                'max_depth': max(depths, default=0),
+                'overflows': self.overflows,
+                'send_errors': self.send_errors,
+                'acked': self.acked,
+                'retransmitted': self.retransmitted,
+                'evicted': self.evicted,
+            }
+
+
+outbound_stats = OutboundStats()
+
+
+class OutboundQueue:
+    """
+    Очередь кадров одного соединения. send - корутина отправки закодированного
+    кадра клиенту; вызывается только из задачи очереди. Если отправка не
+    удалась, очередь закрывается, оставшиеся кадры считаются отброшенными и
+    вызывается корутина on_error (закрыть соединение).
+    """
+
+    def __init__(self, send, max_frames, on_error=None):
+        self.send = send
+        self.max_frames = max_frames
+        self.on_error = on_error
+        self.closed = False
+        self._items = deque()
+        self._keys = {}
+        self._ready = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def start(self):
+        # Отдельный контекст: отправка не относится к замеру события, в котором создана очередь
+        self._task = asyncio.get_running_loop().create_task(self._run(), context=contextvars.Context())
+        outbound_stats.register(self)
+
+    async def stop(self):
+        self.closed = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def put(self, frame, key=None):
+        """
+        Ставит кадр в очередь. Возвращает False, если очередь заполнена
+        кадрами, которые нельзя отбросить.
+        """
+        if key is not None and key in self._keys:
+            self._keys[key][1] = frame
+            outbound_stats.count('coalesced')
+            return True
+        if len(self._items) >= self.max_frames:
+            if key is not None:
+                outbound_stats.count('dropped')
+                return True
+            victim = next((item for item in self._items if item[0] is not None), None)
+            if victim is None:
+                outbound_stats.count('overflows')
+                return False
+            self._items.remove(victim)
+            del self._keys[victim[0]]
+            outbound_stats.count('dropped')
+        item = [key, frame]
+        self._items.append(item)
+        if key is not None:
+            self._keys[key] = item
+        self._ready.set()
+        return True
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            while self._items:
+                key, frame = self._items.popleft()
+                if key is not None:
+                    del self._keys[key]
+                try:
+                    await self.send(frame)
+                except Exception as e:
+                    await self._fail(e)
+                    return
+                outbound_stats.count('sent')
+            self._ready.clear()
+
+    async def _fail(self, error):
+        self.closed = True
+        # Кадр, на котором упала отправка, тоже потерян
+        lost = len(self._items) + 1
+        self._items.clear()
+        self._keys.clear()
+        outbound_stats.count('dropped', lost)
+        outbound_stats.count('send_errors')
+        logger.warning(f"Outbound send failed, {lost} frames dropped: {error!r}")
+        if self.on_error is not None:
+            await self.on_error()
+
+
+class UnackedFrames:
+    """Неподтвержденные кадры chat_message соединения: ID сообщения -> (room_id, кадр)"""
+
+    def __init__(self, max_frames):
+        self.max_frames = max_frames
+        self._frames = OrderedDict()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __contains__(self, message_id):
+        return message_id in self._frames
+
+    def add(self, message_id, room_id, frame):
+        self._frames[message_id] = (room_id, frame)
+        while len(self._frames) > self.max_frames:
+            # Вытесненные сообщения клиент получит через курсор синхронизации
+            self._frames.popitem(last=False)
+            outbound_stats.count('evicted')
+
+    def ack(self, message_ids):
+        acked = sum(self._frames.pop(message_id, None) is not None for message_id in message_ids)
+        outbound_stats.count('acked', acked)
+        return acked
+
+    def items(self):
+        return list(self._frames.items())
+
+
+class MemoryUnackedStore:
+    """Неподтвержденные кадры пользователей в памяти процесса"""
+
+    def __init__(self, max_frames, ttl):
+        self.max_frames = max_frames
+        self.ttl = ttl
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def save(self, user_id, entries):
+        if not entries:
+            return
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            frames = self._users.setdefault(user_id, {})
+            for message_id, (room_id, frame) in entries:
+                frames[message_id] = (room_id, frame, expires_at)
+            for message_id in sorted(frames)[:-self.max_frames]:
+                del frames[message_id]
+
+    def take(self, user_id, room_ids):
+        """Забирает кадры комнат room_ids: {ID сообщения: (room_id, кадр)}"""
+        now = time.monotonic()
+        taken = {}
+        with self._lock:
+            frames = self._users.get(user_id, {})
+            for message_id, (room_id, frame, expires_at) in list(frames.items()):
+                if expires_at <= now:
+                    del frames[message_id]
+                elif room_id in room_ids:
+                    taken[message_id] = (room_id, frame)
+                    del frames[message_id]
+            if not frames:
+                self._users.pop(user_id, None)
+        return taken
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+
+
+class RedisUnackedStore:
+    """
+    Неподтвержденные кадры в Redis, общие для всех воркеров:
+    hash chat:unacked:<user_id>, поле - ID сообщения, значение - [room_id, кадр].
+    """
+
+    def __init__(self, url, max_frames, ttl):
+        import redis
+
+        self.max_frames = max_frames
+        self.ttl = ttl
+        self.redis = redis.Redis.from_url(url, socket_timeout=1)
+
+    def _key(self, user_id):
+        return f'chat:unacked:{user_id}'
+
+    def save(self, user_id, entries):
+        if not entries:
+            return
+        key = self._key(user_id)
+        pipe = self.redis.pipeline()
+        pipe.hset(key, mapping={
+            message_id: json.dumps([room_id, frame]) for message_id, (room_id, frame) in entries
+        })
+        pipe.expire(key, self.ttl)
+        pipe.hkeys(key)
+        message_ids = pipe.execute()[-1]
+        # Как и в памяти, остаются только max_frames самых новых сообщений
+        extra = sorted(int(message_id) for message_id in message_ids)[:-self.max_frames]
+        if extra:
+            self.redis.hdel(key, *extra)
+
+    def take(self, user_id, room_ids):
+        key = self._key(user_id)
+        taken = {}
+        for message_id, value in self.redis.hgetall(key).items():
+            room_id, frame = json.loads(value)
+            if room_id in room_ids:
+                taken[int(message_id)] = (room_id, frame)
+        if taken:
+            self.redis.hdel(key, *taken)
+        return taken
+
+    def clear(self):
+        keys = list(self.redis.scan_iter('chat:unacked:*'))
+        if keys:
+            self.redis.delete(*keys)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_unacked_store():
+    """Хранилище процесса по настройке CHAT_OUTBOUND"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                config = outbound_settings()
+                if config['BACKEND'] == 'redis':
+                    _store = RedisUnackedStore(config['REDIS_URL'], config['MAX_UNACKED'], config['UNACKED_TTL'])
+                else:
+                    _store = MemoryUnackedStore(config['MAX_UNACKED'], config['UNACKED_TTL'])
+    return _store
+
+
+def reset_unacked_store():
+    """Сбрасывает хранилище (для тестов и после смены настроек)"""
+    global _store
+    with _store_lock:
+        _store = None
@@ -0,0 +1,176 @@
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ParseError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+
+
+DEFAULT_PAGE_SIZE = getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)
+MAX_PAGE_SIZE = getattr(settings, 'CHAT_HISTORY_MAX_PAGE_SIZE', 200)
+
+
+class InvalidCursor(ValueError):
+    """Неверное значение курсора или размера страницы"""
+
+
+def parse_limit(value):
+    """Размер страницы, ограниченный MAX_PAGE_SIZE"""
+    if value in (None, ''):
+        return DEFAULT_PAGE_SIZE
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        raise InvalidCursor('Неверный размер страницы')
+    if limit < 1:
+        raise InvalidCursor('Неверный размер страницы')
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def _resolve_anchor(queryset, value, pending=()):
+    """
+    Превращает значение курсора в пару (timestamp, id).
+
+    Курсор — это либо ID сообщения, либо время в формате ISO 8601.
+    Для времени id не задается, и граница проходит строго по timestamp.
+    """
+    if value.isdigit():
+        message_id = int(value)
+        timestamp = next((m.timestamp for m in pending if m.id == message_id), None)
+        if timestamp is None:
+            timestamp = queryset.filter(id=message_id).values_list('timestamp', flat=True).first()
+        if timestamp is None:
+            raise InvalidCursor('Сообщение для курсора не найдено')
+        return timestamp, message_id
+
+    try:
+        timestamp = parse_datetime(value)
+    except ValueError:
+        # Формат верный, но такой даты нет (2024-13-45)
+        raise InvalidCursor('Неверный курсор')
+    if timestamp is None:
+        raise InvalidCursor('Неверный курсор')
+    return timestamp, None
+
+
+def _older_than(timestamp, message_id):
+    if message_id is None:
+        return Q(timestamp__lt=timestamp)
+    return Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id)
+
+
+def _newer_than(timestamp, message_id):
+    if message_id is None:
+        return Q(timestamp__gt=timestamp)
+    return Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=message_id)
+
+
+def _is_older(message, timestamp, message_id):
+    if message_id is None:
+        return message.timestamp < timestamp
+    return (message.timestamp, message.id) < (timestamp, message_id)
+
+
+def _is_newer(message, timestamp, message_id):
+    if message_id is None:
+        return message.timestamp > timestamp
+    return (message.timestamp, message.id) > (timestamp, message_id)
+
+
+def keyset_page(queryset, before=None, after=None, limit=None, pending=()):
+    """
+    Возвращает одну страницу сообщений по ключу (timestamp, id).
+
+    Без курсора и с `before` выбираются самые новые сообщения (от новых к
+    старым), с `after` — сообщения новее курсора (от старых к новым).
+    Запрос всегда читает не больше limit + 1 строк по индексу
+    (room, timestamp, id), независимо от размера истории.
+
+    pending - еще не записанные в базу сообщения (отложенная запись);
+    они подмешиваются по тем же границам курсора.
+
+    Возвращает (messages, has_more, newest_first).
+    """
+    limit = parse_limit(limit)
+    if before and after:
+        raise InvalidCursor('Нельзя указывать before и after одновременно')
+    pending = list(pending)
+
+    if after:
+        newest_first = False
+        anchor = _resolve_anchor(queryset, after, pending)
+        queryset = queryset.filter(_newer_than(*anchor))
+        pending = [m for m in pending if _is_newer(m, *anchor)]
+        queryset = queryset.order_by('timestamp', 'id')
+    else:
+        newest_first = True
+        if before:
+            anchor = _resolve_anchor(queryset, before, pending)
+            queryset = queryset.filter(_older_than(*anchor))
+            pending = [m for m in pending if _is_older(m, *anchor)]
+        queryset = queryset.order_by('-timestamp', '-id')
+
+    messages = list(queryset[:limit + 1])
+    if pending:
+        # Сообщение может оказаться и в базе, и в очереди: убираем дубликаты по id
+        merged = {message.id: message for message in pending}
+        merged.update((message.id, message) for message in messages)
+        messages = sorted(
+            merged.values(), key=lambda m: (m.timestamp, m.id), reverse=newest_first
+        )[:limit + 1]
+    has_more = len(messages) > limit
+    return messages[:limit], has_more, newest_first
+
+
+def page_cursors(messages, newest_first):
+    """Курсоры для перехода к более старой и более новой странице"""
+    if not messages:
+        return None, None
+    first, last = (messages[-1], messages[0]) if newest_first else (messages[0], messages[-1])
+    # Страница может состоять и из моделей, и из уже сериализованных словарей
+    if isinstance(first, dict):
+        return first['id'], last['id']
+    return first.id, last.id
+
+
+def order_page(messages, newest_first, order):
+    """Приводит страницу к запрошенному порядку ('desc' по умолчанию или 'asc')"""
+    if order not in (None, '', 'asc', 'desc'):
+        raise InvalidCursor('Неверный порядок сортировки')
+    wants_newest_first = order != 'asc'
+    if wants_newest_first != newest_first:
+        return list(reversed(messages))
+    return messages
+
+
+class MessageKeysetPagination(BasePagination):
+    """
+    Курсорная пагинация сообщений для DRF views.
+
+    Параметры запроса: before, after (ID сообщения или ISO-время),
+    limit (до MAX_PAGE_SIZE) и order ('desc' по умолчанию или 'asc').
+    """
+
+    def paginate_queryset(self, queryset, request, view=None):
+        params = request.query_params
+        try:
+            pending = view.get_pending_messages() if hasattr(view, 'get_pending_messages') else ()
+            messages, self.has_more, newest_first = keyset_page(
+                queryset,
+                before=params.get('before'),
+                after=params.get('after'),
+                limit=params.get('limit'),
+                pending=pending,
+            )
+            self.next_before, self.next_after = page_cursors(messages, newest_first)
+            return order_page(messages, newest_first, params.get('order'))
+        except InvalidCursor as e:
+            raise ParseError(str(e))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'results': data,
+            'has_more': self.has_more,
+            'next_before': self.next_before,
+            'next_after': self.next_after,
+        })
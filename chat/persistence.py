@@ -0,0 +1,371 @@
+"""
+Отложенная запись сообщений (write-behind).
+
+Сообщение сразу получает ID и время, рассылается в группу и попадает в
+очередь процесса; фоновая задача записывает очередь пачками через
+bulk_create. Пока сообщение не записано, история в этом процессе берет
+его из очереди, поэтому в ответах нет ни пропусков, ни дубликатов.
+
+ID выдаются блоками на процесс, и сообщения воркеров попадают в базу не в
+порядке ID; отметки о прочтении поэтому не поднимаются выше
+committed_id_cap() - последнего ID, до которого записано все.
+"""
+import asyncio
+import atexit
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULTS = {
+    'ENABLED': False,
+    'FLUSH_SIZE': 200,
+    'FLUSH_INTERVAL': 0.05,
+    'MAX_PENDING': 5000,
+    'ID_BLOCK_SIZE': 500,
+    'ID_BLOCK_LIFETIME': 1.0,
+    # Через сколько секунд блок упавшего процесса перестает держать водяные знаки
+    'ID_BLOCK_EXPIRY': 60,
+}
+
+
+def write_behind_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_WRITE_BEHIND', {})}
+
+
+def write_behind_enabled():
+    return write_behind_settings()['ENABLED']
+
+
+class IdBlock:
+    """Блок ID процесса: выдаются next..end-1 до deadline (time.monotonic())"""
+
+    def __init__(self, pk, start, end, deadline):
+        self.pk = pk
+        self.start = start
+        self.next = start
+        self.end = end
+        self.deadline = deadline
+
+
+class MessageIdAllocator:
+    """
+    Выдает ID сообщений из общего для всех процессов счетчика в базе.
+
+    Отложенная запись берет ID из блока процесса (ID_BLOCK_SIZE штук), и за
+    новым блоком в базу ходит только когда блок кончился или прожил
+    ID_BLOCK_LIFETIME секунд. Блоки разных воркеров пересекаются по времени,
+    поэтому меньший ID может попасть в базу позже большего; пока в блоке
+    могут быть незаписанные ID, его строка MessageIdBlock ограничивает
+    водяные знаки прочтения (см. committed_id_cap).
+
+    В PostgreSQL счетчик - последовательность самой таблицы сообщений, и
+    обычные INSERT с ней не пересекаются; в остальных базах - строка
+    MessageSequence, которая никогда не отстает от максимального ID сообщения.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._block = None
+        self._retired = []
+
+    def reset(self):
+        """Забывает блоки процесса (для тестов, после очистки базы)"""
+        with self._lock:
+            self._block = None
+            self._retired = []
+
+    def take(self):
+        """ID из текущего блока без обращения к базе; None, если блок кончился"""
+        with self._lock:
+            self._retire()
+            if self._block is None:
+                return None
+            message_id = self._block.next
+            self._block.next += 1
+            return message_id
+
+    def allocate(self):
+        message_id = self.take()
+        if message_id is not None:
+            return message_id
+        from .models import MessageIdBlock
+
+        config = write_behind_settings()
+        with transaction.atomic():
+            start = self.reserve(config['ID_BLOCK_SIZE'])[0]
+            row = MessageIdBlock.objects.create(
+                start=start,
+                end=start + config['ID_BLOCK_SIZE'],
+                expires_at=timezone.now() + timedelta(seconds=config['ID_BLOCK_EXPIRY']),
+            )
+        block = IdBlock(row.pk, row.start, row.end, time.monotonic() + config['ID_BLOCK_LIFETIME'])
+        with self._lock:
+            if self._block is not None:
+                self._retired.append(self._block)
+            self._block = block
+            block.next += 1
+        return block.start
+
+    def reserve(self, size):
+        """
+        Список из size новых ID по возрастанию. Вызывается в транзакции,
+        которая сама записывает сообщения с этими ID (сохранение, импорт).
+        """
+        from .models import Message, MessageSequence
+
+        if connection.vendor == 'postgresql':
+            # setval(nextval + size - 1) сдвигает последовательность на весь блок сразу
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+                    "nextval(pg_get_serial_sequence(%s, 'id')) + %s - 1)",
+                    [Message._meta.db_table, Message._meta.db_table, size],
+                )
+                end = cursor.fetchone()[0] + 1
+            return list(range(end - size, end))
+
+        with transaction.atomic():
+            sequence, _ = MessageSequence.objects.select_for_update().get_or_create(pk=1)
+            max_id = Message.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+            start = max(sequence.next_id, max_id + 1)
+            sequence.next_id = start + size
+            sequence.save(update_fields=['next_id'])
+        return list(range(start, start + size))
+
+    def _retire(self, force=False):
+        block = self._block
+        if block is not None and (force or block.next >= block.end or time.monotonic() >= block.deadline):
+            self._retired.append(block)
+            self._block = None
+
+    def retire(self, force=False):
+        """Закрывает блок, если он кончился или устарел; True, если есть закрытые блоки"""
+        with self._lock:
+            self._retire(force)
+            return bool(self._retired)
+
+    def release(self, pending_ids):
+        """Удаляет строки закрытых блоков, выданные ID которых уже записаны (нет в pending_ids)"""
+        from .models import MessageIdBlock
+
+        with self._lock:
+            done = [
+                block for block in self._retired
+                if not any(block.start <= message_id < block.next for message_id in pending_ids)
+            ]
+            self._retired = [block for block in self._retired if block not in done]
+        if done:
+            MessageIdBlock.objects.filter(pk__in=[block.pk for block in done]).delete()
+
+
+def committed_id_cap():
+    """
+    Наибольший ID, до которого все сообщения уже в базе, или None, если
+    незаписанных блоков нет. Водяной знак выше него мог бы накрыть сообщение
+    другого воркера, которое еще появится с меньшим ID.
+    """
+    from .models import MessageIdBlock
+
+    if not write_behind_enabled():
+        return None
+    start = MessageIdBlock.objects.filter(
+        expires_at__gt=timezone.now()
+    ).aggregate(start=Min('start'))['start']
+    return None if start is None else start - 1
+
+
+class MessageWriteBehind:
+    """Очередь несохраненных сообщений процесса и фоновая запись пачками"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._task = None
+        self._wakeup = None
+        self._drained = None
+        self._flushing = None
+        self._loop = None
+        self._exit_hook = False
+        self.failed = 0
+
+    def _ensure_task(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._drained = asyncio.Event()
+            self._drained.set()
+            self._flushing = asyncio.Lock()
+            self._task = loop.create_task(self._run())
+        if not self._exit_hook:
+            # Сервер без ASGI lifespan (daphne) при остановке только завершает процесс
+            atexit.register(self.flush_sync)
+            self._exit_hook = True
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def pending_ids(self):
+        with self._lock:
+            return set(self._pending)
+
+    def pending_for_room(self, room_id):
+        """Несохраненные сообщения комнаты (для чтения истории)"""
+        with self._lock:
+            return [message for message in self._pending.values() if message.room_id == room_id]
+
+    async def enqueue(self, message):
+        """
+        Ставит сообщение в очередь. Если очередь больше MAX_PENDING,
+        ждет, пока фоновая запись ее разгрузит (backpressure).
+        """
+        self._ensure_task()
+        config = write_behind_settings()
+        while self.pending_count() >= config['MAX_PENDING']:
+            self._drained.clear()
+            self._wakeup.set()
+            await self._drained.wait()
+
+        with self._lock:
+            self._pending[message.id] = message
+            size = len(self._pending)
+        if size >= config['FLUSH_SIZE']:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            config = write_behind_settings()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), config['FLUSH_INTERVAL'])
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+                if message_id_allocator.retire():
+                    await database_sync_to_async(message_id_allocator.release)(self.pending_ids())
+            except Exception as e:
+                logger.error(f"Error flushing messages: {e}")
+                await asyncio.sleep(config['FLUSH_INTERVAL'])
+
+    async def flush(self):
+        """Записывает все сообщения очереди пачками по FLUSH_SIZE"""
+        if self._flushing is None:
+            return
+        # Фоновая задача и close() не должны писать одну пачку одновременно
+        async with self._flushing:
+            await self._flush()
+
+    async def _flush(self):
+        flush_size = write_behind_settings()['FLUSH_SIZE']
+        while True:
+            with self._lock:
+                batch = list(self._pending.values())[:flush_size]
+            if not batch:
+                break
+            failed = await database_sync_to_async(self._write)(batch)
+            if self._written(batch, failed) and self._drained is not None:
+                self._drained.set()
+
+    def flush_sync(self):
+        """Записывает остаток очереди без цикла событий (при выходе процесса)"""
+        flush_size = write_behind_settings()['FLUSH_SIZE']
+        while True:
+            with self._lock:
+                batch = list(self._pending.values())[:flush_size]
+            if not batch:
+                break
+            self._written(batch, self._write(batch))
+        message_id_allocator.retire(force=True)
+        message_id_allocator.release(self.pending_ids())
+
+    def _written(self, batch, failed):
+        """Убирает записанную пачку из очереди; True, если очередь ниже MAX_PENDING"""
+        for message in failed:
+            logger.error(
+                f"Dropping message {message.id} (room {message.room_id}, user {message.user_id}): "
+                f"cannot be written"
+            )
+        # Удаляем из очереди только после коммита: сообщение всегда
+        # видно либо в базе, либо в очереди
+        with self._lock:
+            self.failed += len(failed)
+            for message in batch:
+                self._pending.pop(message.id, None)
+            return len(self._pending) < write_behind_settings()['MAX_PENDING']
+
+    async def close(self):
+        """Записывает остаток очереди и останавливает фоновую задачу"""
+        await self.flush()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        message_id_allocator.retire(force=True)
+        await database_sync_to_async(message_id_allocator.release)(self.pending_ids())
+
+    @staticmethod
+    def _write(batch):
+        """
+        Записывает пачку. Возвращает сообщения, которые записать нельзя
+        (комната или автор удалены, ID уже занят другим сообщением); остальные
+        ошибки пробрасываются, и пачка повторяется целиком.
+        """
+        from .history_cache import invalidate_room
+        from .models import Message
+
+        try:
+            with transaction.atomic():
+                Message.objects.bulk_create(batch)
+            return []
+        except IntegrityError:
+            pass
+        # Пачка не прошла: пишем сообщения по одному, чтобы отделить плохие
+        failed = []
+        for message in batch:
+            try:
+                with transaction.atomic():
+                    Message.objects.bulk_create([message])
+            except IntegrityError:
+                # Сообщение могло быть записано прошлой попыткой
+                written = Message.objects.filter(
+                    id=message.id, room_id=message.room_id, user_id=message.user_id, content=message.content
+                ).exists()
+                if not written:
+                    failed.append(message)
+        # Отброшенные сообщения уже попали в буфер истории комнаты
+        for room_id in {message.room_id for message in failed}:
+            invalidate_room(room_id)
+        return failed
+
+
+message_id_allocator = MessageIdAllocator()
+message_write_behind = MessageWriteBehind()
+
+
+async def lifespan(scope, receive, send):
+    """
+    Обработчик ASGI lifespan: при остановке сервера (uvicorn, hypercorn)
+    дописывает очередь отложенной записи, пока цикл событий еще работает.
+    """
+    while True:
+        event = await receive()
+        if event['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif event['type'] == 'lifespan.shutdown':
+            try:
+                await message_write_behind.close()
+            except Exception as e:
+                logger.error(f"Error flushing messages on shutdown: {e}")
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
@@ -0,0 +1,442 @@
+"""
+Присутствие пользователей (online/offline, last_seen) вне базы данных.
+
+Каждое WebSocket-соединение регистрируется отдельно и живет TTL секунд,
+пока клиент присылает heartbeat. Пользователь онлайн, пока у него есть хотя
+бы одно живое соединение, поэтому закрытие одной из вкладок не делает его
+оффлайн. last_seen копится в памяти и записывается в UserProfile пачками
+через flush_last_seen().
+
+Смена статуса публикуется один раз на пользователя - в группу его
+наблюдателей (соединений собеседников), а не в каждую общую комнату.
+За участниками комнат больше ROOM_WATCH_SIZE соединение следит одной
+подпиской на группу комнаты, и статус публикуется еще и в группы больших
+комнат пользователя.
+PresenceBroadcaster отбрасывает повторы и откладывает публикацию ухода на
+GRACE секунд: если пользователь за это время переподключился (обрыв сети,
+перезагрузка страницы), собеседники не видят ни ухода, ни возвращения.
+"""
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from .membership import room_member_ids, user_room_ids
+from .models import UserProfile
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULTS = {
+    'BACKEND': 'memory',
+    'REDIS_URL': 'redis://127.0.0.1:6379/0',
+    'TTL': 90,
+    'FLUSH_INTERVAL': 30,
+    'FLUSH_BATCH_SIZE': 500,
+    # Сколько секунд ждать переподключения, прежде чем публиковать уход
+    'GRACE': 3.0,
+    # В комнатах больше стольких участников статусы смотрятся через группу комнаты
+    'ROOM_WATCH_SIZE': 200,
+}
+
+
+def presence_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_PRESENCE', {})}
+
+
+class BasePresenceStore:
+    def __init__(self, ttl, flush_interval, flush_batch_size):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def connect(self, user_id, connection_id):
+        """Регистрирует соединение. True, если пользователь только что стал онлайн."""
+        raise NotImplementedError
+
+    def heartbeat(self, user_id, connection_id):
+        """Продлевает TTL соединения"""
+        raise NotImplementedError
+
+    def disconnect(self, user_id, connection_id):
+        """Снимает соединение. True, если у пользователя не осталось соединений."""
+        raise NotImplementedError
+
+    def online_user_ids(self):
+        raise NotImplementedError
+
+    def statuses(self, user_ids):
+        """Словарь {user_id: (is_online, last_seen)}; last_seen может быть None"""
+        raise NotImplementedError
+
+    def touch(self, user_id):
+        """Обновляет last_seen без регистрации соединения (вход/выход через REST)"""
+        self._seen(user_id, timezone.now())
+
+    def _seen(self, user_id, when):
+        with self._pending_lock:
+            self._pending[user_id] = when
+
+    def flush_due(self):
+        with self._pending_lock:
+            if not self._pending:
+                return False
+            return (
+                len(self._pending) >= self.flush_batch_size
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            )
+
+    def drain_pending(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        return pending
+
+
+class MemoryPresenceStore(BasePresenceStore):
+    """Хранилище в памяти процесса: для разработки и одного воркера"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._last_seen = {}
+
+    def _alive(self, user_id, now):
+        connections = {
+            connection_id: expires_at
+            for connection_id, expires_at in self._connections.get(user_id, {}).items()
+            if expires_at > now
+        }
+        if connections:
+            self._connections[user_id] = connections
+        else:
+            self._connections.pop(user_id, None)
+        return connections
+
+    def connect(self, user_id, connection_id):
+        now = time.time()
+        with self._lock:
+            connections = self._alive(user_id, now)
+            was_online = bool(connections)
+            connections[connection_id] = now + self.ttl
+            self._connections[user_id] = connections
+            self._last_seen[user_id] = seen = timezone.now()
+        self._seen(user_id, seen)
+        return not was_online
+
+    def heartbeat(self, user_id, connection_id):
+        now = time.time()
+        with self._lock:
+            connections = self._alive(user_id, now)
+            connections[connection_id] = now + self.ttl
+            self._connections[user_id] = connections
+            self._last_seen[user_id] = timezone.now()
+
+    def disconnect(self, user_id, connection_id):
+        now = time.time()
+        with self._lock:
+            connections = self._alive(user_id, now)
+            connections.pop(connection_id, None)
+            if not connections:
+                self._connections.pop(user_id, None)
+            self._last_seen[user_id] = seen = timezone.now()
+        self._seen(user_id, seen)
+        return not connections
+
+    def touch(self, user_id):
+        with self._lock:
+            self._last_seen[user_id] = timezone.now()
+        super().touch(user_id)
+
+    def online_user_ids(self):
+        now = time.time()
+        with self._lock:
+            return {
+                user_id for user_id in list(self._connections)
+                if self._alive(user_id, now)
+            }
+
+    def statuses(self, user_ids):
+        now = time.time()
+        with self._lock:
+            return {
+                user_id: (bool(self._alive(user_id, now)), self._last_seen.get(user_id))
+                for user_id in user_ids
+            }
+
+
+class RedisPresenceStore(BasePresenceStore):
+    """
+    Хранилище в Redis, общее для всех воркеров.
+
+    presence:conn:<user_id> - ZSET соединений со временем истечения,
+    presence:online         - ZSET пользователей с максимальным временем истечения,
+    presence:last_seen      - HASH user_id -> unix-время последней активности.
+    """
+    ONLINE_KEY = 'presence:online'
+    LAST_SEEN_KEY = 'presence:last_seen'
+
+    def __init__(self, url, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        import redis
+
+        self.redis = redis.Redis.from_url(url, socket_timeout=1)
+
+    def _connections_key(self, user_id):
+        return f'presence:conn:{user_id}'
+
+    def _register(self, pipe, user_id, connection_id, now):
+        key = self._connections_key(user_id)
+        expires_at = now + self.ttl
+        pipe.zadd(key, {connection_id: expires_at})
+        pipe.expire(key, self.ttl)
+        pipe.zadd(self.ONLINE_KEY, {user_id: expires_at}, gt=True)
+        pipe.hset(self.LAST_SEEN_KEY, user_id, now)
+
+    def connect(self, user_id, connection_id):
+        now = time.time()
+        key = self._connections_key(user_id)
+        pipe = self.redis.pipeline()
+        pipe.zremrangebyscore(key, '-inf', now)
+        pipe.zcard(key)
+        self._register(pipe, user_id, connection_id, now)
+        alive_before = pipe.execute()[1]
+        self._seen(user_id, timezone.now())
+        return alive_before == 0
+
+    def heartbeat(self, user_id, connection_id):
+        pipe = self.redis.pipeline()
+        self._register(pipe, user_id, connection_id, time.time())
+        pipe.execute()
+
+    def disconnect(self, user_id, connection_id):
+        now = time.time()
+        key = self._connections_key(user_id)
+        pipe = self.redis.pipeline()
+        pipe.zrem(key, connection_id)
+        pipe.zremrangebyscore(key, '-inf', now)
+        pipe.zcard(key)
+        pipe.hset(self.LAST_SEEN_KEY, user_id, now)
+        remaining = pipe.execute()[2]
+        if not remaining:
+            self.redis.zrem(self.ONLINE_KEY, user_id)
+        self._seen(user_id, timezone.now())
+        return not remaining
+
+    def touch(self, user_id):
+        self.redis.hset(self.LAST_SEEN_KEY, user_id, time.time())
+        super().touch(user_id)
+
+    def online_user_ids(self):
+        now = time.time()
+        pipe = self.redis.pipeline()
+        pipe.zremrangebyscore(self.ONLINE_KEY, '-inf', now)
+        pipe.zrange(self.ONLINE_KEY, 0, -1)
+        return {int(user_id) for user_id in pipe.execute()[1]}
+
+    def statuses(self, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        now = time.time()
+        pipe = self.redis.pipeline()
+        for user_id in user_ids:
+            pipe.zscore(self.ONLINE_KEY, user_id)
+        pipe.hmget(self.LAST_SEEN_KEY, user_ids)
+        *scores, last_seen = pipe.execute()
+        return {
+            user_id: (
+                score is not None and score > now,
+                datetime.fromtimestamp(float(seen), tz=dt_timezone.utc) if seen else None,
+            )
+            for user_id, score, seen in zip(user_ids, scores, last_seen)
+        }
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_presence_store():
+    """Хранилище присутствия процесса, созданное по настройке CHAT_PRESENCE"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                config = presence_settings()
+                options = (config['TTL'], config['FLUSH_INTERVAL'], config['FLUSH_BATCH_SIZE'])
+                if config['BACKEND'] == 'redis':
+                    _store = RedisPresenceStore(config['REDIS_URL'], *options)
+                else:
+                    _store = MemoryPresenceStore(*options)
+    return _store
+
+
+def reset_presence_store():
+    """Сбрасывает хранилище (для тестов и после смены настроек)"""
+    global _store
+    with _store_lock:
+        _store = None
+    presence_broadcaster.clear()
+
+
+def flush_last_seen(force=False):
+    """
+    Записывает накопленные last_seen и is_online в UserProfile одним bulk_update.
+    Без force пишет, только когда набралась пачка или прошел FLUSH_INTERVAL.
+    """
+    store = get_presence_store()
+    if not force and not store.flush_due():
+        return 0
+    pending = store.drain_pending()
+    if not pending:
+        return 0
+
+    statuses = store.statuses(pending)
+    profiles = list(UserProfile.objects.filter(user_id__in=pending))
+    for profile in profiles:
+        profile.last_seen = pending[profile.user_id]
+        profile.is_online = statuses[profile.user_id][0]
+    UserProfile.objects.bulk_update(profiles, ['last_seen', 'is_online'], batch_size=500)
+    return len(profiles)
+
+
+def apply_presence(profiles):
+    """Подставляет в профили is_online/last_seen из хранилища (без записи в БД)"""
+    statuses = get_presence_store().statuses([profile.user_id for profile in profiles])
+    for profile in profiles:
+        is_online, last_seen = statuses[profile.user_id]
+        profile.is_online = is_online
+        profile.last_seen = latest_seen(profile.last_seen, last_seen)
+    return profiles
+
+
+def latest_seen(stored, live):
+    """last_seen из БД или более новый из хранилища (еще не записанный пачкой)"""
+    if live and (stored is None or live > stored):
+        return live
+    return stored
+
+
+def watchers_group_name(user_id):
+    """Группа channel layer с соединениями собеседников пользователя"""
+    return f'presence_{user_id}'
+
+
+def room_watchers_group_name(room_id):
+    """Группа соединений, которые следят за статусами всех участников большой комнаты"""
+    return f'presence_room_{room_id}'
+
+
+def is_large_room(member_ids):
+    return len(member_ids) > presence_settings()['ROOM_WATCH_SIZE']
+
+
+def status_groups(user_id):
+    """Группы для публикации статуса пользователя: его наблюдатели и его большие комнаты"""
+    groups = [watchers_group_name(user_id)]
+    for room_id in sorted(user_room_ids(user_id)):
+        if is_large_room(room_member_ids(room_id)):
+            groups.append(room_watchers_group_name(room_id))
+    return groups
+
+
+class PresenceBroadcaster:
+    """
+    Публикация смен статуса в памяти процесса. publish(is_online) - корутина
+    рассылки в группу наблюдателей; вызывается только при смене статуса,
+    который видят собеседники.
+    """
+
+    def __init__(self):
+        self._online = set()
+        self._timers = {}
+        self.published = 0
+        self.suppressed = 0
+
+    async def online(self, user_id, publish):
+        timer = self._timers.pop(user_id, None)
+        if timer is not None:
+            # Переподключение в пределах GRACE: уход так и не был опубликован
+            timer.cancel()
+        if user_id in self._online:
+            self.suppressed += 1
+            return
+        self._online.add(user_id)
+        self.published += 1
+        await publish(True)
+
+    async def offline(self, user_id, publish):
+        if user_id in self._timers:
+            return
+        grace = presence_settings()['GRACE']
+        if grace > 0:
+            self._timers[user_id] = asyncio.get_running_loop().create_task(
+                self._offline_later(user_id, grace, publish)
+            )
+        else:
+            await self._publish_offline(user_id, publish)
+
+    async def _offline_later(self, user_id, grace, publish):
+        await asyncio.sleep(grace)
+        if self._timers.get(user_id) is not asyncio.current_task():
+            return
+        del self._timers[user_id]
+        try:
+            await self._publish_offline(user_id, publish)
+        except Exception as e:
+            logger.error(f"Error publishing offline status: {e}")
+
+    async def _publish_offline(self, user_id, publish):
+        self._online.discard(user_id)
+        # Пользователь мог переподключиться к другому воркеру
+        statuses = await sync_to_async(get_presence_store().statuses, thread_sensitive=False)([user_id])
+        if statuses[user_id][0]:
+            self.suppressed += 1
+            return
+        self.published += 1
+        await publish(False)
+
+    def clear(self):
+        # Таймеры не отменяются: их цикл событий мог быть уже закрыт, а
+        # сработавший таймер без записи в _timers ничего не публикует
+        self._timers.clear()
+        self._online.clear()
+
+    def stats(self):
+        return {
+            'published': self.published,
+            'suppressed': self.suppressed,
+            'pending': len(self._timers),
+        }
+
+
+presence_broadcaster = PresenceBroadcaster()
+
+
+def notify_membership_change(room_ids):
+    """
+    После входа в комнату или выхода из нее соединения участников пересчитывают
+    подписки на статусы для этой комнаты (кадр presence_watch в группы комнат).
+    """
+    from channels.layers import get_channel_layer
+
+    from .consumers import room_group_name
+
+    layer = get_channel_layer()
+    if layer is None:
+        return
+    try:
+        for room_id in room_ids:
+            async_to_sync(layer.group_send)(room_group_name(room_id), {'type': 'presence_watch', 'room_id': room_id})
+    except Exception as e:
+        logger.error(f"Error notifying membership change: {e}")
@@ -0,0 +1,175 @@
+"""
+Ограничение частоты входящих кадров WebSocket (token bucket).
+
+Три уровня: соединение (все кадры одного сокета), пользователь (все кадры
+всех его соединений) и комната (сообщения в комнату от всех участников).
+Корзина соединения всегда в памяти процесса; корзины пользователя и
+комнаты — в памяти или в Redis (BACKEND='redis'), чтобы лимит действовал
+на все процессы Daphne. База данных не используется.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULTS = {
+    'ENABLED': True,
+    'BACKEND': 'memory',
+    'REDIS_URL': 'redis://127.0.0.1:6379/0',
+    # RATE - кадров в секунду, BURST - емкость корзины
+    'CONNECTION': {'RATE': 10, 'BURST': 20},
+    'USER': {'RATE': 20, 'BURST': 40},
+    'ROOM': {'RATE': 50, 'BURST': 100},
+}
+
+
+def rate_limit_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_RATE_LIMITS', {})}
+
+
+class MemoryBuckets:
+    """Корзины в памяти процесса; давно полные корзины удаляются"""
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def consume(self, key, rate, burst, cost=1):
+        """(разрешено ли, через сколько секунд хватит токенов)"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, _, _ = self._buckets.get(key, (burst, now, rate, burst))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now, rate, burst)
+            if len(self._buckets) > self.max_size:
+                self._evict_full(now)
+        return allowed, 0.0 if allowed else (cost - tokens) / rate
+
+    def _evict_full(self, now):
+        # Корзина, которая уже успела бы наполниться, ничем не отличается от новой
+        for key, (tokens, updated, rate, burst) in list(self._buckets.items()):
+            if tokens + (now - updated) * rate >= burst:
+                del self._buckets[key]
+
+    def discard(self, key):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class RedisBuckets:
+    """
+    Корзины в Redis, общие для всех процессов: ratelimit:<key> - HASH
+    (tokens, ts). Пополнение и списание выполняются одним Lua-скриптом
+    по часам Redis.
+    """
+
+    SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+    def __init__(self, url):
+        import redis
+
+        self.redis = redis.Redis.from_url(url, socket_timeout=1)
+        self._consume = self.redis.register_script(self.SCRIPT)
+
+    def consume(self, key, rate, burst, cost=1):
+        allowed, tokens = self._consume(keys=[f'ratelimit:{key}'], args=[rate, burst, cost])
+        if allowed:
+            return True, 0.0
+        return False, (cost - float(tokens)) / rate
+
+    def clear(self):
+        keys = list(self.redis.scan_iter('ratelimit:*'))
+        if keys:
+            self.redis.delete(*keys)
+
+
+class RateLimiter:
+    def __init__(self, config):
+        self.config = config
+        self.connections = MemoryBuckets()
+        if config['BACKEND'] == 'redis':
+            self.shared = RedisBuckets(config['REDIS_URL'])
+        else:
+            self.shared = self.connections
+
+    def check(self, scope, key):
+        """
+        Списывает токен из корзины scope ('CONNECTION', 'USER' или 'ROOM').
+        Возвращает (разрешено ли, retry_after в секундах).
+        """
+        limits = self.config[scope]
+        buckets = self.connections if scope == 'CONNECTION' else self.shared
+        try:
+            return buckets.consume(f'{scope.lower()}:{key}', limits['RATE'], limits['BURST'])
+        except Exception as e:
+            # Недоступное хранилище не должно ронять чат: пропускаем кадр
+            logger.error(f"Rate limit check failed: {e}")
+            return True, 0.0
+
+    @property
+    def is_shared(self):
+        return self.shared is not self.connections
+
+    def release_connection(self, connection_id):
+        self.connections.discard(f'connection:{connection_id}')
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Ограничитель процесса по настройке CHAT_RATE_LIMITS; None, если выключен"""
+    global _limiter
+    config = rate_limit_settings()
+    if not config['ENABLED']:
+        return None
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = RateLimiter(config)
+    return _limiter
+
+
+def release_rate_limits(connection_id):
+    """Удаляет корзину закрытого соединения"""
+    limiter = get_rate_limiter()
+    if limiter is not None:
+        limiter.release_connection(connection_id)
+
+
+def reset_rate_limiter():
+    """Сбрасывает ограничитель (для тестов и после смены настроек)"""
+    global _limiter
+    with _limiter_lock:
+        _limiter = None
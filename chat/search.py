@@ -0,0 +1,148 @@
+"""
+Полнотекстовый поиск по сообщениям.
+
+Индекс поддерживается самой базой: в SQLite это FTS5-таблица с триггерами
+на chat_message, в PostgreSQL — GIN-индекс по to_tsvector(content)
+(см. миграцию 0007_message_search_index). Бэкенд выбирается по
+настройке CHAT_SEARCH_BACKEND или по типу базы данных; для остальных баз
+поиск идет через icontains без индекса и ранжирования.
+"""
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from .models import ChatRoom, Message
+
+
+FTS_TABLE = 'chat_message_fts'
+# Глубже результаты не отдаются: OFFSET в индексе все равно перебирает строки
+MAX_OFFSET = 1000
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+class SearchOffsetError(ValueError):
+    """Смещение больше MAX_OFFSET"""
+
+
+def _user_rooms_sql():
+    """Подзапрос с ID комнат пользователя (параметр - user_id)"""
+    through = ChatRoom.participants.through._meta.db_table
+    return f'SELECT chatroom_id FROM {through} WHERE user_id = %s'
+
+
+class BaseSearchBackend:
+    def search(self, user, query, room_id=None, limit=20, offset=0):
+        """
+        Возвращает ID сообщений из комнат пользователя, отсортированные
+        по релевантности: не больше limit штук, начиная с offset.
+        """
+        raise NotImplementedError
+
+    def _scope(self, user, room_id):
+        sql = f'm.room_id IN ({_user_rooms_sql()})'
+        params = [user.id]
+        if room_id is not None:
+            sql += ' AND m.room_id = %s'
+            params.append(room_id)
+        return sql, params
+
+
+class SQLiteFTSBackend(BaseSearchBackend):
+    """SQLite FTS5 с ранжированием bm25"""
+
+    @staticmethod
+    def match_expression(query):
+        # Каждое слово в кавычках: синтаксис FTS5 из пользовательского ввода
+        # не интерпретируется, слова объединяются через AND, последнее - по префиксу
+        words = _WORD_RE.findall(query)
+        if not words:
+            return None
+        terms = [f'"{word}"' for word in words]
+        terms[-1] += '*'
+        return ' '.join(terms)
+
+    def search(self, user, query, room_id=None, limit=20, offset=0):
+        match = self.match_expression(query)
+        if match is None:
+            return []
+        scope_sql, scope_params = self._scope(user, room_id)
+        sql = (
+            f'SELECT m.id FROM {FTS_TABLE} f '
+            f'JOIN {Message._meta.db_table} m ON m.id = f.rowid '
+            f'WHERE {FTS_TABLE} MATCH %s AND {scope_sql} '
+            f'ORDER BY bm25({FTS_TABLE}), m.id DESC LIMIT %s OFFSET %s'
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [match, *scope_params, limit, offset])
+            return [row[0] for row in cursor.fetchall()]
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """PostgreSQL tsvector/tsquery с ранжированием ts_rank"""
+
+    config = 'simple'
+
+    def search(self, user, query, room_id=None, limit=20, offset=0):
+        if not _WORD_RE.search(query):
+            return []
+        scope_sql, scope_params = self._scope(user, room_id)
+        # Выражение совпадает с индексом из миграции, иначе GIN не используется
+        vector = f"to_tsvector('{self.config}', m.content)"
+        sql = (
+            f"SELECT m.id FROM {Message._meta.db_table} m, "
+            f"plainto_tsquery('{self.config}', %s) q "
+            f'WHERE {vector} @@ q AND {scope_sql} '
+            f'ORDER BY ts_rank({vector}, q) DESC, m.id DESC LIMIT %s OFFSET %s'
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [query, *scope_params, limit, offset])
+            return [row[0] for row in cursor.fetchall()]
+
+
+class IContainsSearchBackend(BaseSearchBackend):
+    """Запасной вариант без индекса: все слова через icontains, новые сообщения первыми"""
+
+    def search(self, user, query, room_id=None, limit=20, offset=0):
+        words = _WORD_RE.findall(query)
+        if not words:
+            return []
+        queryset = Message.objects.filter(
+            room_id__in=ChatRoom.participants.through.objects.filter(user_id=user.id).values('chatroom_id')
+        )
+        if room_id is not None:
+            queryset = queryset.filter(room_id=room_id)
+        for word in words:
+            queryset = queryset.filter(content__icontains=word)
+        return list(queryset.order_by('-id').values_list('id', flat=True)[offset:offset + limit])
+
+
+BACKENDS = {
+    'sqlite': SQLiteFTSBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def get_search_backend():
+    path = getattr(settings, 'CHAT_SEARCH_BACKEND', None)
+    if path:
+        return import_string(path)()
+    return BACKENDS.get(connection.vendor, IContainsSearchBackend)()
+
+
+def search_messages(user, query, room_id=None, limit=20, offset=0):
+    """
+    Поиск сообщений в комнатах пользователя.
+    Возвращает (сообщения в порядке релевантности, есть ли еще результаты).
+    Смещение больше MAX_OFFSET - SearchOffsetError; страница, которая
+    доходит до MAX_OFFSET, последняя.
+    """
+    if offset > MAX_OFFSET:
+        raise SearchOffsetError(f'Смещение больше {MAX_OFFSET}')
+    ids = get_search_backend().search(user, query, room_id=room_id, limit=limit + 1, offset=offset)
+    has_more = len(ids) > limit and offset + limit < MAX_OFFSET
+    ids = ids[:limit]
+    messages = Message.objects.filter(id__in=ids).select_related('user').in_bulk()
+    return [messages[message_id] for message_id in ids if message_id in messages], has_more
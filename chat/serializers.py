@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
-from .models import ChatRoom, Message, UserProfile
+from .membership import is_member
+from .models import ChatRoom, Message, ReadReceipt, UserProfile
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -17,6 +18,19 @@ class UserProfileSerializer(serializers.ModelSerializer):
         fields = ['user', 'is_online', 'last_seen', 'avatar']
 
 
+class ChatRoomListSerializer(serializers.ListSerializer):
+    """Считает непрочитанные сообщения для всего списка комнат одним запросом"""
+
+    def to_representation(self, data):
+        rooms = list(data.all() if hasattr(data, 'all') else data)
+        request = self.context.get('request')
+        if request:
+            self.context['unread_counts'] = ChatRoom.unread_counts_for(
+                request.user, [room.id for room in rooms]
+            )
+        return super().to_representation(rooms)
+
+
 class ChatRoomSerializer(serializers.ModelSerializer):
     participants = UserSerializer(many=True, read_only=True)
     participants_count = serializers.SerializerMethodField()
@@ -29,9 +43,10 @@ class ChatRoomSerializer(serializers.ModelSerializer):
             'id', 'name', 'description', 'chat_type', 'created_at', 
             'participants', 'participants_count', 'other_participant', 'unread_count'
         ]
+        list_serializer_class = ChatRoomListSerializer
 
     def get_participants_count(self, obj):
-        return obj.participants.count()
+        return len(obj.participants.all())
         
     def get_other_participant(self, obj):
         """Для прямых чатов возвращает другого участника"""
@@ -46,24 +61,52 @@ class ChatRoomSerializer(serializers.ModelSerializer):
         """Количество непрочитанных сообщений для текущего пользователя"""
         request = self.context.get('request')
         if request:
-            return Message.objects.filter(
-                room=obj,
-                is_read=False
-            ).exclude(user=request.user).count()
+            unread_counts = self.context.get('unread_counts')
+            if unread_counts is not None and obj.id in unread_counts:
+                return unread_counts[obj.id]
+            return obj.unread_count_for(request.user)
         return 0
 
 
 class MessageSerializer(serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
     user_username = serializers.CharField(source='user.username', read_only=True)
+    is_read = serializers.SerializerMethodField()
 
     class Meta:
         model = Message
         fields = ['id', 'room', 'user', 'user_username', 'content', 'timestamp', 'is_read']
         read_only_fields = ['user', 'timestamp']
 
+    def get_is_read(self, obj):
+        """
+        Свое сообщение прочитано, если его прочитал кто-то из собеседников,
+        чужое — если его прочитал текущий пользователь.
+        """
+        request = self.context.get('request')
+        if not request:
+            return False
+        # Водяные знаки кэшируются в контексте: один запрос на комнату, а не на сообщение
+        watermarks = self.context.setdefault('read_watermarks', {})
+        if obj.room_id not in watermarks:
+            watermarks[obj.room_id] = ReadReceipt.watermarks(obj.room_id, request.user)
+        return message_is_read(obj.id, obj.user_id, request.user.id, *watermarks[obj.room_id])
+
+
+def message_is_read(message_id, author_id, user_id, own, peers):
+    """is_read для читателя user_id по водяным знакам комнаты (own, peers)"""
+    if author_id == user_id:
+        return message_id <= peers
+    return message_id <= own
+
 
 class CreateMessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
-        fields = ['room', 'content']
\ No newline at end of file
+        fields = ['room', 'content']
+
+    def validate_room(self, room):
+        request = self.context.get('request')
+        if request is not None and not is_member(request.user.id, room.id):
+            raise serializers.ValidationError('Вы не участник этой комнаты')
+        return room
\ No newline at end of file
@@ -0,0 +1,169 @@
+"""
+Синхронизация после переподключения: что изменилось с момента курсора.
+
+Курсор - непрозрачная строка (base64 JSON) с моментом времени сервера `t`,
+на который клиент уже синхронизирован, и, если ответ не уместил все новые
+сообщения, ключом (timestamp, id) последнего отданного сообщения `a`.
+Следующий курсор всегда не меньше предыдущего. Клиент, который получал
+сообщения по WebSocket, может вместо курсора передать timestamp последнего
+из них.
+
+Изменения выбираются с запасом SKEW секунд до `t`: при отложенной записи
+сообщение попадает в базу позже своего timestamp, а часы воркеров могут
+немного расходиться. Поэтому клиент должен пропускать уже известные
+сообщения по id - так же, как при повторе кадров chat_message.
+"""
+import base64
+import binascii
+import json
+from datetime import timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .membership import user_room_ids
+from .models import ChatRoom, MembershipChange, Message, ReadReceipt
+from .pagination import InvalidCursor
+from .presence import get_presence_store
+
+
+DEFAULTS = {
+    'SKEW': 5.0,
+    'MESSAGE_LIMIT': 500,
+    'REPLAY_LIMIT': 200,
+}
+
+
+def sync_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_SYNC', {})}
+
+
+def encode_cursor(synced_at, anchor=None):
+    data = {'t': synced_at.isoformat()}
+    if anchor is not None:
+        data['a'] = [anchor.timestamp.isoformat(), anchor.id]
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    (момент синхронизации, (timestamp, id) или None). Вместо курсора можно
+    передать время ISO 8601, например timestamp последнего полученного кадра.
+    """
+    try:
+        moment = parse_datetime(cursor) if cursor[:1].isdigit() else None
+    except ValueError:
+        raise InvalidCursor('Неверный курсор синхронизации')
+    if moment is not None:
+        if timezone.is_naive(moment):
+            moment = timezone.make_aware(moment, dt_timezone.utc)
+        return moment, None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        synced_at = parse_datetime(data['t'])
+        anchor = data.get('a')
+        if anchor is not None:
+            anchor = parse_datetime(anchor[0]), int(anchor[1])
+            if anchor[0] is None:
+                raise ValueError
+    except (binascii.Error, AttributeError, ValueError, TypeError, KeyError, IndexError):
+        raise InvalidCursor('Неверный курсор синхронизации')
+    if synced_at is None:
+        raise InvalidCursor('Неверный курсор синхронизации')
+    return synced_at, anchor
+
+
+def initial_cursor():
+    """Курсор "сейчас" для клиента, который только что загрузил все данные"""
+    return encode_cursor(timezone.now())
+
+
+def messages_since(room_ids, cursor, limit):
+    """
+    Новые сообщения комнат после курсора, от старых к новым.
+    Возвращает (сообщения, has_more, следующий курсор).
+    """
+    now = timezone.now()
+    synced_at, anchor = decode_cursor(cursor)
+    since = synced_at - timedelta(seconds=sync_settings()['SKEW'])
+    queryset = Message.objects.filter(room_id__in=room_ids, timestamp__gt=since)
+    if anchor is not None:
+        timestamp, message_id = anchor
+        queryset = queryset.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=message_id))
+    messages = list(queryset.select_related('user').order_by('timestamp', 'id')[:limit + 1])
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if has_more:
+        # Время синхронизации не двигается, пока не отданы все сообщения
+        return messages, True, encode_cursor(synced_at, messages[-1])
+    return messages, False, encode_cursor(max(now, synced_at))
+
+
+def changes_since(user, cursor):
+    """
+    Изменения для пользователя после курсора: сообщения, вход и выход из
+    комнат (своих и чужих в его комнатах), водяные знаки прочтения и
+    присутствие участников его комнат.
+    """
+    synced_at, _ = decode_cursor(cursor)
+    since = synced_at - timedelta(seconds=sync_settings()['SKEW'])
+    room_ids = user_room_ids(user.id)
+
+    messages, has_more, next_cursor = messages_since(room_ids, cursor, sync_settings()['MESSAGE_LIMIT'])
+
+    own_changes = {}
+    member_changes = []
+    for change in MembershipChange.objects.filter(
+        Q(user=user) | Q(room_id__in=room_ids), created_at__gt=since
+    ).order_by('id'):
+        if change.user_id == user.id:
+            # Важно только последнее состояние
+            own_changes[change.room_id] = change.joined
+        else:
+            member_changes.append({'room_id': change.room_id, 'user_id': change.user_id, 'joined': change.joined})
+    joined = [room_id for room_id, state in own_changes.items() if state and room_id in room_ids]
+    left = [room_id for room_id, state in own_changes.items() if not state and room_id not in room_ids]
+
+    receipts = list(ReadReceipt.objects.filter(
+        room_id__in=room_ids, updated_at__gt=since
+    ).values('room_id', 'user_id', 'last_read_message_id'))
+
+    peer_ids = set(ChatRoom.participants.through.objects.filter(
+        chatroom_id__in=room_ids
+    ).exclude(user_id=user.id).values_list('user_id', flat=True))
+    presence = []
+    for user_id, (is_online, last_seen) in sorted(get_presence_store().statuses(peer_ids).items()):
+        if is_online or (last_seen is not None and last_seen > since):
+            presence.append({'user_id': user_id, 'is_online': is_online, 'last_seen': last_seen})
+
+    return {
+        'cursor': next_cursor,
+        'has_more': has_more,
+        'messages': messages,
+        'rooms_joined': ChatRoom.objects.filter(id__in=joined).prefetch_related('participants'),
+        'rooms_left': sorted(left),
+        'members': member_changes,
+        'read_receipts': receipts,
+        'presence': presence,
+    }
+
+
+def replay_frames(room_ids, cursor):
+    """
+    Кадры chat_message, пропущенные с момента курсора (для resume в WebSocket).
+    Возвращает (кадры, has_more, следующий курсор).
+    """
+    messages, has_more, next_cursor = messages_since(room_ids, cursor, sync_settings()['REPLAY_LIMIT'])
+    frames = [{
+        'type': 'chat_message',
+        'room_id': message.room_id,
+        'message_id': message.id,
+        'message': message.content,
+        'user_id': message.user_id,
+        'username': message.user.username,
+        'timestamp': message.timestamp.isoformat(),
+        'replayed': True,
+    } for message in messages]
+    return frames, has_more, next_cursor
@@ -1,3 +1,1566 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import importlib
+import io
+import json
+import os
+import tempfile
+import time
+import warnings
+from datetime import timedelta
+from importlib.util import find_spec
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from django.apps import apps as django_apps
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient, APITestCase
+
+from .models import ArchiveSegment, ChatRoom, Message, ReadReceipt, UserProfile
+from minichat.databases import build_databases
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .consumers import ChatConsumer
+from .codec import CODECS, encode_frame, get_codec, group_event
+from .exporter import export_lines, export_queryset
+from .search import IContainsSearchBackend, get_search_backend
+from .importer import MessageImporter
+from .membership import RedisMembershipCache, is_member, reset_membership_cache, room_member_ids, user_room_ids
+from .metrics import get_registry, reset_registry
+from .outbound import OutboundQueue, RedisUnackedStore, outbound_stats, reset_unacked_store
+from .sync import encode_cursor
+from .history_cache import MemoryHistoryCache, get_history_cache, reset_history_cache
+from .middleware import JWTAuthMiddleware, token_user_cache
+from .pagination import keyset_page
+from .persistence import MessageIdAllocator, MessageWriteBehind, lifespan, message_id_allocator
+from .ratelimit import MemoryBuckets, reset_rate_limiter
+from .routing import websocket_urlpatterns
+from .typing import TypingTracker
+from .presence import MemoryPresenceStore, flush_last_seen, get_presence_store, reset_presence_store
+
+
+class ChatTestMixin:
+    """Общие фикстуры для тестов чата"""
+
+    def create_user(self, username):
+        return User.objects.create_user(username=username, password='testpass123')
+
+    def create_room(self, *users, chat_type='group'):
+        room = ChatRoom.objects.create(name='Комната', chat_type=chat_type)
+        room.participants.add(*users)
+        return room
+
+    def create_messages(self, room, user, count):
+        return Message.objects.bulk_create(
+            Message(room=room, user=user, content=f'Сообщение {i}') for i in range(count)
+        )
+
+
+class MessageHistoryPaginationTests(ChatTestMixin, APITestCase):
+    def setUp(self):
+        reset_history_cache()
+        self.alice = self.create_user('alice')
+        self.bob = self.create_user('bob')
+        self.room = self.create_room(self.alice, self.bob)
+        self.messages = self.create_messages(self.room, self.bob, 7)
+        self.client.force_authenticate(self.alice)
+
+    def history(self, **params):
+        return self.client.get(f'/api/chat/rooms/{self.room.id}/history/', params)
+
+    def test_latest_page_is_newest_first(self):
+        response = self.history(limit=3)
+        self.assertEqual(response.status_code, 200)
+        ids = [m['id'] for m in response.data['messages']]
+        self.assertEqual(ids, [m.id for m in reversed(self.messages)][:3])
+        self.assertTrue(response.data['has_more'])
+        self.assertEqual(response.data['next_before'], ids[-1])
+
+    def test_before_cursor_walks_whole_history(self):
+        seen = []
+        before = None
+        while True:
+            params = {'limit': 3}
+            if before:
+                params['before'] = before
+            response = self.history(**params)
+            seen.extend(m['id'] for m in response.data['messages'])
+            if not response.data['has_more']:
+                break
+            before = response.data['next_before']
+        self.assertEqual(seen, [m.id for m in reversed(self.messages)])
+
+    def test_after_cursor_ascending(self):
+        response = self.history(after=self.messages[4].id, order='asc')
+        ids = [m['id'] for m in response.data['messages']]
+        self.assertEqual(ids, [self.messages[5].id, self.messages[6].id])
+        self.assertFalse(response.data['has_more'])
+
+    def test_limit_is_bounded(self):
+        response = self.history(limit=10_000)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['messages']), 7)
+
+    def test_invalid_cursor(self):
+        response = self.history(before='not-a-cursor')
+        self.assertEqual(response.status_code, 400)
+        response = self.history(before='2024-13-45T00:00:00')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/chat/messages/', {'room': self.room.id, 'after': '2024-02-30T00:00:00'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_message_list_is_paginated(self):
+        response = self.client.get('/api/chat/messages/', {'room': self.room.id, 'limit': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertTrue(response.data['has_more'])
+
+
+class ReadReceiptTests(ChatTestMixin, APITestCase):
+    def setUp(self):
+        reset_history_cache()
+        self.alice = self.create_user('alice')
+        self.bob = self.create_user('bob')
+        self.carol = self.create_user('carol')
+        self.room = self.create_room(self.alice, self.bob, self.carol)
+        self.messages = self.create_messages(self.room, self.bob, 3)
+
+    def test_watermark_only_moves_forward(self):
+        latest = ReadReceipt.mark_read(self.alice, self.room.id)
+        self.assertEqual(latest, self.messages[-1].id)
+        ReadReceipt.mark_read(self.alice, self.room.id, self.messages[0].id)
+        receipt = ReadReceipt.objects.get(user=self.alice, room=self.room)
+        self.assertEqual(receipt.last_read_message_id, latest)
+
+    def test_watermarks_are_one_indexed_query(self):
+        from django.test.utils import CaptureQueriesContext
+
+        self.assertEqual(ReadReceipt.watermarks(self.room.id, self.alice), (0, 0))
+        ReadReceipt.mark_read(self.alice, self.room.id, self.messages[0].id)
+        ReadReceipt.mark_read(self.bob, self.room.id, self.messages[2].id)
+        ReadReceipt.mark_read(self.carol, self.room.id, self.messages[1].id)
+        with CaptureQueriesContext(connection) as ctx:
+            watermarks = ReadReceipt.watermarks(self.room.id, self.alice)
+        self.assertEqual(watermarks, (self.messages[0].id, self.messages[2].id))
+        self.assertEqual(ReadReceipt.watermarks(self.room.id, self.bob), (self.messages[2].id, self.messages[1].id))
+        self.assertEqual(len(ctx.captured_queries), 1)
+        plan = connection.cursor().execute('EXPLAIN QUERY PLAN ' + ctx.captured_queries[0]['sql']).fetchall()
+        self.assertIn('chat_receipt_room_last_idx', str(plan))
+
+    def test_unread_count_is_per_user(self):
+        ReadReceipt.mark_read(self.alice, self.room.id)
+        self.assertEqual(self.room.unread_count_for(self.alice), 0)
+        self.assertEqual(self.room.unread_count_for(self.carol), 3)
+        self.assertEqual(self.room.unread_count_for(self.bob), 0)
+
+    def test_unread_counts_for_many_rooms(self):
+        rooms = ChatRoom.objects.bulk_create(ChatRoom(name=f'room {i}') for i in range(1200))
+        Message.objects.bulk_create(
+            Message(room=room, user=self.bob, content=str(i)) for room in rooms for i in range(2)
+        )
+        ReadReceipt.mark_read(self.alice, rooms[0].id)
+        first = Message.objects.filter(room=rooms[1]).order_by('id').first()
+        ReadReceipt.mark_read(self.alice, rooms[1].id, first.id)
+
+        room_ids = [room.id for room in rooms] + [self.room.id]
+        with self.assertNumQueries(1):
+            counts = ChatRoom.unread_counts_for(self.alice, room_ids)
+        self.assertEqual(len(counts), 1201)
+        self.assertEqual((counts[rooms[0].id], counts[rooms[1].id], counts[rooms[-1].id]), (0, 1, 2))
+        self.assertEqual(counts[self.room.id], 3)
+        self.assertEqual(sum(counts.values()), 2 * 1198 + 1 + 3)
+
+    def test_history_marks_read_for_caller_only(self):
+        self.client.force_authenticate(self.alice)
+        response = self.client.get(f'/api/chat/rooms/{self.room.id}/history/')
+        self.assertTrue(all(m['is_read'] for m in response.data['messages']))
+        self.assertEqual(self.room.unread_count_for(self.carol), 3)
+
+        self.client.force_authenticate(self.bob)
+        response = self.client.get(f'/api/chat/rooms/{self.room.id}/history/')
+        # Свои сообщения bob видит прочитанными, т.к. их прочитала alice
+        self.assertTrue(all(m['is_read'] for m in response.data['messages']))
+
+
+class RoomListQueryCountTests(ChatTestMixin, APITestCase):
+    def setUp(self):
+        reset_membership_cache()
+        self.alice = self.create_user('alice')
+        self.client.force_authenticate(self.alice)
+
+    def add_rooms(self, count):
+        for i in range(count):
+            other = self.create_user(f'user{ChatRoom.objects.count()}')
+            room = self.create_room(self.alice, other, chat_type='direct')
+            self.create_messages(room, other, 2)
+
+    def count_queries(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/chat/rooms/')
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response
+
+    def test_query_count_is_constant(self):
+        self.add_rooms(2)
+        small, _ = self.count_queries()
+        self.add_rooms(20)
+        large, response = self.count_queries()
+        self.assertEqual(small, large)
+        self.assertEqual(len(response.data), 22)
+        # Повторный запрос берет комнаты пользователя из кэша членства
+        warm, _ = self.count_queries()
+        self.assertEqual(warm, large - 1)
+        self.assertLessEqual(warm, 4)
+
+    def test_room_fields_from_batched_data(self):
+        self.add_rooms(1)
+        room = ChatRoom.objects.get()
+        ReadReceipt.mark_read(self.alice, room.id, room.messages.first().id)
+        _, response = self.count_queries()
+        data = response.data[0]
+        self.assertEqual(data['participants_count'], 2)
+        self.assertEqual(data['unread_count'], 1)
+        self.assertEqual(data['other_participant']['username'], 'user0')
+
+
+class MemoryPresenceStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.store = MemoryPresenceStore(ttl=90, flush_interval=30, flush_batch_size=500)
+
+    def test_second_tab_keeps_user_online(self):
+        self.assertTrue(self.store.connect(1, 'tab-1'))
+        self.assertFalse(self.store.connect(1, 'tab-2'))
+        self.assertFalse(self.store.disconnect(1, 'tab-1'))
+        self.assertEqual(self.store.online_user_ids(), {1})
+        self.assertTrue(self.store.disconnect(1, 'tab-2'))
+        self.assertEqual(self.store.online_user_ids(), set())
+
+    def test_connection_expires_without_heartbeat(self):
+        self.store.ttl = -1
+        self.store.connect(1, 'tab-1')
+        self.assertEqual(self.store.online_user_ids(), set())
+        self.assertFalse(self.store.statuses([1])[1][0])
+
+
+class PresenceViewTests(ChatTestMixin, APITestCase):
+    def setUp(self):
+        reset_presence_store()
+        self.alice = self.create_user('alice')
+        self.bob = self.create_user('bob')
+        self.room = self.create_room(self.alice, self.bob)
+        self.client.force_authenticate(self.alice)
+
+    def tearDown(self):
+        reset_presence_store()
+
+    def test_online_users_served_from_store(self):
+        get_presence_store().connect(self.bob.id, 'tab-1')
+        response = self.client.get('/api/chat/online-users/')
+        self.assertEqual([p['user']['id'] for p in response.data], [self.bob.id])
+        self.assertFalse(UserProfile.objects.get(user=self.bob).is_online)
+
+        response = self.client.get(f'/api/chat/rooms/{self.room.id}/participants/')
+        online = {p['id']: p['is_online'] for p in response.data['participants']}
+        self.assertEqual(online, {self.alice.id: False, self.bob.id: True})
+
+    def test_last_seen_flushed_in_batch(self):
+        store = get_presence_store()
+        store.connect(self.bob.id, 'tab-1')
+        store.disconnect(self.alice.id, 'tab-2')
+        self.assertEqual(flush_last_seen(force=True), 2)
+        self.assertTrue(UserProfile.objects.get(user=self.bob).is_online)
+        self.assertEqual(flush_last_seen(force=True), 0)
+
+
+class UserChatConsumerTests(ChatTestMixin, TransactionTestCase):
+    def setUp(self):
+        reset_presence_store()
+        self.alice = self.create_user('alice')
+        self.bob = self.create_user('bob')
+        self.first = self.create_room(self.alice, self.bob)
+        self.second = self.create_room(self.alice, self.bob)
+        self.foreign = self.create_room(self.bob)
+
+    def tearDown(self):
+        reset_presence_store()
+
+    async def open(self, user, path='/ws/chat/'):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path)
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive_type(self, communicator, frame_type):
+        while True:
+            frame = await communicator.receive_json_from()
+            if frame['type'] == frame_type:
+                return frame
+
+    async def test_one_socket_receives_all_rooms(self):
+        alice = await self.open(self.alice)
+        subscribed = await alice.receive_json_from()
+        self.assertEqual(subscribed['room_ids'], sorted([self.first.id, self.second.id]))
+
+        bob = await self.open(self.bob, f'/ws/chat/{self.second.id}/')
+        await bob.send_json_to({'type': 'chat_message', 'message': 'Привет'})
+        event = await self.receive_type(alice, 'chat_message')
+        self.assertEqual(event['room_id'], self.second.id)
+        await self.receive_type(bob, 'chat_message')  # собственное сообщение bob
+
+        await alice.send_json_to({'type': 'chat_message', 'room_id': self.second.id, 'message': 'Ответ'})
+        event = await self.receive_type(bob, 'chat_message')
+        self.assertEqual(event['message'], 'Ответ')
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_subscribe_requires_membership(self):
+        alice = await self.open(self.alice)
+        await alice.receive_json_from()
+        await alice.send_json_to({'type': 'subscribe', 'room_id': self.foreign.id})
+        self.assertEqual((await alice.receive_json_from())['type'], 'error')
+        await alice.send_json_to({'type': 'chat_message', 'room_id': self.foreign.id, 'message': 'x'})
+        self.assertEqual((await alice.receive_json_from())['type'], 'error')
+        await alice.disconnect()
+
+    async def test_leaving_room_drops_subscription(self):
+        alice = await self.open(self.alice)
+        await alice.receive_json_from()
+        single = await self.open(self.alice, f'/ws/chat/{self.first.id}/')
+        await database_sync_to_async(self.first.participants.remove)(self.alice)
+
+        frame = await self.receive_type(alice, 'unsubscribed')
+        self.assertEqual(frame['room_ids'], [self.first.id])
+        self.assertEqual((await single.receive_output())['type'], 'websocket.close')
+        await alice.send_json_to({'type': 'chat_message', 'room_id': self.first.id, 'message': 'x'})
+        self.assertEqual((await alice.receive_json_from())['type'], 'error')
+
+        bob = await self.open(self.bob, f'/ws/chat/{self.first.id}/')
+        await bob.send_json_to({'type': 'chat_message', 'message': 'без alice'})
+        await self.receive_type(bob, 'chat_message')
+        frames = []
+        while not await alice.receive_nothing():
+            frames.append((await alice.receive_json_from())['type'])
+        self.assertNotIn('chat_message', frames)
+        self.assertFalse(await database_sync_to_async(
+            Message.objects.filter(room=self.first, user=self.alice).exists
+        )())
+        await alice.disconnect()
+        await single.disconnect()
+        await bob.disconnect()
+
+
+    async def test_frame_encoded_once_per_group_send(self):
+        alice = await self.open(self.alice, f'/ws/chat/{self.first.id}/')
+        bob = await self.open(self.bob, f'/ws/chat/{self.first.id}/')
+        with mock.patch('chat.codec.encode_frame', wraps=encode_frame) as encode:
+            await bob.send_json_to({'type': 'chat_message', 'message': 'Один кадр'})
+            received = [await self.receive_type(c, 'chat_message') for c in (alice, bob)]
+        self.assertEqual(encode.call_count, 1)
+        self.assertEqual(received[0], received[1])
+        await alice.disconnect()
+        await bob.disconnect()
+
+
+class JSONCodecTests(SimpleTestCase):
+    def test_codecs_produce_same_frame(self):
+        frame = {'type': 'chat_message', 'message': 'Привет', 'message_id': 1}
+        for name in [name for name in CODECS if name == 'json' or find_spec(name)]:
+            self.assertEqual(json.loads(get_codec(name)(frame)), frame)
+
+    @skipUnless(find_spec('orjson'), 'orjson не установлен')
+    @override_settings(CHAT_JSON_CODEC='orjson')
+    def test_group_event_uses_configured_codec(self):
+        event = group_event('chat_message', {'type': 'chat_message', 'message': 'Привет'}, user_id=1)
+        self.assertEqual(event['type'], 'chat_message')
+        self.assertEqual(event['user_id'], 1)
+        self.assertEqual(event['frame'], '{"type":"chat_message","message":"Привет"}')
+
+    @override_settings(CHAT_JSON_CODEC='xml')
+    def test_unknown_codec(self):
+        with self.assertRaises(ImproperlyConfigured):
+            encode_frame({})
+
+
+@override_settings(CHAT_TYPING={'STOP_DELAY': 0.05, 'TTL': 0.2})
+class TypingTrackerTests(SimpleTestCase):
+    def setUp(self):
+        self.tracker = TypingTracker()
+        self.sent = []
+
+    async def broadcast(self, is_typing):
+        self.sent.append(is_typing)
+
+    async def test_keystrokes_coalesce_into_start_and_stop(self):
+        for _ in range(10):
+            await self.tracker.update(1, 1, True, self.broadcast)
+        await self.tracker.update(1, 1, False, self.broadcast)
+        await self.tracker.update(1, 1, True, self.broadcast)  # отменяет отложенную остановку
+        await self.tracker.update(1, 1, False, self.broadcast)
+        await self.tracker.update(1, 1, False, self.broadcast)
+        self.assertEqual(self.sent, [True])
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.sent, [True, False])
+        self.assertEqual(self.tracker.stats()['suppressed'], 12)
+
+    async def test_stale_state_expires(self):
+        await self.tracker.update(1, 1, True, self.broadcast)
+        await asyncio.sleep(0.3)
+        self.assertEqual(self.sent, [True, False])
+        self.assertFalse(self.tracker.is_typing(1, 1))
+        self.assertEqual(self.tracker.stats()['expired'], 1)
+
+    async def test_disconnect_stops_typing(self):
+        await self.tracker.update(1, 1, True, self.broadcast)
+        await self.tracker.update(1, 2, True, self.broadcast)
+        await self.tracker.clear(1, [1, 2, 3])
+        self.assertEqual(self.sent, [True, True, False, False])
+        self.assertEqual(self.tracker.stats()['active'], 0)
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_burst_then_refill(self):
+        buckets = MemoryBuckets()
+        with mock.patch('chat.ratelimit.time.monotonic', return_value=100.0):
+            results = [buckets.consume('user:1', rate=2, burst=3)[0] for _ in range(4)]
+            allowed, retry_after = buckets.consume('user:1', rate=2, burst=3)
+        self.assertEqual(results, [True, True, True, False])
+        self.assertAlmostEqual(retry_after, 0.5)
+        with mock.patch('chat.ratelimit.time.monotonic', return_value=100.5):
+            self.assertTrue(buckets.consume('user:1', rate=2, burst=3)[0])
+            self.assertTrue(buckets.consume('user:2', rate=2, burst=3)[0])
+
+    def test_full_buckets_are_evicted(self):
+        buckets = MemoryBuckets(max_size=1)
+        with mock.patch('chat.ratelimit.time.monotonic', return_value=0.0):
+            buckets.consume('a', rate=1, burst=10)
+        with mock.patch('chat.ratelimit.time.monotonic', return_value=100.0):
+            buckets.consume('b', rate=1, burst=10)
+        self.assertEqual(list(buckets._buckets), ['b'])
+
+
+@override_settings(CHAT_RATE_LIMITS={
+    'CONNECTION': {'RATE': 0.01, 'BURST': 3},
+    'USER': {'RATE': 0.01, 'BURST': 100},
+    'ROOM': {'RATE': 0.01, 'BURST': 1},
+})
+class RateLimitConsumerTests(ChatTestMixin, TransactionTestCase):
+    def setUp(self):
+        reset_rate_limiter()
+        self.alice = self.create_user('alice')
+        self.bob = self.create_user('bob')
+        self.room = self.create_room(self.alice, self.bob)
+
+    def tearDown(self):
+        reset_rate_limiter()
+
+    async def open(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chat/{self.room.id}/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def next_error(self, communicator):
+        while True:
+            frame = await communicator.receive_json_from()
+            if frame['type'] == 'error':
+                return frame
+
+    async def test_room_and_connection_limits(self):
+        alice = await self.open(self.alice)
+        bob = await self.open(self.bob)
+        await alice.send_json_to({'type': 'chat_message', 'message': 'Первое'})
+        await bob.send_json_to({'type': 'chat_message', 'message': 'Второе'})
+        error = await self.next_error(bob)
+        self.assertEqual((error['code'], error['scope']), ('rate_limited', 'room'))
+        self.assertGreater(error['retry_after'], 0)
+
+        for _ in range(2):
+            await alice.send_json_to({'type': 'heartbeat'})
+        await alice.send_to(text_data='не JSON')
+        error = await self.next_error(alice)
+        self.assertEqual(error['scope'], 'connection')
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 1)
+        await alice.disconnect()
+        await bob.disconnect()
+
+
+class JWTAuthMiddlewareTests(ChatTestMixin, TransactionTestCase):
+    def setUp(self):
+        token_user_cache.clear()
+        self.alice = self.create_user('alice')
+        self.token = str(AccessToken.for_user(self.alice))
+
+        async def inner(scope, receive, send):
+            self.scope_user = scope['user']
+        self.middleware = JWTAuthMiddleware(inner)
+
+    def tearDown(self):
+        token_user_cache.clear()
+
+    async def handshake(self, token):
+        await self.middleware({'type': 'websocket', 'query_string': f'token={token}'.encode()}, None, None)
+        return self.scope_user
+
+    async def test_repeat_handshake_skips_database(self):
+        with mock.patch.object(JWTAuthMiddleware, 'load_user', wraps=self.middleware.load_user) as load_user:
+            first = await self.handshake(self.token)
+            second = await self.handshake(self.token)
+        self.assertEqual((first.id, second.id), (self.alice.id, self.alice.id))
+        self.assertEqual(load_user.call_count, 1)
+
+    async def test_user_change_evicts_cache(self):
+        await self.handshake(self.token)
+        self.alice.is_active = False
+        await self.alice.asave()
+        user = await self.handshake(self.token)
+        self.assertFalse(user.is_authenticated)
+
+    async def test_invalid_token_is_anonymous(self):
+        user = await self.handshake('not-a-token')
+        self.assertFalse(user.is_authenticated)
+
+
+@override_settings(CHAT_WRITE_BEHIND={'ENABLED': True, 'FLUSH_SIZE': 2})
+class WriteBehindTests(ChatTestMixin, TransactionTestCase):
+    def setUp(self):
+        self.alice = self.create_user('alice')
+        self.room = self.create_room(self.alice)
+        self.pipeline = MessageWriteBehind()
+        message_id_allocator.reset()
+        self.addCleanup(message_id_allocator.reset)
+
+    def new_message(self, content):
+        return Message(
+            id=message_id_allocator.allocate(), room_id=self.room.id, user=self.alice,
+            content=content, timestamp=timezone.now(),
+        )
+
+    def history_ids(self):
+        page, _, _ = keyset_page(
+            Message.objects.filter(room=self.room),
+            pending=self.pipeline.pending_for_room(self.room.id),
+        )
+        return [m.id for m in page]
+
+    async def test_pending_messages_visible_until_flushed(self):
+        queued = [await sync_to_async(self.new_message)(f'm{i}') for i in range(3)]
+        for message in queued:
+            await self.pipeline.enqueue(message)
+        expected = [m.id for m in reversed(queued)]
+        self.assertEqual(await sync_to_async(self.history_ids)(), expected)
+
+        await self.pipeline.close()
+        self.assertEqual(self.pipeline.pending_count(), 0)
+        self.assertEqual(await sync_to_async(self.history_ids)(), expected)
+
+    async def test_unwritable_messages_are_dropped(self):
+        gone = await database_sync_to_async(self.create_room)(self.alice)
+        existing = await database_sync_to_async(Message.objects.create)(room=self.room, user=self.alice, content='есть')
+        queued = [await sync_to_async(self.new_message)(f'm{i}') for i in range(4)]
+        queued[1].room_id = gone.id
+        queued[2].id = existing.id
+        await database_sync_to_async(gone.delete)()
+        for message in queued:
+            await self.pipeline.enqueue(message)
+
+        with self.assertLogs('chat.persistence', 'ERROR') as logs:
+            await self.pipeline.close()
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual((self.pipeline.pending_count(), self.pipeline.failed), (0, 2))
+        self.assertEqual(await sync_to_async(self.history_ids)(), [queued[3].id, queued[0].id, existing.id])
+        # Уже записанное сообщение при повторе не считается ошибкой
+        self.assertEqual(await database_sync_to_async(self.pipeline._write)([queued[0]]), [])
+
+    async def test_shutdown_writes_pending_messages(self):
+        first = await sync_to_async(self.new_message)('до остановки')
+        await self.pipeline.enqueue(first)
+        events = iter([{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+        sent = []
+
+        async def receive():
+            return next(events)
+
+        async def send(event):
+            sent.append(event['type'])
+
+        with mock.patch('chat.persistence.message_write_behind', self.pipeline):
+            await lifespan({'type': 'lifespan'}, receive, send)
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertEqual(self.pipeline.pending_count(), 0)
+
+        # Без lifespan остаток дописывается при выходе процесса
+        second = await sync_to_async(self.new_message)('при выходе')
+        await self.pipeline.enqueue(second)
+        self.pipeline._task.cancel()
+        await database_sync_to_async(self.pipeline.flush_sync)()
+        self.assertEqual(await sync_to_async(self.history_ids)(), [second.id, first.id])
+
+    def test_unwritten_blocks_cap_read_marks(self):
+        bob = self.create_user('bob')
+        self.room.participants.add(bob)
+        # Отдельные аллокаторы - как в разных воркерах
+        first, second = MessageIdAllocator(), MessageIdAllocator()
+        early = first.allocate()
+        late = second.allocate()
+        with self.assertNumQueries(0):
+            self.assertEqual(first.take(), early + 1)
+        self.assertGreater(late, early + 1)
+
+        # Второй воркер записал свое сообщение раньше, чем первый - свои
+        Message.objects.bulk_create([Message(id=late, room=self.room, user=self.alice, content='позже')])
+        second.retire(force=True)
+        second.release(set())
+        self.assertLess(ReadReceipt.mark_read(bob, self.room.id, late), early)
+        # Блок с незаписанным ID не освобождается
+        first.retire(force=True)
+        first.release({early + 1})
+        self.assertLess(ReadReceipt.mark_read(bob, self.room.id), early)
+
+        Message.objects.bulk_create([
+            Message(id=message_id, room=self.room, user=self.alice, content='раньше')
+            for message_id in (early, early + 1)
+        ])
+        first.release(set())
+        self.assertEqual(ReadReceipt.mark_read(bob, self.room.id), late)
+        self.assertEqual(ChatRoom.unread_counts_for(bob, [self.room.id]), {self.room.id: 0})
+
+    def test_regular_saves_use_allocator(self):
+        reserved = self.new_message('в очереди')
+        created = Message.objects.create(room=self.room, user=self.alice, content='REST')
+        self.assertGreater(created.id, reserved.id)
+
+
+class MessageSearchTests(ChatTestMixin, APITestCase):
+    def setUp(self):
+        self.alice = self.create_user('alice')
+        self.bob = self.create_user('bob')
+        self.room = self.create_room(self.alice, self.bob)
+        self.foreign = self.create_room(self.bob)
+        Message.objects.create(room=self.room, user=self.bob, content='Встречаемся завтра в офисе')
+        Message.objects.create(room=self.room, user=self.bob, content='Офис закрыт, офис на ремонте')
+        Message.objects.create(room=self.foreign, user=self.bob, content='Секретный офис')
+        self.client.force_authenticate(self.alice)
+
+    def search(self, **params):
+        return self.client.get('/api/chat/messages/search/', params)
+
+    def test_search_is_ranked_and_scoped_to_rooms(self):
+        response = self.search(q='ОФИС')
+        self.assertEqual(response.status_code, 200)
+        contents = [m['content'] for m in response.data['results']]
+        self.assertEqual(contents, ['Офис закрыт, офис на ремонте', 'Встречаемся завтра в офисе'])
+
+    def test_prefix_and_pagination(self):
+        response = self.search(q='офи', limit=1)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['next_offset'], 1)
+        response = self.search(q='офи', limit=1, offset=1)
+        self.assertFalse(response.data['has_more'])
+
+    def test_pagination_stops_at_max_offset(self):
+        Message.objects.bulk_create(Message(room=self.room, user=self.bob, content='офис') for _ in range(5))
+        with mock.patch('chat.search.MAX_OFFSET', 3):
+            offset, pages = 0, 0
+            while offset is not None:
+                response = self.search(q='офис', limit=2, offset=offset)
+                offset = response.data['next_offset']
+                pages += 1
+            self.assertEqual(pages, 2)
+            self.assertEqual(self.search(q='офис', offset=4).status_code, 400)
+
+    def test_unsupported_database_falls_back_to_icontains(self):
+        with mock.patch.object(connection, 'vendor', 'mysql'):
+            self.assertIsInstance(get_search_backend(), IContainsSearchBackend)
+            response = self.search(q='офис ремонт')
+        self.assertEqual([m['content'] for m in response.data['results']], ['Офис закрыт, офис на ремонте'])
+
+    def test_index_follows_edits(self):
+        message = Message.objects.get(content__startswith='Встречаемся')
+        message.content = 'Перенесли встречу'
+        message.save()
+        self.assertEqual(len(self.search(q='завтра').data['results']), 0)
+        self.assertEqual(len(self.search(q='встречу').data['results']), 1)
+
+    def test_fts_syntax_is_not_interpreted(self):
+        response = self.search(q='офис" OR *')
+        self.assertEqual(response.status_code, 200)
+
+
+class HistoryCacheTests(ChatTestMixin, APITestCase):
+    def setUp(self):
+        reset_history_cache()
+        self.alice = self.create_user('alice')
+        self.bob = self.create_user('bob')
+        self.room = self.create_room(self.alice, self.bob)
+        self.create_messages(self.room, self.bob, 3)
+        self.client.force_authenticate(self.alice)
+
+    def history(self, **params):
+        return self.client.get(f'/api/chat/rooms/{self.room.id}/history/', params)
+
+    def test_ring_buffer_keeps_last_messages(self):
+        cache = MemoryHistoryCache(size=3, max_rooms=2, ttl=60)
+        cache.store(1, [{'id': 1}, {'id': 2}], False, cache.generation(1))
+        for message_id in (3, 4):
+            cache.append(1, {'id': message_id})
+        self.assertEqual(cache.get(1), ([{'id': 2}, {'id': 3}, {'id': 4}], True))
+
+        # Буфер, прочитанный до появления нового сообщения, не записывается
+        generation = cache.generation(2)
+        cache.append(2, {'id': 5})
+        self.assertFalse(cache.store(2, [], False, generation))
+        self.assertIsNone(cache.get(2))
+
+        cache.store(2, [], False, cache.generation(2))
+        cache.store(3, [], False, cache.generation(3))
+        self.assertIsNone(cache.get(1))
+
+    def test_memory_buffer_expires(self):
+        cache = MemoryHistoryCache(size=3, max_rooms=2, ttl=60)
+        cache.store(1, [{'id': 1}], False, cache.generation(1))
+        with mock.patch('chat.history_cache.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.get(1))
+        self.assertIsNone(cache.get(1))
+
+    def test_hot_room_serves_from_cache(self):
+        self.history()
+        Message.objects.create(room=self.room, user=self.bob, content='Новое')
+        self.assertEqual(get_history_cache().get(self.room.id)[0][-1]['content'], 'Новое')
+
+        # Горячая комната: ни выборки сообщений, ни сериализации
+        with mock.patch('chat.views.history_with_archive', side_effect=AssertionError), \
+                mock.patch('chat.views.MessageSerializer', side_effect=AssertionError):
+            response = self.history(limit=2)
+        self.assertEqual([m['content'] for m in response.data['messages']], ['Новое', 'Сообщение 2'])
+        self.assertTrue(response.data['has_more'])
+
+    def test_cached_page_matches_database_page(self):
+        cold = self.history().data
+        warm = self.history().data
+        self.assertEqual(cold['messages'], warm['messages'])
+        self.assertEqual(cold['next_before'], warm['next_before'])
+
+    def test_edit_and_delete_invalidate(self):
+        self.history()
+        message = Message.objects.create(room=self.room, user=self.bob, content='Черновик')
+        message.content = 'Исправлено'
+        message.save()
+        self.assertIsNone(get_history_cache().get(self.room.id))
+        self.assertEqual(self.history().data['messages'][0]['content'], 'Исправлено')
+
+        message.delete()
+        self.assertIsNone(get_history_cache().get(self.room.id))
+        self.assertEqual(self.history().data['messages'][0]['content'], 'Сообщение 2')
+
+
+class MessageImportTests(ChatTestMixin, APITestCase):
+    def setUp(self):
+        reset_history_cache()
+        self.admin = User.objects.create_superuser('admin', password='testpass123')
+        self.alice = self.create_user('alice')
+        self.bob = self.create_user('bob')
+        self.room = self.create_room(self.alice, self.bob)
+        self.other = self.create_room(self.bob)
+
+    def jsonl(self, *rows):
+        return '\n'.join(row if isinstance(row, str) else json.dumps(row) for row in rows)
+
+    def test_import_validates_membership_and_reports(self):
+        self.client.force_authenticate(self.admin)
+        body = self.jsonl(
+            {'room': self.room.id, 'user': self.alice.id, 'content': 'Первое', 'timestamp': '2020-01-01T10:00:00'},
+            {'room': self.room.id, 'username': 'bob', 'content': 'Второе'},
+            {'room': self.other.id, 'user': self.alice.id, 'content': 'Чужая комната'},
+            '{broken',
+            {'room': self.room.id, 'username': 'nobody', 'content': 'x'},
+        )
+        response = self.client.post(
+            '/api/chat/messages/import/?batch_size=2', body, content_type='application/x-ndjson'
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.data['imported'], response.data['skipped']), (2, 3))
+        self.assertEqual([e['line'] for e in response.data['errors']], [4, 3, 5])
+        first = Message.objects.get(content='Первое')
+        self.assertEqual(first.timestamp.year, 2020)
+
+    def test_bad_timestamp_and_encoding_are_skipped(self):
+        lines = [
+            self.jsonl({'room': self.room.id, 'user': self.alice.id, 'content': 'a', 'timestamp': '2024-02-30T00:00:00'}).encode(),
+            'Привет'.encode('cp1251'),
+            self.jsonl({'room': self.room.id, 'user': self.alice.id, 'content': 'b'}).encode(),
+        ]
+        report = MessageImporter().run(lines)
+        self.assertEqual((report['imported'], report['skipped']), (1, 2))
+        self.assertEqual(
+            report['errors'], [{'line': 1, 'error': 'Неверное время'}, {'line': 2, 'error': 'Строка не в кодировке UTF-8'}]
+        )
+
+    def test_imported_history_is_not_unread(self):
+        carol = self.create_user('carol')
+        self.room.participants.add(carol)
+        live = self.create_messages(self.room, self.alice, 2)
+        ReadReceipt.mark_read(self.bob, self.room.id)
+        ReadReceipt.mark_read(carol, self.room.id, live[0].id)
+
+        MessageImporter().run([
+            self.jsonl({'room': self.room.id, 'user': self.alice.id, 'content': f'old {i}', 'timestamp': '2020-01-01T10:00:00'})
+            for i in range(3)
+        ])
+        self.assertEqual(self.room.unread_count_for(self.bob), 0)
+        # У carol есть непрочитанное живое сообщение: ее знак не сдвигается
+        self.assertEqual(self.room.unread_count_for(carol), 4)
+        # Пустая до импорта комната прочитана всеми участниками
+        MessageImporter().run([self.jsonl({'room': self.other.id, 'user': self.bob.id, 'content': 'x'})])
+        receipt = ReadReceipt.objects.get(room=self.other, user=self.bob)
+        self.assertEqual(receipt.last_read_message_id, Message.objects.get(content='x').id)
+
+    def test_import_requires_admin(self):
+        self.client.force_authenticate(self.alice)
+        response = self.client.post('/api/chat/messages/import/', '', content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 403)
+
+    def test_queries_per_batch_are_constant(self):
+        rows = [{'room': self.room.id, 'username': 'bob', 'content': f'm{i}'} for i in range(50)]
+        # На пачку: пользователи, участники, последний ID комнат, INSERT, водяные
+        # знаки (чтение, участники, UPDATE) и точка сохранения (2 запроса)
+        with self.assertNumQueries(18):
+            report = MessageImporter(batch_size=25).run(self.jsonl(*rows).splitlines())
+        self.assertEqual(report['imported'], 50)
+
+    @override_settings(CHAT_WRITE_BEHIND={'ENABLED': True})
+    def test_import_takes_ids_from_allocator(self):
+        message_id_allocator.reset()
+        self.addCleanup(message_id_allocator.reset)
+        queued = message_id_allocator.allocate()
+        MessageImporter().run([self.jsonl({'room': self.room.id, 'user': self.bob.id, 'content': 'x'})])
+        self.assertGreater(Message.objects.get(content='x').id, queued)
+
+    def test_management_command(self):
+        with tempfile.NamedTemporaryFile('wb', suffix='.jsonl', delete=False) as f:
+            f.write(self.jsonl({'room': self.room.id, 'user': self.bob.id, 'content': 'Из файла'}).encode())
+            f.write(b'\n\xff\xfe\n')
+        self.addCleanup(os.remove, f.name)
+        out = io.StringIO()
+        call_command('import_messages', f.name, stdout=out, stderr=io.StringIO())
+        self.assertIn('импортировано 1, пропущено 1', out.getvalue())
+        self.assertTrue(Message.objects.filter(content='Из файла').exists())
+
+
+class MessageExportTests(ChatTestMixin, APITestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', password='testpass123')
+        self.alice = self.create_user('alice')
+        self.bob = self.create_user('bob')
+        self.room = self.create_room(self.alice, self.bob)
+        self.other = self.create_room(self.bob)
+        self.create_messages(self.room, self.alice, 3)
+        Message.objects.create(room=self.room, user=self.bob, content='Ответ, с "кавычками"')
+        Message.objects.create(room=self.other, user=self.bob, content='Другая комната')
+        self.client.force_authenticate(self.admin)
+
+    def export(self, **params):
+        response = self.client.get('/api/chat/messages/export/', params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_jsonl_with_filters(self):
+        rows = [json.loads(line) for line in self.export(room=self.room.id).splitlines()]
+        self.assertEqual([row['content'] for row in rows][-1], 'Ответ, с "кавычками"')
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[0]['username'], 'alice')
+
+        rows = self.export(room=self.room.id, user=self.bob.id).splitlines()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(self.export(since='2100-01-01T00:00:00Z'), '')
+
+    def test_csv(self):
+        rows = list(csv.reader(io.StringIO(self.export(output='csv', user=self.bob.id))))
+        self.assertEqual(rows[0], ['id', 'room', 'user', 'username', 'content', 'timestamp'])
+        self.assertEqual([row[4] for row in rows[1:]], ['Ответ, с "кавычками"', 'Другая комната'])
+
+    def test_rows_are_streamed_from_cursor(self):
+        queryset = export_queryset(room_id=self.room.id)
+        with mock.patch.object(type(queryset), 'iterator', wraps=queryset.iterator) as iterator:
+            lines = export_lines(queryset, chunk_size=2)
+            next(lines)
+        iterator.assert_called_once_with(chunk_size=2)
+
+    async def test_asgi_response_is_not_buffered(self):
+        token = await sync_to_async(AccessToken.for_user)(self.admin)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            response = await self.async_client.get(
+                '/api/chat/messages/export/', {'room': self.room.id},
+                headers={'Authorization': f'Bearer {token}'},
+            )
+            self.assertTrue(response.is_async)
+            content = b''.join([chunk async for chunk in response])
+        self.assertEqual(len(content.decode().splitlines()), 4)
+        self.assertEqual([str(w.message) for w in caught if 'StreamingHttpResponse' in str(w.message)], [])
+
+    def test_invalid_params_and_permissions(self):
+        response = self.client.get('/api/chat/messages/export/', {'since': 'вчера'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/chat/messages/export/', {'until': '2024-02-30T00:00:00'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/chat/messages/export/', {'output': 'xml'})
+        self.assertEqual(response.status_code, 400)
+        self.client.force_authenticate(self.alice)
+        self.assertEqual(self.client.get('/api/chat/messages/export/').status_code, 403)
+
+    def test_management_command(self):
+        out = io.StringIO()
+        call_command('export_messages', '--user', 'bob', '--format', 'jsonl', stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 2)
+
+
+class DirectChatTests(ChatTestMixin, APITestCase):
+    def setUp(self):
+        self.alice = self.create_user('alice')
+        self.bob = self.create_user('bob')
+        self.client.force_authenticate(self.alice)
+
+    def create_direct(self):
+        return self.client.post('/api/chat/create-direct-chat/', {'user_id': self.bob.id})
+
+    def test_create_is_idempotent(self):
+        first = self.create_direct()
+        self.assertEqual(first.status_code, 201)
+        self.client.force_authenticate(self.bob)
+        second = self.client.post('/api/chat/create-direct-chat/', {'user_id': self.alice.id})
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(first.data['room']['id'], second.data['room']['id'])
+        room = ChatRoom.objects.get()
+        self.assertEqual(room.direct_key, ChatRoom.direct_pair_key(self.bob.id, self.alice.id))
+
+    def test_existing_chat_restores_participant(self):
+        room_id = self.create_direct().data['room']['id']
+        self.client.post(f'/api/chat/rooms/{room_id}/leave/')
+        self.assertEqual(self.create_direct().status_code, 200)
+        self.assertTrue(ChatRoom.objects.filter(id=room_id, participants=self.alice).exists())
+
+        self.client.force_authenticate(self.create_user('carol'))
+        self.assertEqual(self.client.post(f'/api/chat/rooms/{room_id}/join/').status_code, 400)
+
+    def test_migration_merges_duplicates(self):
+        migration = importlib.import_module('chat.migrations.0008_chatroom_direct_key')
+        rooms = [self.create_room(self.alice, self.bob, chat_type='direct') for _ in range(3)]
+        group = self.create_room(self.alice, self.bob)
+        for room in rooms:
+            Message.objects.create(room=room, user=self.bob, content=f'В комнате {room.id}')
+        ReadReceipt.mark_read(self.alice, rooms[1].id)
+
+        migration.merge_direct_rooms(django_apps, None)
+
+        keeper = ChatRoom.objects.get(direct_key__isnull=False)
+        self.assertEqual(keeper.id, rooms[0].id)
+        self.assertEqual(keeper.messages.count(), 3)
+        self.assertEqual(ReadReceipt.watermarks(keeper.id, self.alice)[0], Message.objects.get(content=f'В комнате {rooms[1].id}').id)
+        self.assertEqual(set(ChatRoom.objects.values_list('id', flat=True)), {keeper.id, group.id})
+
+
+class MetricsTests(ChatTestMixin, APITestCase):
+    def setUp(self):
+        reset_registry()
+        reset_history_cache()
+        self.alice = self.create_user('alice')
+        self.room = self.create_room(self.alice)
+        self.create_messages(self.room, self.alice, 3)
+        self.client.force_authenticate(self.alice)
+
+    def tearDown(self):
+        reset_registry()
+
+    def scrape(self):
+        admin = User.objects.create_superuser('admin', password='adminpass123')
+        self.client.force_authenticate(admin)
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def test_request_recorded_per_endpoint(self):
+        self.client.get(f'/api/chat/rooms/{self.room.id}/history/')
+        self.client.get('/api/chat/rooms/')
+        text = self.scrape()
+        labels = '{endpoint="chat-history",method="GET"}'
+        self.assertIn(f'chat_http_duration_seconds_count{labels} 1', text)
+        self.assertIn(f'chat_http_responses_total{{endpoint="chat-history",method="GET",status="200"}} 1', text)
+        queries = [line for line in text.splitlines() if line.startswith(f'chat_http_db_queries_sum{labels}')]
+        self.assertGreater(float(queries[0].split()[-1]), 0)
+        self.assertIn('endpoint="room-list-create"', text)
+        self.assertIn('chat_typing_frames_total{result="forwarded"}', text)
+
+    def test_access(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.client.force_authenticate(None)
+        with override_settings(CHAT_METRICS={'TOKEN': 'secret'}):
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+
+    @override_settings(CHAT_METRICS={'SLOW_MS': 0})
+    def test_slow_request_logged_with_sql(self):
+        with self.assertLogs('chat.metrics', 'WARNING') as logs:
+            self.client.get(f'/api/chat/rooms/{self.room.id}/history/')
+        self.assertIn('endpoint=chat-history', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+    @override_settings(CHAT_METRICS={'ENABLED': False})
+    def test_disabled(self):
+        self.client.get('/api/chat/rooms/')
+        self.assertIsNone(get_registry())
+        self.client.force_authenticate(User.objects.create_superuser('admin', password='adminpass123'))
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+
+class MetricsConsumerTests(ChatTestMixin, TransactionTestCase):
+    def setUp(self):
+        reset_registry()
+        reset_presence_store()
+        self.alice = self.create_user('alice')
+        self.room = self.create_room(self.alice)
+
+    def tearDown(self):
+        reset_registry()
+        reset_presence_store()
+
+    async def test_frames_recorded_by_type(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chat/{self.room.id}/')
+        communicator.scope['user'] = self.alice
+        await communicator.connect()
+        await communicator.send_json_to({'type': 'chat_message', 'message': 'Привет'})
+        await communicator.receive_json_from()
+        await communicator.send_json_to({'type': 'nonsense'})
+        await communicator.disconnect()
+
+        text = get_registry().render()
+        self.assertIn('chat_ws_duration_seconds_count{event="frame:chat_message"} 1', text)
+        self.assertIn('chat_ws_duration_seconds_count{event="frame:unknown"} 1', text)
+        self.assertIn('chat_ws_errors_total{event="websocket.disconnect"} 0', text)
+        queries = [line for line in text.splitlines() if line.startswith('chat_ws_db_queries_sum{event="frame:chat_message"}')]
+        self.assertGreater(float(queries[0].split()[-1]), 0)
+        sent = [line for line in text.splitlines() if line.startswith('chat_ws_response_bytes_total{event="chat_message"}')]
+        self.assertGreater(int(sent[0].split()[-1]), 0)
+
+
+class BenchmarkBaselineTests(SimpleTestCase):
+    def test_baseline_matches_report_schema(self):
+        from django.conf import settings
+
+        from .management.commands.bench_load import REPORT_SCHEMA
+
+        with open(os.path.join(settings.BASE_DIR, 'benchmarks', 'baseline_memory.json'), encoding='utf-8') as f:
+            baseline = json.load(f)
+        # Эталон пересобирается при каждой смене формата отчета
+        self.assertEqual(baseline['schema'], REPORT_SCHEMA)
+        self.assertIn('presence', baseline)
+        self.assertIn('reconnects', baseline['config'])
+
+
+class DatabaseProfileTests(SimpleTestCase):
+    databases = {'default'}
+
+    def test_sqlite_profile(self):
+        database = build_databases('sqlite', {}, 'db.sqlite3')['default']
+        self.assertIn('PRAGMA journal_mode=WAL', database['OPTIONS']['init_command'])
+        self.assertEqual(database['OPTIONS']['transaction_mode'], 'IMMEDIATE')
+        plain = build_databases('sqlite', {'SQLITE_TUNING': '0'}, 'db.sqlite3')['default']
+        self.assertNotIn('OPTIONS', plain)
+
+    def test_postgres_profile(self):
+        pooled = build_databases('postgres', {'DATABASE_POOL_MAX': '50'}, None)['default']
+        self.assertEqual(pooled['CONN_MAX_AGE'], 0)
+        self.assertEqual(pooled['OPTIONS']['pool']['max_size'], 50)
+        persistent = build_databases('postgres', {'DATABASE_POOL': '0'}, None)['default']
+        self.assertEqual(persistent['CONN_MAX_AGE'], 60)
+        self.assertTrue(persistent['CONN_HEALTH_CHECKS'])
+        with self.assertRaises(ValueError):
+            build_databases('oracle', {}, None)
+
+    @skipUnless(connection.vendor == 'sqlite', 'SQLite')
+    def test_pragmas_applied_on_connect(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+
+
+class MembershipCacheTests(ChatTestMixin, TransactionTestCase):
+    def setUp(self):
+        reset_membership_cache()
+        self.alice = self.create_user('alice')
+        self.bob = self.create_user('bob')
+        self.room = self.create_room(self.alice)
+
+    def tearDown(self):
+        reset_membership_cache()
+
+    def test_m2m_changes_invalidate(self):
+        self.assertEqual(user_room_ids(self.bob.id), frozenset())
+        self.room.participants.add(self.bob)
+        self.assertEqual(user_room_ids(self.bob.id), {self.room.id})
+        self.bob.chat_rooms.remove(self.room)
+        self.assertEqual(user_room_ids(self.bob.id), frozenset())
+
+        user_room_ids(self.alice.id)
+        self.room.participants.clear()
+        self.assertEqual(user_room_ids(self.alice.id), frozenset())
+
+        self.room.participants.add(self.alice)
+        user_room_ids(self.alice.id)
+        self.room.delete()
+        self.assertEqual(user_room_ids(self.alice.id), frozenset())
+
+    @skipUnless(find_spec('fakeredis'), 'fakeredis не установлен')
+    def test_redis_invalidation_reaches_other_workers(self):
+        import fakeredis
+
+        server = fakeredis.FakeServer()
+        connect = mock.patch('redis.Redis.from_url', side_effect=lambda *args, **kwargs: fakeredis.FakeRedis(server=server))
+        with connect, override_settings(CHAT_MEMBERSHIP_CACHE={'BACKEND': 'redis'}):
+            reset_membership_cache()
+            # Кэш другого воркера: отдельный экземпляр с тем же Redis
+            other = RedisMembershipCache('redis://fake', ttl=300)
+            key = ('user', self.bob.id)
+            self.room.participants.add(self.bob)
+            generation = other.generation(key)
+            self.assertTrue(other.store(key, frozenset({self.room.id}), generation))
+
+            self.bob.chat_rooms.remove(self.room)
+            self.assertIsNone(other.get(key))
+            # Загрузка, начатая до сброса, не возвращает старое членство
+            self.assertFalse(other.store(key, frozenset({self.room.id}), generation))
+            self.assertFalse(is_member(self.bob.id, self.room.id))
+            reset_membership_cache()
+
+    def test_rest_access_uses_cache(self):
+        from django.test.utils import CaptureQueriesContext
+
+        client = APIClient()
+        client.force_authenticate(self.bob)
+        url = f'/api/chat/rooms/{self.room.id}/history/'
+        self.assertEqual(client.get(url).status_code, 404)
+        self.assertEqual(client.post(f'/api/chat/rooms/{self.room.id}/join/').status_code, 200)
+        self.assertEqual(client.get(url).status_code, 200)
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertTrue(is_member(self.bob.id, self.room.id))
+        self.assertEqual(len(ctx.captured_queries), 0)
+
+        response = client.post('/api/chat/messages/', {'room': self.room.id, 'content': 'Привет'})
+        self.assertEqual(response.status_code, 201)
+        client.post(f'/api/chat/rooms/{self.room.id}/leave/')
+        self.assertEqual(client.get(url).status_code, 404)
+        response = client.post('/api/chat/messages/', {'room': self.room.id, 'content': 'Еще'})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(CHAT_SYNC={'SKEW': 0, 'MESSAGE_LIMIT': 2})
+class SyncTests(ChatTestMixin, APITestCase):
+    def setUp(self):
+        reset_membership_cache()
+        reset_presence_store()
+        self.alice = self.create_user('alice')
+        self.bob = self.create_user('bob')
+        self.room = self.create_room(self.alice, self.bob)
+        self.client.force_authenticate(self.alice)
+        self.cursor = self.client.get('/api/chat/sync/').data['cursor']
+
+    def sync(self, cursor):
+        response = self.client.get('/api/chat/sync/', {'cursor': cursor})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_changes_since_cursor(self):
+        self.create_messages(self.room, self.bob, 3)
+        ReadReceipt.mark_read(self.bob, self.room.id)
+        other = self.create_room(self.bob)
+        other.participants.add(self.alice)
+        self.room.participants.remove(self.bob)
+        get_presence_store().connect(self.bob.id, 'bob-channel')
+
+        first = self.sync(self.cursor)
+        self.assertTrue(first['has_more'])
+        self.assertEqual([m['content'] for m in first['messages']], ['Сообщение 0', 'Сообщение 1'])
+        self.assertEqual([room['id'] for room in first['rooms_joined']], [other.id])
+        self.assertIn({'room_id': self.room.id, 'user_id': self.bob.id, 'joined': False}, first['members'])
+        self.assertEqual(first['read_receipts'][0]['user_id'], self.bob.id)
+        self.assertEqual([(p['user_id'], p['is_online']) for p in first['presence']], [(self.bob.id, True)])
+
+        second = self.sync(first['cursor'])
+        self.assertFalse(second['has_more'])
+        self.assertEqual([m['content'] for m in second['messages']], ['Сообщение 2'])
+
+        other.participants.remove(self.alice)
+        third = self.sync(second['cursor'])
+        self.assertEqual(third['messages'], [])
+        self.assertEqual(third['rooms_left'], [other.id])
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/chat/sync/', {'cursor': 'не курсор'})
+        self.assertEqual(response.status_code, 400)
+
+
+class ArchiveTests(ChatTestMixin, APITestCase):
+    def setUp(self):
+        reset_history_cache()
+        self.archive_dir = tempfile.mkdtemp()
+        settings_override = override_settings(CHAT_RETENTION={'ARCHIVE_DIR': self.archive_dir, 'PAUSE': 0})
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.alice = self.create_user('alice')
+        self.bob = self.create_user('bob')
+        self.room = self.create_room(self.alice, self.bob)
+        self.room.retention_days = 30
+        self.room.save()
+        self.messages = self.create_messages(self.room, self.bob, 10)
+        old = timezone.now() - timedelta(days=40)
+        for i, message in enumerate(self.messages[:7]):
+            Message.objects.filter(id=message.id).update(timestamp=old + timedelta(seconds=i))
+        self.client.force_authenticate(self.alice)
+
+    def archive(self, *args, **options):
+        output = io.StringIO()
+        call_command('archive_messages', *args, stdout=output, **options)
+        return output.getvalue()
+
+    def history(self, **params):
+        response = self.client.get(f'/api/chat/rooms/{self.room.id}/history/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_old_messages_moved_in_batches(self):
+        self.assertIn('К архивации сообщений: 7', self.archive('--dry-run'))
+        self.assertEqual(Message.objects.count(), 10)
+
+        self.assertIn('Архивировано сообщений: 7', self.archive(batch_size=3))
+        self.assertEqual(
+            list(Message.objects.order_by('id').values_list('id', flat=True)), [m.id for m in self.messages[7:]]
+        )
+        segments = list(ArchiveSegment.objects.order_by('first_timestamp'))
+        self.assertEqual([segment.message_count for segment in segments], [3, 3, 1])
+        with gzip.open(segments[0].path, 'rt', encoding='utf-8') as source:
+            self.assertEqual([json.loads(line)['id'] for line in source], [m.id for m in self.messages[:3]])
+
+        # Комнаты без срока хранения не трогаются
+        other = self.create_room(self.alice)
+        self.create_messages(other, self.alice, 2)
+        Message.objects.filter(room=other).update(timestamp=timezone.now() - timedelta(days=400))
+        self.assertIn('Архивировано сообщений: 0', self.archive())
+        self.assertIn('Архивировано сообщений: 2', self.archive(room=other.id, days=365))
+
+    def test_history_falls_back_to_archive(self):
+        self.archive(batch_size=3)
+        ReadReceipt.mark_read(self.alice, self.room.id)
+
+        seen = []
+        before = None
+        while True:
+            data = self.history(limit=4, **({'before': before} if before else {}))
+            seen.extend(data['messages'])
+            if not data['has_more']:
+                break
+            before = data['next_before']
+        self.assertEqual([m['id'] for m in seen], [m.id for m in reversed(self.messages)])
+        self.assertEqual(sum(m.get('archived', False) for m in seen), 7)
+        self.assertTrue(all(m['is_read'] for m in seen))
+        self.assertEqual(seen[-1]['user']['username'], 'bob')
+
+        data = self.history(after=self.messages[2].id, limit=5, order='asc')
+        self.assertEqual([m['id'] for m in data['messages']], [m.id for m in self.messages[3:8]])
+        self.assertTrue(data['has_more'])
+
+    def test_before_oldest_message_in_database(self):
+        # Архива нет: страница пустая
+        data = self.history(before=self.messages[0].id)
+        self.assertEqual((data['messages'], data['has_more']), ([], False))
+
+        self.archive(batch_size=3)
+        oldest = self.messages[7].id
+        data = self.history(before=oldest, limit=4)
+        self.assertEqual([m['id'] for m in data['messages']], [m.id for m in reversed(self.messages[3:7])])
+        self.assertTrue(all(m['archived'] for m in data['messages']))
+        self.assertTrue(data['has_more'])
+        data = self.history(before=oldest, limit=10)
+        self.assertEqual(len(data['messages']), 7)
+        self.assertFalse(data['has_more'])
+
+    def test_after_archived_cursor_continues_in_database(self):
+        self.archive(batch_size=3)
+        data = self.history(after=self.messages[5].id, limit=10, order='asc')
+        self.assertEqual([m['id'] for m in data['messages']], [m.id for m in self.messages[6:]])
+        self.assertEqual([m.get('archived', False) for m in data['messages']], [True, False, False, False])
+        self.assertFalse(data['has_more'])
+        self.assertEqual(data['next_after'], self.messages[-1].id)
+
+        data = self.history(after=self.messages[6].id, limit=2)
+        self.assertEqual([m['id'] for m in data['messages']], [m.id for m in reversed(self.messages[7:9])])
+        self.assertTrue(data['has_more'])
+
+
+class ResumeConsumerTests(ChatTestMixin, TransactionTestCase):
+    def setUp(self):
+        reset_membership_cache()
+        reset_presence_store()
+        self.alice = self.create_user('alice')
+        self.bob = self.create_user('bob')
+        self.room = self.create_room(self.alice, self.bob)
+
+    def tearDown(self):
+        reset_presence_store()
+
+    async def test_missed_messages_replayed(self):
+        cursor = encode_cursor(timezone.now())
+        await database_sync_to_async(self.create_messages)(self.room, self.bob, 2)
+
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chat/?cursor={cursor}')
+        communicator.scope['user'] = self.alice
+        await communicator.connect()
+        self.assertEqual((await communicator.receive_json_from())['type'], 'subscribed')
+        replayed = [await communicator.receive_json_from() for _ in range(2)]
+        self.assertEqual([frame['message'] for frame in replayed], ['Сообщение 0', 'Сообщение 1'])
+        self.assertTrue(all(frame['replayed'] for frame in replayed))
+        resumed = await communicator.receive_json_from()
+        self.assertEqual((resumed['type'], resumed['replayed'], resumed['has_more']), ('resumed', 2, False))
+        await communicator.disconnect()
+
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chat/{self.room.id}/?cursor=bad')
+        communicator.scope['user'] = self.alice
+        await communicator.connect()
+        self.assertEqual((await communicator.receive_json_from())['code'], 'invalid_cursor')
+        await communicator.disconnect()
+
+
+class OutboundQueueTests(SimpleTestCase):
+    def setUp(self):
+        self.sent = []
+        self.gate = asyncio.Event()
+
+    async def send(self, frame):
+        await self.gate.wait()
+        self.sent.append(frame)
+
+    async def test_droppable_frames_coalesce_and_make_room(self):
+        queue = OutboundQueue(self.send, max_frames=3)
+        queue.start()
+        self.assertTrue(queue.put('typing:1', key=('typing', 1, 1)))
+        self.assertTrue(queue.put('message:1'))
+        self.assertTrue(queue.put('typing:2', key=('typing', 1, 1)))  # заменяет typing:1
+        self.assertTrue(queue.put('status', key=('status', 1, 2)))
+        self.assertEqual(len(queue), 3)
+        # Полная очередь: сообщение вытесняет самый старый отбрасываемый кадр
+        self.assertTrue(queue.put('message:2'))
+        self.assertTrue(queue.put('typing:3', key=('typing', 1, 3)))  # отброшен
+        self.assertTrue(queue.put('message:3'))
+        # Отбрасывать больше нечего: соединение придется закрыть
+        self.assertFalse(queue.put('message:4'))
+
+        self.gate.set()
+        for _ in range(10):
+            await asyncio.sleep(0)
+        self.assertEqual(self.sent, ['message:1', 'message:2', 'message:3'])
+        await queue.stop()
+
+    async def test_send_error_closes_queue(self):
+        closed = asyncio.Event()
+
+        async def broken(frame):
+            raise RuntimeError('client gone')
+
+        async def on_error():
+            closed.set()
+
+        queue = OutboundQueue(broken, max_frames=3, on_error=on_error)
+        dropped = outbound_stats.stats()['dropped']
+        queue.put('message:1')
+        queue.put('message:2')
+        queue.start()
+        with self.assertLogs('chat.outbound', 'WARNING'):
+            await asyncio.wait_for(closed.wait(), 1)
+        self.assertTrue(queue.closed)
+        self.assertEqual((len(queue), outbound_stats.stats()['dropped'] - dropped), (0, 2))
+        await queue.stop()
+
+    @skipUnless(find_spec('fakeredis'), 'fakeredis не установлен')
+    def test_redis_store_keeps_newest_frames(self):
+        import fakeredis
+
+        with mock.patch('redis.Redis.from_url', return_value=fakeredis.FakeRedis()):
+            store = RedisUnackedStore('redis://fake', max_frames=2, ttl=60)
+        store.save(1, [(3, (10, 'c')), (1, (10, 'a'))])
+        store.save(1, [(2, (10, 'b'))])
+        self.assertEqual(store.take(1, {10}), {2: (10, 'b'), 3: (10, 'c')})
+
+
+@override_settings(CHAT_OUTBOUND={'MAX_UNACKED': 2})
+class DeliveryAckConsumerTests(ChatTestMixin, TransactionTestCase):
+    def setUp(self):
+        reset_membership_cache()
+        reset_presence_store()
+        reset_unacked_store()
+        self.alice = self.create_user('alice')
+        self.bob = self.create_user('bob')
+        self.room = self.create_room(self.alice, self.bob)
+
+    def tearDown(self):
+        reset_presence_store()
+        reset_unacked_store()
+
+    async def open(self, user, query=''):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chat/{self.room.id}/{query}')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive_messages(self, communicator, count):
+        frames = []
+        while len(frames) < count:
+            frame = await communicator.receive_json_from()
+            if frame['type'] == 'chat_message':
+                frames.append(frame)
+        return frames
+
+    async def test_unacked_messages_retransmitted_on_reconnect(self):
+        alice = await self.open(self.alice, '?acks=1')
+        bob = await self.open(self.bob)
+        for text in ('Первое', 'Второе', 'Третье'):
+            await bob.send_json_to({'type': 'chat_message', 'message': text})
+        received = await self.receive_messages(alice, 3)
+        await alice.send_json_to({'type': 'ack', 'message_ids': [received[1]['message_id']]})
+        await alice.receive_nothing()
+        await alice.disconnect()
+
+        # Первое сообщение вытеснено лимитом MAX_UNACKED, второе подтверждено
+        alice = await self.open(self.alice, '?acks=1')
+        retransmitted = await self.receive_messages(alice, 1)
+        self.assertEqual(retransmitted[0]['message'], 'Третье')
+        await alice.send_json_to({'type': 'ack', 'message_id': retransmitted[0]['message_id']})
+        await alice.receive_nothing()
+        await alice.disconnect()
+
+        alice = await self.open(self.alice, '?acks=1')
+        self.assertTrue(await alice.receive_nothing())
+        await alice.disconnect()
+        await bob.disconnect()
+
+        stats = outbound_stats.stats()
+        self.assertGreaterEqual(stats['retransmitted'], 1)
+        self.assertGreaterEqual(stats['acked'], 2)
+
+
+@override_settings(CHAT_PRESENCE={'GRACE': 0.2})
+class PresenceFanoutTests(ChatTestMixin, TransactionTestCase):
+    def setUp(self):
+        reset_membership_cache()
+        reset_presence_store()
+        self.alice = self.create_user('alice')
+        self.bob = self.create_user('bob')
+        self.carol = self.create_user('carol')
+        self.first = self.create_room(self.alice, self.bob)
+        self.second = self.create_room(self.alice, self.bob)
+
+    def tearDown(self):
+        reset_presence_store()
+
+    async def open(self, user, path='/ws/chat/'):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path)
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        if path == '/ws/chat/':
+            self.assertEqual((await communicator.receive_json_from())['type'], 'subscribed')
+        return communicator
+
+    async def test_status_published_once_per_user(self):
+        alice = await self.open(self.alice)
+        bob = await self.open(self.bob)
+        status = await alice.receive_json_from()
+        self.assertEqual((status['type'], status['user_id'], status['is_online']), ('user_status', self.bob.id, True))
+        self.assertNotIn('room_id', status)
+        # Две общие комнаты - один кадр
+        self.assertTrue(await alice.receive_nothing())
+
+        # Соединение с комнатой получает статус с room_id
+        room_socket = await self.open(self.alice, f'/ws/chat/{self.first.id}/')
+        await bob.disconnect()
+        await asyncio.sleep(0.3)
+        status = await room_socket.receive_json_from()
+        self.assertEqual((status['room_id'], status['is_online']), (self.first.id, False))
+        self.assertFalse((await alice.receive_json_from())['is_online'])
+        await alice.disconnect()
+        await room_socket.disconnect()
+
+    async def test_reconnect_within_grace_is_suppressed(self):
+        alice = await self.open(self.alice)
+        bob = await self.open(self.bob)
+        await alice.receive_json_from()
+        await bob.disconnect()
+        bob = await self.open(self.bob)
+        self.assertTrue(await alice.receive_nothing(timeout=0.3))
+        await bob.disconnect()
+        await alice.disconnect()
+
+    async def test_rejected_connection_does_not_touch_presence(self):
+        await database_sync_to_async(self.second.participants.add)(self.carol)
+        alice = await self.open(self.alice)
+        with mock.patch.object(ChatConsumer, 'leave_presence') as leave_presence:
+            for user in (self.carol, AnonymousUser()):
+                communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chat/{self.first.id}/')
+                communicator.scope['user'] = user
+                connected, _ = await communicator.connect()
+                self.assertFalse(connected)
+                # Сервер после отказа в рукопожатии все равно присылает websocket.disconnect
+                await communicator.disconnect()
+        leave_presence.assert_not_called()
+        self.assertTrue(await alice.receive_nothing(timeout=0.4))
+        await alice.disconnect()
+
+    async def test_new_member_becomes_watched(self):
+        alice = await self.open(self.alice)
+        await database_sync_to_async(self.first.participants.add)(self.carol)
+        await asyncio.sleep(0.05)
+        carol = await self.open(self.carol)
+        status = await alice.receive_json_from()
+        self.assertEqual((status['user_id'], status['is_online']), (self.carol.id, True))
+        await carol.disconnect()
+        await alice.disconnect()
+
+    async def test_membership_change_reloads_only_that_room(self):
+        alice = await self.open(self.alice)
+        with mock.patch('chat.consumers.room_member_ids', wraps=room_member_ids) as members:
+            await database_sync_to_async(self.first.participants.add)(self.carol)
+            await asyncio.sleep(0.05)
+        self.assertEqual([call.args for call in members.call_args_list], [(self.first.id,)])
+        await alice.disconnect()
+
+    async def test_large_rooms_are_watched_per_room(self):
+        layer = get_channel_layer()
+        with override_settings(CHAT_PRESENCE={'ROOM_WATCH_SIZE': 1}):
+            with mock.patch.object(layer, 'group_add', wraps=layer.group_add) as group_add:
+                alice = await self.open(self.alice)
+            groups = {call.args[0] for call in group_add.call_args_list}
+            self.assertIn(f'presence_room_{self.first.id}', groups)
+            self.assertNotIn(f'presence_{self.bob.id}', groups)
+
+            bob = await self.open(self.bob)
+            status = await alice.receive_json_from()
+            self.assertEqual((status['user_id'], status['is_online']), (self.bob.id, True))
+            # Две большие общие комнаты - один кадр
+            self.assertTrue(await alice.receive_nothing())
+            await bob.disconnect()
+            await alice.disconnect()
@@ -0,0 +1,114 @@
+"""
+Объединение кадров индикатора печати.
+
+Клиент может присылать `typing` на каждое нажатие клавиши, но в группу
+комнаты уходят только смены состояния пользователя в комнате: начал печатать
+и перестал. Остановка откладывается на STOP_DELAY секунд, и если за это время
+пользователь снова начал печатать, оба кадра поглощаются. Если от клиента
+TTL секунд нет кадров `typing`, состояние истекает и рассылается остановка.
+
+Состояние хранится в памяти процесса по ключу (user_id, room_id).
+"""
+import asyncio
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULTS = {
+    'STOP_DELAY': 1.0,
+    'TTL': 6.0,
+}
+
+
+def typing_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_TYPING', {})}
+
+
+class TypingTracker:
+    def __init__(self):
+        self._states = {}
+        self.received = 0
+        self.forwarded = 0
+        self.expired = 0
+
+    def is_typing(self, user_id, room_id):
+        return (user_id, room_id) in self._states
+
+    async def update(self, user_id, room_id, is_typing, broadcast):
+        """
+        Обрабатывает кадр typing. broadcast(is_typing) - корутина рассылки
+        в группу комнаты; вызывается только при смене состояния.
+        """
+        self.received += 1
+        config = typing_settings()
+        key = (user_id, room_id)
+        state = self._states.get(key)
+
+        if is_typing:
+            if state is None:
+                state = self._states[key] = {'broadcast': broadcast, 'timer': None, 'stopping': False}
+                self.forwarded += 1
+                await broadcast(True)
+            # Печать продолжается: отменяем отложенную остановку и продлеваем TTL
+            self._schedule(key, config['TTL'], expired=True)
+        elif state is not None and not state['stopping']:
+            if config['STOP_DELAY'] > 0:
+                self._schedule(key, config['STOP_DELAY'], expired=False)
+            else:
+                await self._stop(key, expired=False)
+
+    async def clear(self, user_id, room_ids):
+        """Остановка печати при отключении"""
+        for room_id in room_ids:
+            if (user_id, room_id) in self._states:
+                await self._stop((user_id, room_id), expired=True)
+
+    def _schedule(self, key, delay, expired):
+        state = self._states[key]
+        if state['timer'] is not None:
+            state['timer'].cancel()
+        state['stopping'] = not expired
+        state['timer'] = asyncio.get_running_loop().create_task(self._stop_later(key, delay, expired))
+
+    async def _stop_later(self, key, delay, expired):
+        await asyncio.sleep(delay)
+        state = self._states.get(key)
+        if state is not None and state['timer'] is asyncio.current_task():
+            state['timer'] = None
+            await self._stop(key, expired)
+
+    async def _stop(self, key, expired):
+        state = self._states.pop(key)
+        if state['timer'] is not None:
+            state['timer'].cancel()
+        if expired:
+            self.expired += 1
+        else:
+            self.forwarded += 1
+        try:
+            await state['broadcast'](False)
+        except Exception as e:
+            logger.error(f"Error broadcasting typing stop: {e}")
+
+    def stats(self):
+        """Счетчики: сколько кадров получено, разослано и поглощено"""
+        return {
+            'received': self.received,
+            'forwarded': self.forwarded,
+            'suppressed': self.received - self.forwarded,
+            'expired': self.expired,
+            'active': len(self._states),
+        }
+
+    def reset(self):
+        for state in self._states.values():
+            if state['timer'] is not None:
+                state['timer'].cancel()
+        self._states.clear()
+        self.received = self.forwarded = self.expired = 0
+
+
+typing_tracker = TypingTracker()
@@ -7,6 +7,10 @@ urlpatterns = [
     path('rooms/<int:room_id>/history/', views.chat_history, name='chat-history'),
     path('rooms/<int:room_id>/participants/', views.room_participants_status, name='room-participants'),
     path('messages/', views.MessageListCreateView.as_view(), name='message-list-create'),
+    path('messages/search/', views.message_search, name='message-search'),
+    path('messages/import/', views.import_messages, name='message-import'),
+    path('messages/export/', views.export_messages, name='message-export'),
+    path('sync/', views.sync, name='sync'),
     path('online-users/', views.online_users, name='online-users'),
     path('rooms/<int:room_id>/join/', views.join_room, name='join-room'),
     path('rooms/<int:room_id>/leave/', views.leave_room, name='leave-room'),
@@ -1,13 +1,28 @@
 from rest_framework import generics, permissions, status
 from rest_framework.response import Response
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
+from rest_framework.settings import api_settings
 from django.contrib.auth.models import User
 from django.db.models import Q, Count
-from django.db import models
-from .models import ChatRoom, Message, UserProfile
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.dateparse import parse_datetime
+from .models import ChatRoom, Message, ReadReceipt, UserProfile
+from .archive import history_records, history_with_archive, older_archived
+from .exporter import FORMATS, ExportFilterError, aexport_lines, export_lines, export_queryset
+from .history_cache import recent_page
+from .importer import DEFAULT_BATCH_SIZE, MessageImporter
+from .membership import is_member, user_room_ids
+from .metrics import CanReadMetrics, MetricsTokenAuthentication, get_registry
+from .persistence import message_write_behind
+from .presence import apply_presence, get_presence_store
+from .search import SearchOffsetError, search_messages
+from .sync import changes_since, initial_cursor
+from .pagination import (
+    InvalidCursor, MessageKeysetPagination, order_page, page_cursors, parse_limit
+)
 from .serializers import (
     ChatRoomSerializer, MessageSerializer, 
-    CreateMessageSerializer, UserProfileSerializer
+    CreateMessageSerializer, UserProfileSerializer, message_is_read
 )
 
 
@@ -16,7 +31,9 @@ class ChatRoomListCreateView(generics.ListCreateAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return ChatRoom.objects.filter(participants=self.request.user)
+        return ChatRoom.objects.filter(
+            id__in=user_room_ids(self.request.user.id)
+        ).prefetch_related('participants')
 
     def get_serializer_context(self):
         context = super().get_serializer_context()
@@ -33,7 +50,9 @@ class ChatRoomDetailView(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return ChatRoom.objects.filter(participants=self.request.user)
+        return ChatRoom.objects.filter(
+            id__in=user_room_ids(self.request.user.id)
+        ).prefetch_related('participants')
         
     def get_serializer_context(self):
         context = super().get_serializer_context()
@@ -43,6 +62,7 @@ class ChatRoomDetailView(generics.RetrieveUpdateDestroyAPIView):
 
 class MessageListCreateView(generics.ListCreateAPIView):
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = MessageKeysetPagination
 
     def get_serializer_class(self):
         if self.request.method == 'POST':
@@ -52,11 +72,17 @@ class MessageListCreateView(generics.ListCreateAPIView):
     def get_queryset(self):
         room_id = self.request.query_params.get('room')
         if room_id:
-            return Message.objects.filter(
-                room_id=room_id,
-                room__participants=self.request.user
-            ).order_by('timestamp')
-        return Message.objects.filter(room__participants=self.request.user)
+            if not room_id.isdigit() or not is_member(self.request.user.id, room_id):
+                return Message.objects.none()
+            return Message.objects.filter(room_id=room_id).select_related('user')
+        return Message.objects.filter(room_id__in=user_room_ids(self.request.user.id)).select_related('user')
+
+    def get_pending_messages(self):
+        """Еще не записанные сообщения комнаты (отложенная запись)"""
+        room_id = self.request.query_params.get('room')
+        if room_id and room_id.isdigit() and is_member(self.request.user.id, room_id):
+            return message_write_behind.pending_for_room(int(room_id))
+        return ()
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
@@ -66,7 +92,10 @@ class MessageListCreateView(generics.ListCreateAPIView):
 @permission_classes([permissions.IsAuthenticated])
 def online_users(request):
     """Получить список онлайн пользователей"""
-    online_profiles = UserProfile.objects.filter(is_online=True).select_related('user')
+    online_ids = get_presence_store().online_user_ids()
+    online_profiles = apply_presence(list(
+        UserProfile.objects.filter(user_id__in=online_ids).select_related('user')
+    ))
     serializer = UserProfileSerializer(online_profiles, many=True)
     return Response(serializer.data)
 
@@ -77,6 +106,8 @@ def join_room(request, room_id):
     """Присоединиться к комнате чата"""
     try:
         room = ChatRoom.objects.get(id=room_id)
+        if room.direct_key:
+            return Response({'error': 'Нельзя присоединиться к прямому чату'}, status=400)
         room.participants.add(request.user)
         return Response({'message': 'Успешно присоединились к комнате'})
     except ChatRoom.DoesNotExist:
@@ -112,31 +143,14 @@ def create_direct_chat(request):
     if other_user == request.user:
         return Response({'error': 'Нельзя создать чат с самим собой'}, status=400)
     
-    # Проверяем, существует ли уже прямой чат между этими пользователями
-    existing_room = ChatRoom.objects.filter(
-        chat_type='direct',
-        participants=request.user
-    ).filter(
-        participants=other_user
-    ).annotate(
-        participant_count=models.Count('participants')
-    ).filter(participant_count=2).first()
+    room, created = ChatRoom.get_or_create_direct(request.user, other_user)
     
-    if existing_room:
+    if not created:
         return Response({
-            'room': ChatRoomSerializer(existing_room).data,
+            'room': ChatRoomSerializer(room).data,
             'message': 'Чат уже существует'
         })
     
-    # Создаем новый прямой чат
-    room_name = f"Чат: {request.user.username} и {other_user.username}"
-    room = ChatRoom.objects.create(
-        name=room_name,
-        description=f"Прямой чат между {request.user.username} и {other_user.username}",
-        chat_type='direct'
-    )
-    room.participants.add(request.user, other_user)
-    
     return Response({
         'room': ChatRoomSerializer(room).data,
         'message': 'Чат успешно создан'
@@ -146,20 +160,70 @@ def create_direct_chat(request):
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated])
 def chat_history(request, room_id):
-    """Получить историю сообщений для конкретной комнаты"""
+    """
+    Получить историю сообщений для конкретной комнаты.
+
+    Возвращает одну страницу (по умолчанию самые новые сообщения).
+    Параметры: before/after (ID сообщения или ISO-время), limit, order.
+    """
     try:
-        room = ChatRoom.objects.get(id=room_id, participants=request.user)
-        messages = Message.objects.filter(room=room).order_by('timestamp')
+        if not is_member(request.user.id, room_id):
+            return Response({'error': 'Комната не найдена'}, status=404)
+        room = ChatRoom.objects.get(id=room_id)
+        messages = Message.objects.filter(room=room)
         
-        # Отмечаем сообщения как прочитанные
-        messages.filter(is_read=False).exclude(user=request.user).update(is_read=True)
+        # Сдвигаем водяной знак прочтения до последнего сообщения
+        ReadReceipt.mark_read(request.user, room.id)
+        
+        params = request.query_params
+        try:
+            cached = None
+            if not params.get('before') and not params.get('after'):
+                # Первая страница горячей комнаты берется из кэша уже сериализованной
+                cached = recent_page(room.id, messages.select_related('user'), parse_limit(params.get('limit')))
+            
+            if cached is not None:
+                page, has_more = cached
+                newest_first = True
+                own, peers = ReadReceipt.watermarks(room.id, request.user)
+                messages_data = [{
+                    **message,
+                    'is_read': message_is_read(message['id'], message['user']['id'], request.user.id, own, peers),
+                } for message in page]
+                archived = []
+                if not has_more:
+                    # В базе старше ничего нет: продолжение в архиве
+                    anchor = (parse_datetime(page[-1]['timestamp']), page[-1]['id']) if page else None
+                    archived, has_more = older_archived(room.id, anchor, parse_limit(params.get('limit')) - len(page))
+            else:
+                page, archived, has_more, newest_first = history_with_archive(
+                    room.id,
+                    messages.select_related('user'),
+                    before=params.get('before'),
+                    after=params.get('after'),
+                    limit=params.get('limit'),
+                    pending=message_write_behind.pending_for_room(room.id),
+                )
+                messages_data = list(MessageSerializer(page, many=True, context={'request': request}).data)
+                if archived:
+                    own, peers = ReadReceipt.watermarks(room.id, request.user)
+            
+            if archived:
+                archived_data = history_records(archived, request.user.id, own, peers)
+                messages_data = messages_data + archived_data if newest_first else archived_data + messages_data
+            next_before, next_after = page_cursors(messages_data, newest_first)
+            messages_data = order_page(messages_data, newest_first, params.get('order'))
+        except InvalidCursor as e:
+            return Response({'error': str(e)}, status=400)
         
-        serializer = MessageSerializer(messages, many=True)
         room_serializer = ChatRoomSerializer(room, context={'request': request})
         
         return Response({
             'room': room_serializer.data,
-            'messages': serializer.data
+            'messages': messages_data,
+            'has_more': has_more,
+            'next_before': next_before,
+            'next_after': next_after,
         })
     except ChatRoom.DoesNotExist:
         return Response({'error': 'Комната не найдена'}, status=404)
@@ -170,20 +234,27 @@ def chat_history(request, room_id):
 def room_participants_status(request, room_id):
     """Получить статус участников конкретной комнаты"""
     try:
-        room = ChatRoom.objects.get(id=room_id, participants=request.user)
+        if not is_member(request.user.id, room_id):
+            return Response({'error': 'Комната не найдена'}, status=404)
+        room = ChatRoom.objects.get(id=room_id)
         participants = room.participants.all().select_related('profile')
+        statuses = get_presence_store().statuses([user.id for user in participants])
         
         participants_data = []
         for user in participants:
+            is_online, seen = statuses[user.id]
             try:
                 profile = user.profile
+                last_seen = profile.last_seen
+                if seen and (last_seen is None or seen > last_seen):
+                    last_seen = seen
                 participant_info = {
                     'id': user.id,
                     'username': user.username,
                     'first_name': user.first_name,
                     'last_name': user.last_name,
-                    'is_online': profile.is_online,
-                    'last_seen': profile.last_seen,
+                    'is_online': is_online,
+                    'last_seen': last_seen,
                     'avatar': profile.avatar
                 }
             except UserProfile.DoesNotExist:
@@ -192,8 +263,8 @@ def room_participants_status(request, room_id):
                     'username': user.username,
                     'first_name': user.first_name,
                     'last_name': user.last_name,
-                    'is_online': False,
-                    'last_seen': None,
+                    'is_online': is_online,
+                    'last_seen': seen,
                     'avatar': 'https://via.placeholder.com/150?text=Avatar'
                 }
             participants_data.append(participant_info)
@@ -204,3 +275,128 @@ def room_participants_status(request, room_id):
         })
     except ChatRoom.DoesNotExist:
         return Response({'error': 'Комната не найдена'}, status=404)
+
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def message_search(request):
+    """
+    Полнотекстовый поиск сообщений в комнатах пользователя.
+    Параметры: q, room (необязательно), limit, offset.
+    """
+    query = request.GET.get('q', '').strip()
+    if not query:
+        return Response({'results': [], 'has_more': False, 'next_offset': None})
+
+    try:
+        limit = parse_limit(request.GET.get('limit'))
+        offset = int(request.GET.get('offset', 0))
+        room_id = request.GET.get('room')
+        room_id = int(room_id) if room_id else None
+    except (InvalidCursor, ValueError):
+        return Response({'error': 'Неверные параметры поиска'}, status=400)
+    if offset < 0:
+        return Response({'error': 'Неверные параметры поиска'}, status=400)
+
+    try:
+        messages, has_more = search_messages(
+            request.user, query, room_id=room_id, limit=limit, offset=offset
+        )
+    except SearchOffsetError as e:
+        return Response({'error': str(e)}, status=400)
+    serializer = MessageSerializer(messages, many=True, context={'request': request})
+    return Response({
+        'results': serializer.data,
+        'has_more': has_more,
+        'next_offset': offset + len(messages) if has_more else None,
+    })
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def sync(request):
+    """
+    Изменения во всех комнатах пользователя после курсора: новые сообщения,
+    вход и выход из комнат, водяные знаки прочтения, присутствие.
+    Без cursor возвращает только курсор "сейчас".
+    """
+    cursor = request.query_params.get('cursor')
+    if not cursor:
+        return Response({
+            'cursor': initial_cursor(), 'has_more': False, 'messages': [], 'rooms_joined': [],
+            'rooms_left': [], 'members': [], 'read_receipts': [], 'presence': [],
+        })
+    try:
+        changes = changes_since(request.user, cursor)
+    except InvalidCursor as e:
+        return Response({'error': str(e)}, status=400)
+
+    context = {'request': request}
+    changes['messages'] = MessageSerializer(changes['messages'], many=True, context=context).data
+    changes['rooms_joined'] = ChatRoomSerializer(changes['rooms_joined'], many=True, context=context).data
+    return Response(changes)
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAdminUser])
+def import_messages(request):
+    """
+    Массовый импорт сообщений (только для администраторов).
+    Тело запроса - JSONL, читается потоком; параметр batch_size.
+    """
+    try:
+        batch_size = int(request.query_params.get('batch_size', DEFAULT_BATCH_SIZE))
+    except ValueError:
+        batch_size = 0
+    if not 1 <= batch_size <= 10000:
+        return Response({'error': 'Неверный размер пачки'}, status=400)
+
+    report = MessageImporter(batch_size=batch_size).run(request.stream or ())
+    return Response(report, status=status.HTTP_201_CREATED if report['imported'] else status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def export_messages(request):
+    """
+    Потоковая выгрузка сообщений (только для администраторов).
+    Параметры: output (jsonl или csv), room, user, since, until.
+    """
+    params = request.query_params
+    file_format = params.get('output', 'jsonl')
+    if file_format not in FORMATS:
+        return Response({'error': 'Неизвестный формат выгрузки'}, status=400)
+    try:
+        room_id = int(params['room']) if params.get('room') else None
+        user_id = int(params['user']) if params.get('user') else None
+    except ValueError:
+        return Response({'error': 'Неверный фильтр'}, status=400)
+    try:
+        queryset = export_queryset(room_id, user_id, params.get('since'), params.get('until'))
+    except ExportFilterError as e:
+        return Response({'error': str(e)}, status=400)
+
+    content_type = 'text/csv' if file_format == 'csv' else 'application/x-ndjson'
+    # Синхронный генератор под ASGI Django целиком вычитывает в память,
+    # асинхронный под WSGI - тоже; выбираем по серверу
+    lines = export_lines if 'wsgi.version' in request.META else aexport_lines
+    response = StreamingHttpResponse(
+        lines(queryset, file_format), content_type=f'{content_type}; charset=utf-8'
+    )
+    response['Content-Disposition'] = f'attachment; filename="messages.{file_format}"'
+    return response
+
+
+@api_view(['GET'])
+@authentication_classes([MetricsTokenAuthentication, *api_settings.DEFAULT_AUTHENTICATION_CLASSES])
+@permission_classes([CanReadMetrics])
+def metrics(request):
+    """
+    Метрики процесса в формате Prometheus: по токену CHAT_METRICS['TOKEN']
+    или для администраторов.
+    """
+    registry = get_registry()
+    if registry is None:
+        return Response({'error': 'Метрики отключены'}, status=404)
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
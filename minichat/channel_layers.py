@@ -0,0 +1,72 @@
+"""
+Конфигурация channel layer для Django Channels.
+
+Бэкенды:
+    memory       - InMemoryChannelLayer, только один процесс (разработка и тесты)
+    redis        - RedisChannelLayer, каналы шардируются между всеми hosts
+    redis-pubsub - RedisPubSubChannelLayer, групповая рассылка через Redis Pub/Sub
+"""
+
+BACKENDS = {
+    'memory': 'channels.layers.InMemoryChannelLayer',
+    'redis': 'channels_redis.core.RedisChannelLayer',
+    'redis-pubsub': 'channels_redis.pubsub.RedisPubSubChannelLayer',
+}
+
+
+def build_channel_layers(backend, hosts, capacity=1000, expiry=30, group_expiry=86400):
+    """
+    Собирает значение CHANNEL_LAYERS.
+
+    capacity - сколько сообщений может ждать в одном канале (одном соединении);
+    при переполнении group_send пропускает этот канал, а не всю группу.
+    expiry - через сколько секунд недоставленное сообщение удаляется.
+    group_expiry - сколько живет членство в группе без переподключения.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f'Неизвестный channel layer: {backend}')
+
+    if backend == 'memory':
+        return {
+            'default': {
+                'BACKEND': BACKENDS[backend],
+                'CONFIG': {
+                    'capacity': capacity,
+                    'expiry': expiry,
+                    'group_expiry': group_expiry,
+                },
+            },
+        }
+
+    if backend == 'redis-pubsub':
+        # Pub/Sub не хранит очередей: доставка идет сразу подписчикам,
+        # каналы и группы распределяются между hosts по хэшу имени
+        return {
+            'default': {
+                'BACKEND': BACKENDS[backend],
+                'CONFIG': {
+                    'hosts': hosts,
+                    'prefix': 'minichat',
+                },
+            },
+        }
+
+    return {
+        'default': {
+            'BACKEND': BACKENDS[backend],
+            'CONFIG': {
+                # Несколько hosts = шардирование: каждый канал и группа живут
+                # на одном сервере, выбранном по хэшу имени
+                'hosts': hosts,
+                'prefix': 'minichat',
+                'capacity': capacity,
+                'expiry': expiry,
+                'group_expiry': group_expiry,
+                # HTTP-запросы не должны вытеснять очереди WebSocket-соединений
+                'channel_capacity': {
+                    'http.request': 200,
+                    'http.response!*': 10,
+                },
+            },
+        },
+    }
@@ -0,0 +1,93 @@
+"""
+Конфигурация базы данных.
+
+Профили:
+    sqlite   - файл SQLite; с tuned=True соединения открываются в режиме WAL
+               (читатели не блокируют писателя), synchronous=NORMAL, mmap и
+               ожиданием блокировки вместо ошибки "database is locked"
+    postgres - PostgreSQL (нужен psycopg); с pool=True соединения берутся из
+               пула psycopg_pool (нужен psycopg[pool]), иначе живут
+               conn_max_age секунд
+"""
+
+# Выполняются на каждом новом соединении (OPTIONS['init_command'])
+SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA cache_size=-16000',
+    'PRAGMA temp_store=MEMORY',
+)
+
+
+def sqlite_database(path, tuned=True, busy_timeout=20):
+    """
+    busy_timeout - сколько секунд писатель ждет блокировку (sqlite3 timeout,
+    то же, что PRAGMA busy_timeout). Транзакции начинаются с BEGIN IMMEDIATE:
+    блокировка записи берется сразу, и ожидание busy_timeout работает, а не
+    падает при попытке повысить блокировку чтения до записи.
+    """
+    database = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': path,
+    }
+    if tuned:
+        database['OPTIONS'] = {
+            'init_command': ';'.join(SQLITE_PRAGMAS),
+            'timeout': busy_timeout,
+            'transaction_mode': 'IMMEDIATE',
+        }
+    return database
+
+
+def postgres_database(name, user, password, host, port, pool=True, pool_min=2, pool_max=20,
+                      pool_timeout=10, conn_max_age=60):
+    """
+    pool - пул соединений Django 5.1+ (OPTIONS['pool']); с пулом CONN_MAX_AGE
+    должен быть 0. Без пула соединение переиспользуется conn_max_age секунд
+    и проверяется перед повторным использованием.
+    """
+    database = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': name,
+        'USER': user,
+        'PASSWORD': password,
+        'HOST': host,
+        'PORT': port,
+        'CONN_MAX_AGE': 0 if pool else conn_max_age,
+        'CONN_HEALTH_CHECKS': not pool,
+        'OPTIONS': {},
+    }
+    if pool:
+        database['OPTIONS']['pool'] = {
+            'min_size': pool_min,
+            'max_size': pool_max,
+            'timeout': pool_timeout,
+        }
+    return database
+
+
+def build_databases(engine, environ, sqlite_path):
+    """Собирает значение DATABASES по переменным окружения"""
+    if engine == 'sqlite':
+        database = sqlite_database(
+            sqlite_path,
+            tuned=environ.get('SQLITE_TUNING', '1') == '1',
+            busy_timeout=float(environ.get('SQLITE_BUSY_TIMEOUT', 20)),
+        )
+    elif engine == 'postgres':
+        database = postgres_database(
+            environ.get('POSTGRES_DB', 'minichat'),
+            environ.get('POSTGRES_USER', 'minichat'),
+            environ.get('POSTGRES_PASSWORD', ''),
+            environ.get('POSTGRES_HOST', '127.0.0.1'),
+            environ.get('POSTGRES_PORT', '5432'),
+            pool=environ.get('DATABASE_POOL', '1') == '1',
+            pool_min=int(environ.get('DATABASE_POOL_MIN', 2)),
+            pool_max=int(environ.get('DATABASE_POOL_MAX', 20)),
+            pool_timeout=float(environ.get('DATABASE_POOL_TIMEOUT', 10)),
+            conn_max_age=int(environ.get('DATABASE_CONN_MAX_AGE', 60)),
+        )
+    else:
+        raise ValueError(f'Неизвестная база данных: {engine}')
+    return {'default': database}
@@ -10,8 +10,12 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
+from .channel_layers import build_channel_layers
+from .databases import build_databases
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -46,6 +50,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat.metrics.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -76,12 +81,164 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'minichat.wsgi.application'
 
-# Channels - InMemoryChannelLayer (без Redis)
-# CHANNEL_LAYERS = {
-#     'default': {
-#         'BACKEND': 'channels.layers.InMemoryChannelLayer',
-#     },
-# }
+ASGI_APPLICATION = 'minichat.asgi.application'
+
+# Channels
+# CHANNEL_LAYER_BACKEND: memory (по умолчанию, один процесс), redis или redis-pubsub.
+# Для нескольких воркеров Daphne нужен redis; CHANNEL_REDIS_HOSTS - список
+# через запятую, при нескольких адресах каналы шардируются между ними.
+CHANNEL_LAYER_BACKEND = os.environ.get('CHANNEL_LAYER_BACKEND', 'memory')
+CHANNEL_REDIS_HOSTS = [
+    host.strip()
+    for host in os.environ.get('CHANNEL_REDIS_HOSTS', 'redis://127.0.0.1:6379/0').split(',')
+    if host.strip()
+]
+
+CHANNEL_LAYERS = build_channel_layers(
+    CHANNEL_LAYER_BACKEND,
+    CHANNEL_REDIS_HOSTS,
+    capacity=int(os.environ.get('CHANNEL_LAYER_CAPACITY', 1000)),
+    expiry=int(os.environ.get('CHANNEL_LAYER_EXPIRY', 30)),
+    group_expiry=int(os.environ.get('CHANNEL_LAYER_GROUP_EXPIRY', 86400)),
+)
+
+# Присутствие пользователей: memory (один процесс) или redis (общее для всех воркеров).
+# TTL - сколько секунд соединение считается живым без heartbeat,
+# last_seen пишется в UserProfile пачками раз в FLUSH_INTERVAL секунд.
+# GRACE - через сколько секунд после отключения публикуется статус offline
+# (переподключение за это время статус не меняет). За статусами участников
+# комнат больше ROOM_WATCH_SIZE соединение следит через группу комнаты, а не
+# подпиской на каждого собеседника.
+CHAT_PRESENCE = {
+    'BACKEND': os.environ.get('CHAT_PRESENCE_BACKEND', 'memory'),
+    'REDIS_URL': os.environ.get('CHAT_PRESENCE_REDIS_URL', CHANNEL_REDIS_HOSTS[0]),
+    'TTL': 90,
+    'FLUSH_INTERVAL': 30,
+    'FLUSH_BATCH_SIZE': 500,
+    'GRACE': float(os.environ.get('CHAT_PRESENCE_GRACE', 3.0)),
+    'ROOM_WATCH_SIZE': int(os.environ.get('CHAT_PRESENCE_ROOM_WATCH_SIZE', 200)),
+}
+
+# Отложенная запись сообщений из WebSocket: сообщение сразу получает ID и
+# рассылается, а в базу попадает пачками (bulk_create) из фоновой задачи.
+# FLUSH_INTERVAL - секунды; при MAX_PENDING сообщений в очереди прием
+# новых сообщений ждет записи (backpressure). ID выдаются блоками по
+# ID_BLOCK_SIZE на процесс; блок живет ID_BLOCK_LIFETIME секунд, и пока его
+# сообщения не записаны, отметки о прочтении не поднимаются выше его начала.
+# ID_BLOCK_EXPIRY - через сколько секунд не учитывается блок упавшего процесса.
+CHAT_WRITE_BEHIND = {
+    'ENABLED': os.environ.get('CHAT_WRITE_BEHIND') == '1',
+    'FLUSH_SIZE': 200,
+    'FLUSH_INTERVAL': 0.05,
+    'MAX_PENDING': 5000,
+    'ID_BLOCK_SIZE': 500,
+    'ID_BLOCK_LIFETIME': 1.0,
+    'ID_BLOCK_EXPIRY': 60,
+}
+
+# Кэш последних SIZE сообщений горячих комнат для первой страницы истории:
+# memory (LRU на MAX_ROOMS комнат в процессе) или redis (общий для воркеров).
+# Буфер в памяти сбрасывается только в том процессе, где изменилось сообщение,
+# поэтому с channel layer на Redis (несколько воркеров) по умолчанию redis.
+# TTL - секунды жизни буфера в обоих бэкендах.
+CHAT_HISTORY_CACHE = {
+    'ENABLED': os.environ.get('CHAT_HISTORY_CACHE', '1') == '1',
+    'BACKEND': os.environ.get(
+        'CHAT_HISTORY_CACHE_BACKEND', 'memory' if CHANNEL_LAYER_BACKEND == 'memory' else 'redis'
+    ),
+    'REDIS_URL': os.environ.get('CHAT_HISTORY_CACHE_REDIS_URL', CHANNEL_REDIS_HOSTS[0]),
+    'SIZE': 50,
+    'MAX_ROOMS': 1000,
+    'TTL': 3600,
+}
+
+# Кэш членства в комнатах (комнаты пользователя и участники комнаты) для
+# проверок доступа: memory (в процессе) или redis (общий для воркеров).
+# Сбрасывается сигналами m2m_changed; TTL - секунды жизни записи. Кэш в памяти
+# сбрасывается только в своем процессе, поэтому с channel layer на Redis
+# (несколько воркеров) по умолчанию redis.
+CHAT_MEMBERSHIP_CACHE = {
+    'ENABLED': os.environ.get('CHAT_MEMBERSHIP_CACHE', '1') == '1',
+    'BACKEND': os.environ.get(
+        'CHAT_MEMBERSHIP_CACHE_BACKEND', 'memory' if CHANNEL_LAYER_BACKEND == 'memory' else 'redis'
+    ),
+    'REDIS_URL': os.environ.get('CHAT_MEMBERSHIP_CACHE_REDIS_URL', CHANNEL_REDIS_HOSTS[0]),
+    'MAX_ENTRIES': 100000,
+    'TTL': 300,
+}
+
+# Синхронизация после переподключения (/api/chat/sync/ и cursor в ws/chat/).
+# SKEW - запас в секундах при выборке изменений (отложенная запись, часы
+# воркеров), MESSAGE_LIMIT - сообщений в ответе sync, REPLAY_LIMIT - сколько
+# пропущенных сообщений повторяется в WebSocket при подключении.
+CHAT_SYNC = {
+    'SKEW': 5.0,
+    'MESSAGE_LIMIT': 500,
+    'REPLAY_LIMIT': 200,
+}
+
+# Срок хранения сообщений (manage.py archive_messages). DAYS - общий срок в
+# днях (пусто - бессрочно), ChatRoom.retention_days его переопределяет.
+# Старые сообщения переносятся пачками по BATCH_SIZE в сегменты JSONL (gzip)
+# в ARCHIVE_DIR с паузой PAUSE секунд между пачками.
+CHAT_RETENTION = {
+    'DAYS': int(os.environ['CHAT_RETENTION_DAYS']) if os.environ.get('CHAT_RETENTION_DAYS') else None,
+    'ARCHIVE_DIR': os.environ.get('CHAT_ARCHIVE_DIR', str(BASE_DIR / 'archive')),
+    'BATCH_SIZE': 1000,
+    'PAUSE': 0.05,
+}
+
+# Индикатор печати: в комнату рассылаются только начало и конец печати.
+# STOP_DELAY - на сколько секунд откладывается остановка (повторное начало
+# печати ее отменяет), TTL - через сколько секунд без кадров typing
+# индикатор гаснет сам.
+CHAT_TYPING = {
+    'STOP_DELAY': 1.0,
+    'TTL': 6.0,
+}
+
+# Лимиты входящих кадров WebSocket (token bucket): RATE - кадров в секунду,
+# BURST - емкость корзины. CONNECTION - все кадры одного сокета, USER - все
+# кадры пользователя, ROOM - сообщения в комнату. С BACKEND='redis' лимиты
+# пользователя и комнаты общие для всех процессов.
+CHAT_RATE_LIMITS = {
+    'ENABLED': True,
+    'BACKEND': os.environ.get('CHAT_RATE_LIMIT_BACKEND', 'memory'),
+    'REDIS_URL': os.environ.get('CHAT_RATE_LIMIT_REDIS_URL', CHANNEL_REDIS_HOSTS[0]),
+    'CONNECTION': {'RATE': 10, 'BURST': 20},
+    'USER': {'RATE': 20, 'BURST': 40},
+    'ROOM': {'RATE': 50, 'BURST': 100},
+}
+
+# Исходящие очереди соединений WebSocket: MAX_FRAMES - емкость очереди (печать
+# и статусы склеиваются и отбрасываются, сообщения - нет; при переполнении
+# соединение закрывается с кодом CLOSE_CODE). С ?acks=1 неподтвержденные
+# сообщения (не больше MAX_UNACKED на соединение) хранятся UNACKED_TTL секунд
+# и повторяются при переподключении; BACKEND - memory или redis.
+CHAT_OUTBOUND = {
+    'ENABLED': os.environ.get('CHAT_OUTBOUND_QUEUE', '1') == '1',
+    'MAX_FRAMES': 256,
+    'CLOSE_CODE': 4008,
+    'MAX_UNACKED': 500,
+    'UNACKED_TTL': 600,
+    'BACKEND': os.environ.get('CHAT_UNACKED_BACKEND', 'memory'),
+    'REDIS_URL': os.environ.get('CHAT_UNACKED_REDIS_URL', CHANNEL_REDIS_HOSTS[0]),
+}
+
+# Кодек JSON для кадров WebSocket: json (стандартная библиотека) или orjson.
+CHAT_JSON_CODEC = os.environ.get('CHAT_JSON_CODEC', 'json')
+
+# Метрики HTTP-запросов и событий WebSocket на GET /metrics (формат
+# Prometheus). Запросы дольше SLOW_MS пишутся в лог chat.metrics вместе с
+# SQL. Если задан TOKEN, /metrics требует Authorization: Bearer <TOKEN>,
+# иначе доступен только администраторам.
+CHAT_METRICS = {
+    'ENABLED': os.environ.get('CHAT_METRICS', '1') == '1',
+    'SLOW_MS': int(os.environ.get('CHAT_METRICS_SLOW_MS', '500')),
+    'LOG_SQL': True,
+    'MAX_SQL': 20,
+    'TOKEN': os.environ.get('CHAT_METRICS_TOKEN', ''),
+}
 
 # CORS settings
 CORS_ALLOWED_ORIGINS = [
@@ -118,16 +275,28 @@ SIMPLE_JWT = {
     'USER_ID_CLAIM': 'user_id',
 }
 
+# Кэш пользователей для WebSocket-аутентификации по JWT (ключ - jti токена).
+# Запись живет не дольше TTL секунд и не дольше срока действия токена.
+CHAT_WS_AUTH_CACHE = {
+    'MAX_SIZE': 10000,
+    'TTL': 300,
+}
+
 
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
-}
+# DATABASE_ENGINE=sqlite (по умолчанию) или postgres.
+# SQLite: SQLITE_TUNING=1 включает WAL, synchronous=NORMAL, mmap и ожидание
+# блокировки SQLITE_BUSY_TIMEOUT секунд.
+# PostgreSQL: POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_HOST,
+# POSTGRES_PORT; DATABASE_POOL=1 - пул соединений (DATABASE_POOL_MIN/MAX),
+# иначе соединение живет DATABASE_CONN_MAX_AGE секунд.
+DATABASES = build_databases(
+    os.environ.get('DATABASE_ENGINE', 'sqlite'),
+    os.environ,
+    sqlite_path=BASE_DIR / 'db.sqlite3',
+)
 
 
 # Password validation